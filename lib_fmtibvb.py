@@ -3,7 +3,7 @@
 #
 # GitHub eArmada8/gust_stuff
 
-import io, re, struct, json
+import io, re, struct, json, mmap
 
 # Currently only simple formats (8-, 16-, and 32-bit) are supported.  Floats must be 32-bit.
 # Attempting to read an unsupported format will return a raw bytes object.
@@ -147,6 +147,84 @@ def get_stride_from_dxgi_format(dxgi_format):
     else:
         return False
 
+# Used by the segmented (vbN stride) buffers, which are read and written a whole column at a time
+# with numpy.  Returns the numpy dtype, the number of values per vertex and the normalization
+# factor (None if not normalized), or False if the format is not supported.
+def get_numpy_format_from_dxgi_format(dxgi_format, e = '<'):
+    dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
+    dxgi_format_split = dxgi_format.split('_')
+    if len(dxgi_format_split) == 2:
+        numtype = dxgi_format_split[1]
+        vec_format = re.findall("[0-9]+",dxgi_format_split[0])
+        if len(vec_format) > 0:
+            vec_bits = int(vec_format[0])
+            vec_elements = len(vec_format)
+            if numtype == 'FLOAT' and vec_bits in [16, 32]:
+                return(e + 'f' + str(vec_bits // 8), vec_elements, None)
+            elif numtype in ['UINT', 'UNORM'] and vec_bits in [8, 16, 32]:
+                return(e + 'u' + str(vec_bits // 8), vec_elements, (2**vec_bits)-1 if numtype == 'UNORM' else None)
+            elif numtype in ['SINT', 'SNORM'] and vec_bits in [8, 16, 32]:
+                return(e + 'i' + str(vec_bits // 8), vec_elements, (2**(vec_bits-1))-1 if numtype == 'SNORM' else None)
+    return False
+
+def get_seg_buffer_strides(seg_elements, seg_stride):
+    buffer_strides = []
+    for i in range(len(seg_elements)):
+        if i == len(seg_elements) - 1:
+            buffer_strides.append(int(seg_stride) - int(seg_elements[i]["AlignedByteOffset"]))
+        else:
+            buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
+                - int(seg_elements[i]["AlignedByteOffset"]))
+    return(buffer_strides)
+
+def unpack_vb_column(column, dxgi_format, e = '<'):
+    # column is a (vertices, bytes) uint8 array holding one element of every vertex
+    numpy_format = get_numpy_format_from_dxgi_format(dxgi_format, e)
+    if numpy_format == False or numpy_format[1] * int(numpy_format[0][2:]) != column.shape[1]:
+        # Same as unpack_dxgi_vector() for formats it does not support
+        return([bytes(x) for x in column])
+    dtype, vec_elements, float_max = numpy_format
+    values = column.copy().view(dtype).reshape(len(column), vec_elements)
+    if float_max is not None:
+        values = values / float_max
+    return(values.tolist())
+
+def pack_vb_column(buffer, buffer_stride, dxgi_format, e = '<'):
+    # Returns the element of every vertex as a (vertices, buffer_stride) uint8 array, the same bytes
+    # as pack_dxgi_vector().  Columns that it would reject (integers out of range or not integers,
+    # floats too large for the format, NaN in normalized formats, short vectors) are packed with it
+    # instead, so that the same error is raised.  Components past vec_elements are ignored.
+    import numpy
+    def pack_by_vector ():
+        column = io.BytesIO()
+        for vector in buffer:
+            pack_dxgi_vector(column, vector, buffer_stride, dxgi_format, e)
+        return(numpy.frombuffer(column.getvalue(), dtype = 'u1').reshape(len(buffer), buffer_stride))
+    numpy_format = get_numpy_format_from_dxgi_format(dxgi_format, e)
+    if numpy_format == False or numpy_format[1] * int(numpy_format[0][2:]) != buffer_stride or len(buffer) == 0:
+        return(pack_by_vector())
+    dtype, vec_elements, float_max = numpy_format
+    try:
+        values = numpy.array(buffer)
+    except ValueError: # Vectors of different lengths
+        return(pack_by_vector())
+    if values.ndim != 2 or values.shape[1] < vec_elements or not values.dtype.kind in 'biuf':
+        return(pack_by_vector())
+    values = values[:, :vec_elements]
+    if float_max is not None:
+        if numpy.isnan(values).any():
+            return(pack_by_vector())
+        packed = numpy.round(numpy.clip(values.astype('float64'), 0 if dtype[1] == 'u' else -1, 1) * float_max).astype(dtype)
+    elif dtype[1] == 'f':
+        packed = values.astype(dtype)
+        if (numpy.isinf(packed) & ~numpy.isinf(values)).any():
+            return(pack_by_vector())
+    else:
+        if values.dtype.kind == 'f' or values.min() < numpy.iinfo(dtype).min or values.max() > numpy.iinfo(dtype).max:
+            return(pack_by_vector())
+        packed = values.astype(dtype)
+    return(numpy.ascontiguousarray(packed).view('u1'))
+
 def read_fmt(fmt_filename):
     fmt_struct = {}
     with open(fmt_filename, 'r') as f:
@@ -256,34 +334,25 @@ def read_vb_stream(vb_stream, fmt_struct, e = '<'):
             vb_data.append(element)
     return(vb_data)
 
-def read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e = '<'):
-    seg_stride = "vb{} stride".format(input_slot)
-    seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+def read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e = '<', seg_elements = None):
+    # vb_stream can be any bytes-like object, such as a memory-mapped file.  Each element is
+    # decoded for all the vertices at once.
+    import numpy
+    seg_stride = int(fmt_struct["vb{} stride".format(input_slot)])
+    if seg_elements is None:
+        seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+    num_vertex = len(vb_stream) // seg_stride
+    vertices = numpy.frombuffer(vb_stream, dtype = 'u1', count = num_vertex * seg_stride).reshape(num_vertex, seg_stride)
+    buffer_strides = get_seg_buffer_strides(seg_elements, seg_stride)
     vb_data = []
-    with io.BytesIO(vb_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        num_vertex = int(length / int(fmt_struct[seg_stride]))
-        buffer_strides = []
-        # Calculate individual buffer strides
-        for i in range(len(seg_elements)):
-            if i == len(seg_elements) - 1:
-                buffer_strides.append(int(fmt_struct[seg_stride]) - int(seg_elements[i]["AlignedByteOffset"]))
-            else:
-                buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
-                    - int(seg_elements[i]["AlignedByteOffset"]))
-        # Read in the buffers
-        for i in range(len(seg_elements)):
-            element = {}
-            element["SemanticName"] = seg_elements[i]["SemanticName"]
-            element["SemanticIndex"] = seg_elements[i]["SemanticIndex"]
-            element["InputSlot"] = seg_elements[i]["InputSlot"]
-            element_buffer = []
-            for j in range(num_vertex):
-                f.seek(j * int(fmt_struct[seg_stride]) + int(seg_elements[i]["AlignedByteOffset"]),0)
-                element_buffer.append(unpack_dxgi_vector(f, buffer_strides[i], seg_elements[i]["Format"], e))
-            element["Buffer"] = element_buffer
-            vb_data.append(element)
+    for i in range(len(seg_elements)):
+        element = {}
+        element["SemanticName"] = seg_elements[i]["SemanticName"]
+        element["SemanticIndex"] = seg_elements[i]["SemanticIndex"]
+        element["InputSlot"] = seg_elements[i]["InputSlot"]
+        offset = int(seg_elements[i]["AlignedByteOffset"])
+        element["Buffer"] = unpack_vb_column(vertices[:, offset:offset + buffer_strides[i]], seg_elements[i]["Format"], e)
+        vb_data.append(element)
     return(vb_data)
 
 def read_vb(vb_filename, fmt_struct, e = '<'):
@@ -294,9 +363,14 @@ def read_vb(vb_filename, fmt_struct, e = '<'):
     elif 'vb0 stride' in fmt_struct:
         vb = []
         for input_slot in [x[2:-7] for x in fmt_struct if len(x.split('stride')) > 1]:
+            seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+            # Each slot file is memory-mapped rather than read into memory
             with open(vb_filename + input_slot, 'rb') as f:
-                vb_stream = f.read()
-            vb.extend(read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e))
+                if f.seek(0, 2) == 0:
+                    vb.extend(read_seg_vb_stream(b'', fmt_struct, input_slot, e, seg_elements))
+                else:
+                    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as vb_stream:
+                        vb.extend(read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e, seg_elements))
         return(vb)
     else:
         print("Decoding error when trying to interpret fmt file for {0}!\r\n".format(vb_filename))
@@ -325,27 +399,24 @@ def write_vb_stream(vb_data, vb_stream, fmt_struct, e = '<', interleave = True):
     return
 
 def write_seg_vb_stream(vb_data, vb_stream, fmt_struct, input_slot, e = '<', interleave = True):
-    buffer_strides = []
-    seg_stride = fmt_struct["vb{} stride".format(input_slot)]
+    # Each element is encoded for all the vertices at once, and the slot is written in one go
+    import numpy
+    seg_stride = int(fmt_struct["vb{} stride".format(input_slot)])
     seg_vb_data = [x for x in vb_data if x['InputSlot'] == input_slot]
     seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
-    # Calculate individual buffer strides
-    for i in range(len(seg_elements)):
-        if i == len(seg_elements) - 1:
-            buffer_strides.append(int(seg_stride) - int(seg_elements[i]["AlignedByteOffset"]))
-        else:
-            buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
-                - int(seg_elements[i]["AlignedByteOffset"]))
+    buffer_strides = get_seg_buffer_strides(seg_elements, seg_stride)
+    columns = [pack_vb_column(seg_vb_data[i]["Buffer"], buffer_strides[i], seg_elements[i]["Format"], e)\
+        for i in range(len(seg_elements))]
     if interleave == True:
-        # Write out the buffers, vertex by vertex.
-        for j in range(len(seg_vb_data[0]["Buffer"])):
-            for i in range(len(seg_elements)):
-                pack_dxgi_vector(vb_stream, seg_vb_data[i]["Buffer"][j], buffer_strides[i], seg_elements[i]["Format"], e)
-    else:
-        # Write out the buffers, element by element.
+        # Vertex by vertex
+        vertices = numpy.zeros((len(seg_vb_data[0]["Buffer"]), seg_stride), dtype = 'u1')
         for i in range(len(seg_elements)):
-            for j in range(len(seg_vb_data[0]["Buffer"])):
-                pack_dxgi_vector(vb_stream, seg_vb_data[i]["Buffer"][j], buffer_strides[i], seg_elements[i]["Format"], e)
+            offset = int(seg_elements[i]["AlignedByteOffset"])
+            vertices[:, offset:offset + buffer_strides[i]] = columns[i]
+        vb_stream.write(vertices.tobytes())
+    else:
+        # Element by element
+        vb_stream.write(b''.join([x.tobytes() for x in columns]))
     return
 
 def write_vb(vb_data, vb_filename, fmt_struct, e = '<', interleave = True):
@@ -0,0 +1,115 @@
+# Library interface to the vato tools, for programs that export many files from one process
+# (e.g. a long-running service).
+#
+# Each function takes a filename or the file data (bytes or a binary stream) and an options dict,
+# and returns the result instead of writing files.  Nothing here changes the current directory,
+# reads module settings, prints or prompts, so the functions can be called from several threads
+# at once.  The tool modules (and numpy / pillow) are only imported when they are first needed.
+#
+# Example:
+#   import lib_vato_api
+#   gltf_data, buffer = lib_vato_api.export_imdl('00_base.mdl', {'embed_textures': True})
+#   glb = lib_vato_api.make_glb(gltf_data, buffer)
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import copy, os, struct, json
+
+# name:           names the file when data is given (used in messages and to find textures)
+# only:           list of parts of the model to export, see vato_extract_imdl.parse_selection()
+# embed_textures: embed the textures from the .txp files in txp_folder into the glTF buffer
+# txp_folder:     folder to search for .txp files, by default the folder of the .mdl
+# texture_cache:  dict to reuse decoded textures between calls (do not share it between threads)
+# choose_texture: function (material_name, image_list) returning the image index of a material that
+#                 does not match any image by name; by default the first image is used
+# geom_workers:   number of processes decoding the geoms of a model
+# lods:           number of simplified levels of detail added to each mesh with MSFT_lod
+# lod_ratio:      fraction of the triangles kept by each level of detail
+# merge_skins:    give the whole model one skin instead of one per mesh
+# batch:          merge the primitives that share a material and skin (not with lods)
+# fps:            frame rate of the animations
+# texture_format: png, tga, dds or raw, and native to keep the texel layout (dds / raw only)
+# profile:        a profile from lib_vato_profile.new_profile() to record the stage timings in
+# log:            function (message) called with warnings, by default they are dropped
+default_options = {'name': '', 'only': None, 'embed_textures': False, 'txp_folder': None, 'texture_cache': None,\
+    'choose_texture': None, 'geom_workers': 1, 'lods': 0, 'lod_ratio': 0.5, 'merge_skins': False, 'batch': False, 'fps': 24, 'texture_format': 'png', 'native': False,\
+    'profile': None, 'log': None}
+
+def new_options (options = None, **kwargs):
+    # Returns a complete options dict, from the defaults updated with options and kwargs
+    all_options = dict(default_options)
+    if options is not None:
+        unknown = [x for x in options if not x in default_options]
+        if len(unknown) > 0:
+            raise ValueError("Unknown options: {}".format(', '.join(unknown)))
+        all_options.update(options)
+    all_options.update(kwargs)
+    return(all_options)
+
+def _read_source (source, options):
+    # Returns the filename and data to pass to the tools
+    if isinstance(source, (str, os.PathLike)):
+        return(os.fspath(source), None)
+    return(options['name'], source)
+
+def export_imdl (source, options = None):
+    # Returns (gltf_data, buffer) for a model.  gltf_data has one buffer without a uri.
+    import vato_extract_imdl
+    options = new_options(options)
+    imdl_file, data = _read_source(source, options)
+    if options['embed_textures'] == True and options['txp_folder'] is None and data is not None and imdl_file == '':
+        raise ValueError("txp_folder (or name) is needed to embed textures of a model given as data")
+    gltf = vato_extract_imdl.build_imdl_gltf(imdl_file, data = data, profile = options['profile'], only = options['only'],\
+        embed_textures = options['embed_textures'], texture_cache = options['texture_cache'],\
+        txp_folder = options['txp_folder'], geom_workers = options['geom_workers'],\
+        choose_texture = options['choose_texture'], log = options['log'], lod_levels = options['lods'],\
+        lod_ratio = options['lod_ratio'], merge_skins = options['merge_skins'],\
+        batch = options['batch'])
+    if gltf is None:
+        raise ValueError("{} is not an IMDL file".format(imdl_file if imdl_file != '' else 'Input'))
+    return(gltf)
+
+def read_skeleton (source, options = None):
+    # Returns the node tree of a model, to animate with export_imtn()
+    import vato_extract_imtn
+    options = new_options(options)
+    imdl_file, data = _read_source(source, options)
+    return(vato_extract_imtn.obtain_skeleton_from_imdl(imdl_file, data = data))
+
+def export_imtn (source, skeleton, options = None):
+    # Returns (gltf_data, buffer) for an animation.  skeleton is a model (filename or data), or the
+    # result of read_skeleton(), which saves reading the model again for each animation.
+    import vato_extract_imtn
+    options = new_options(options)
+    imtn_file, data = _read_source(source, options)
+    if isinstance(skeleton, list):
+        skel_struct = copy.deepcopy(skeleton)
+    else:
+        skel_struct = read_skeleton(skeleton)
+    gltf = vato_extract_imtn.build_imtn_gltf(imtn_file, skel_struct, data = data, profile = options['profile'],\
+        fps = options['fps'])
+    if gltf is None:
+        raise ValueError("{} is not an IMTN file".format(imtn_file if imtn_file != '' else 'Input'))
+    return(gltf)
+
+def export_txp (source, options = None, names = None):
+    # Returns a dict of the textures in a texture archive by name, each a list of (extension, data)
+    # in texture_format.  If names is given, only those textures are decoded.
+    import vato_extract_txp
+    options = new_options(options)
+    if not options['texture_format'] in vato_extract_txp.texture_output_formats:
+        raise ValueError("Unknown texture format {}".format(options['texture_format']))
+    native = options['native'] == True and options['texture_format'] in ['dds', 'raw']
+    txp_file, data = _read_source(source, options)
+    texture_names, textures = vato_extract_txp.read_txp_textures(txp_file, names = names, profile = options['profile'],\
+        data = data, log = options['log'], decode = not native)
+    return({x: vato_extract_txp.encode_texture(textures[x], options['texture_format'], native, options['profile'])\
+        for x in texture_names if x in textures})
+
+def make_glb (gltf_data, buffer):
+    # Returns the .glb file for a glTF document and its buffer
+    jsondata = json.dumps(gltf_data).encode('utf-8')
+    jsondata += b' ' * (4 - len(jsondata) % 4)
+    return(b''.join([struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(buffer)),\
+        struct.pack('<II', len(jsondata), 1313821514), jsondata,\
+        struct.pack('<II', len(buffer), 5130562), buffer]))
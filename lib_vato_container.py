@@ -0,0 +1,52 @@
+# Reader for the section container shared by the IMDL (.mdl) and IMTN (.mtn) formats: a header
+# with five block offsets, then the sections (magic, size, a count and the records), then the
+# blocks, the first of which is the string dictionary.
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import struct
+from lib_vato_profile import profile_stage
+
+# Names of the five blocks, in header order
+imdl_block_names = ["dictionary", "blend_indices", "triangles", "unknown_blanks", "vertices"]
+#block 1 is unknown - may visK data
+#block 2 is keyframes
+#block 3 is actually empty in my sample file (same offset as block 4)
+#block 4 is animation data (TRS)
+imtn_block_names = ["dictionary", "block1", "times", "block3", "trs_vals"]
+
+def read_container (f):
+    # Reads the header and indexes the sections in one pass, without decoding them.  f must be at the
+    # start of the file.  Returns None if the file is not a section container.
+    container = {'magic': f.read(4), 'sections': {}}
+    if not container['magic'] in [b'IMDL', b'IMTN']:
+        return(None)
+    container['unk0'], container['unk1'], container['unk2'], container['num_sections'] = struct.unpack("<4H", f.read(8))
+    container['block_offsets'] = list(struct.unpack("<5I", f.read(20)))
+    section_offset = f.tell()
+    while section_offset < container['block_offsets'][0]:
+        f.seek(section_offset)
+        section_magic, section_size, num_sections, count = struct.unpack("<4s3I", f.read(16))
+        container['sections'][section_magic] = {'offset': section_offset, 'size': section_size, 'count': count}
+        if section_size < 16:
+            break
+        section_offset += section_size
+    return(container)
+
+def seek_section (f, container, section_magic):
+    # Moves f to the first record of the section, and returns the number of records (None if the
+    # file has no such section)
+    if not section_magic in container['sections']:
+        return(None)
+    f.seek(container['sections'][section_magic]['offset'] + 16)
+    return(container['sections'][section_magic]['count'])
+
+def read_from_string_dictionary (f, start_offset, profile = None):
+    with profile_stage(profile, 'string_lookup'):
+        current_loc = f.tell()
+        f.seek(start_offset)
+        null_term_string = f.read(1)
+        while null_term_string[-1] != 0:
+            null_term_string += f.read(1)
+        f.seek(current_loc)
+    return(null_term_string[:-1].decode())
@@ -0,0 +1,166 @@
+# A small library of input/output helpers shared by the vato tools.
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import io, os, queue, shutil, threading
+from contextlib import nullcontext
+
+# Inputs can be given as a filename, or as data that is already in memory: bytes, bytearray,
+# memoryview or an open binary stream.  Streams must start at the beginning of the file, since
+# the formats use absolute offsets; they are not closed when processing is done.
+def open_input (filename, data = None):
+    if data is None:
+        return(open(filename, 'rb'))
+    elif hasattr(data, 'read'):
+        return(nullcontext(data))
+    else:
+        return(io.BytesIO(data))
+
+def read_input (filename, data = None):
+    if data is None:
+        with open(filename, 'rb') as f:
+            return(f.read())
+    elif hasattr(data, 'read'):
+        return(data.read())
+    else:
+        return(data)
+
+def stream_size (f):
+    current_loc = f.tell()
+    size = f.seek(0, 2)
+    f.seek(current_loc)
+    return(size)
+
+# Background writer: finished outputs are queued and written by a small pool of threads, so
+# decoding the next file overlaps with writing the last one.  Submitting blocks while more than
+# max_pending_bytes are waiting to be written, which keeps memory use capped.
+def start_writer (num_threads = 2, max_pending_bytes = 256 * 1024 * 1024):
+    writer = {'queue': queue.Queue(), 'threads': [], 'pending_bytes': 0, 'max_pending_bytes': max_pending_bytes,\
+        'condition': threading.Condition(), 'errors': [], 'bytes_written': 0, 'pending_files': {}}
+    def write_loop ():
+        while True:
+            job = writer['queue'].get()
+            if job is None:
+                break
+            filename, chunks, size = job
+            try:
+                with open(filename, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            except OSError as e:
+                writer['errors'].append(e)
+            with writer['condition']:
+                writer['pending_bytes'] -= size
+                writer['bytes_written'] += size
+                writer['pending_files'][filename] -= 1
+                if writer['pending_files'][filename] == 0:
+                    del(writer['pending_files'][filename])
+                writer['condition'].notify_all()
+    for _ in range(num_threads):
+        writer['threads'].append(threading.Thread(target = write_loop, daemon = True))
+        writer['threads'][-1].start()
+    return(writer)
+
+def write_output (writer, filename, chunks):
+    # chunks is a bytes-like object or a list of them, which must not be modified afterwards.
+    # Without a writer, the file is written immediately.
+    if not isinstance(chunks, (list, tuple)):
+        chunks = [chunks]
+    if writer is None:
+        with open(filename, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return
+    if len(writer['errors']) > 0:
+        raise writer['errors'][0]
+    size = sum([len(x) for x in chunks])
+    with writer['condition']:
+        while writer['pending_bytes'] > 0 and writer['pending_bytes'] + size > writer['max_pending_bytes']:
+            writer['condition'].wait()
+        writer['pending_bytes'] += size
+        writer['pending_files'][filename] = writer['pending_files'].get(filename, 0) + 1
+    writer['queue'].put((filename, chunks, size))
+    return
+
+def write_output_stream (writer, filename, chunks, stream, chunk_size = 1024 * 1024):
+    # Writes chunks, then the contents of stream (from its start) a chunk_size at a time, so that
+    # they are never all in memory.  The file is written before returning, so the stream can be closed.
+    if not isinstance(chunks, (list, tuple)):
+        chunks = [chunks]
+    wait_for_output(writer, filename)
+    stream.seek(0)
+    with open(filename, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        shutil.copyfileobj(stream, f, chunk_size)
+    return
+
+def wait_for_output (writer, filename):
+    # Blocks until any queued writes to filename are done
+    if writer is not None:
+        with writer['condition']:
+            while filename in writer['pending_files']:
+                writer['condition'].wait()
+    return
+
+def finish_writer (writer):
+    # Waits for all queued outputs to be written, and raises the first write error, if any
+    if writer is not None:
+        for _ in writer['threads']:
+            writer['queue'].put(None)
+        for thread in writer['threads']:
+            thread.join()
+        writer['threads'] = []
+        if len(writer['errors']) > 0:
+            raise writer['errors'][0]
+    return
+
+# Makes target a copy of source without writing the data again, as a reflink (copy-on-write clone,
+# Linux filesystems such as btrfs and xfs).  Returns 'reflink', or None if the filesystem does not
+# support it and the data must be copied.  Hard links are never made, since the files would then
+# share their data and editing one would change the other.
+def link_file (source, target):
+    if os.path.abspath(source) == os.path.abspath(target):
+        return('same')
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno()) # FICLONE
+        return('reflink')
+    except (ImportError, OSError):
+        if os.path.exists(target):
+            os.remove(target)
+    return(None)
+
+# Read-ahead prefetcher: yields (filename, data) for each file, while a background thread reads
+# up to max_files (and about max_bytes) ahead.  Read errors are raised when that file comes up.
+def prefetch_inputs (filenames, max_files = 4, max_bytes = 256 * 1024 * 1024):
+    files = queue.Queue(maxsize = max_files)
+    state = {'pending_bytes': 0, 'condition': threading.Condition()}
+    def read_loop ():
+        for filename in filenames:
+            with state['condition']:
+                while state['pending_bytes'] > max_bytes:
+                    state['condition'].wait()
+            try:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                with state['condition']:
+                    state['pending_bytes'] += len(data)
+            except OSError as e:
+                data = e
+            files.put((filename, data))
+        files.put(None)
+    threading.Thread(target = read_loop, daemon = True).start()
+    while True:
+        item = files.get()
+        if item is None:
+            break
+        if isinstance(item[1], Exception):
+            raise item[1]
+        with state['condition']:
+            state['pending_bytes'] -= len(item[1])
+            state['condition'].notify_all()
+        yield(item)
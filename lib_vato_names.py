@@ -0,0 +1,150 @@
+# Name index built from the string archives (.pck files with flag 0x10), to give names to the files
+# and textures that are only known by a 32-bit hash.  The index is kept in vato_names.json so that
+# the strings of every archive unpacked so far are available to the later runs of the tools.
+#
+# The hash function of the game is not known yet.  Each string is indexed under a few common 32-bit
+# string hashes.  The index is checked against many hashes, so one of them can match a string by
+# chance; a hash function is only used once it has matched several different hashes (the matches
+# are kept in the index), and until then no names are resolved.
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import json, os, struct, zlib
+
+default_names_file = 'vato_names.json'
+
+def _fnv1a_32 (data):
+    value = 0x811C9DC5
+    for x in data:
+        value = ((value ^ x) * 0x01000193) & 0xFFFFFFFF
+    return(value)
+
+def _fnv1_32 (data):
+    value = 0x811C9DC5
+    for x in data:
+        value = ((value * 0x01000193) & 0xFFFFFFFF) ^ x
+    return(value)
+
+def _djb2 (data):
+    value = 5381
+    for x in data:
+        value = (value * 33 + x) & 0xFFFFFFFF
+    return(value)
+
+name_hash_functions = {'crc32': zlib.crc32, 'fnv1a32': _fnv1a_32, 'fnv1_32': _fnv1_32, 'djb2': _djb2}
+
+# Different hashes a hash function must match, and more than twice as many as any other, to be used
+settle_matches = 3
+
+def new_name_index ():
+    return({'algorithm': None, 'names': {x:{} for x in name_hash_functions}, 'matches': {x:set() for x in name_hash_functions},\
+        'modified': False})
+
+def load_name_index (names_file = default_names_file):
+    # Returns an empty index if the file does not exist yet
+    index = new_name_index()
+    if os.path.exists(names_file):
+        with open(names_file, 'rb') as f:
+            saved = json.loads(f.read())
+        for algorithm in saved['names']:
+            if algorithm in index['names']:
+                index['names'][algorithm] = {int(k, 16):v for k,v in saved['names'][algorithm].items()}
+        for algorithm in saved.get('matches', {}):
+            if algorithm in index['matches']:
+                index['matches'][algorithm] = set([int(x, 16) for x in saved['matches'][algorithm]])
+        # The saved algorithm is not trusted on its own (older indices settled on the first match)
+        settle_name_algorithm(index)
+    return(index)
+
+def save_name_index (index, names_file = default_names_file):
+    saved = {'algorithm': index['algorithm'], 'names': {algorithm: {'{:08x}'.format(k):v for k,v in\
+        index['names'][algorithm].items()} for algorithm in index['names']}, 'matches': {algorithm:\
+        ['{:08x}'.format(x) for x in sorted(index['matches'][algorithm])] for algorithm in index['matches']}}
+    with open(names_file, 'wb') as f:
+        f.write(json.dumps(saved, indent=4).encode('utf-8'))
+    index['modified'] = False
+    return
+
+def add_names (index, names):
+    # Indexes each string, and its file name if it is a path, under every candidate hash.  The hash
+    # may be of either, and of the lowercase string.  The first string to claim a hash keeps it.
+    for name in names:
+        variants = [name, name.lower()]
+        if '/' in name or '\\' in name:
+            base_name = name.replace('\\', '/').split('/')[-1]
+            variants.extend([base_name, base_name.lower()])
+        for variant in set(variants):
+            encoded = variant.encode('utf-8')
+            for algorithm in name_hash_functions:
+                name_hash = name_hash_functions[algorithm](encoded)
+                if not name_hash in index['names'][algorithm]:
+                    index['names'][algorithm][name_hash] = name
+                    index['modified'] = True
+    return
+
+def has_names (index):
+    return(index is not None and any([len(x) > 0 for x in index['names'].values()]))
+
+def settle_name_algorithm (index):
+    # Sets and returns the hash function that the matches so far agree on, or None
+    counts = sorted([(len(index['matches'][x]), x) for x in index['matches']], reverse = True)
+    if counts[0][0] >= settle_matches and counts[0][0] > 2 * counts[1][0]:
+        index['algorithm'] = counts[0][1]
+    else:
+        index['algorithm'] = None
+    return(index['algorithm'])
+
+def resolve_name (index, name_hash):
+    # Returns the string with this hash, or None.  Until a hash function is settled on, the hash only
+    # counts as a match for each function it is found under, and None is returned.
+    if index is None or not name_hash:
+        return(None)
+    if index['algorithm'] is None:
+        for algorithm in index['names']:
+            if name_hash in index['names'][algorithm] and not name_hash in index['matches'][algorithm]:
+                index['matches'][algorithm].add(name_hash)
+                index['modified'] = True
+        if settle_name_algorithm(index) is None:
+            return(None)
+    return(index['names'][index['algorithm']].get(name_hash))
+
+def resolve_string (index, name):
+    # The string of the index with the same hash as name (e.g. the full path for a file name), or None
+    if index is None or index['algorithm'] is None:
+        return(None)
+    return(resolve_name(index, name_hash_functions[index['algorithm']](name.encode('utf-8'))))
+
+def output_name (resolved_name):
+    # Resolved strings can be paths; only the file name is used for outputs
+    return(resolved_name.replace('\\', '/').split('/')[-1])
+
+def read_string_archive (f, archive_size):
+    # Returns the strings of a string archive (flag 0x10) whose header f is at.  The layout is assumed
+    # to be that of the other archives, with entries (offset and size from the start of the archive)
+    # that hold null-terminated strings.  If the table does not fit the archive, every null-terminated
+    # string after the header is read instead.
+    base_offset = f.tell()
+    num_entries, flags, unk, unk2 = struct.unpack("<4I", f.read(16))
+    table = f.read(8 * num_entries) if 16 + 8 * num_entries <= archive_size else b''
+    if len(table) == 8 * num_entries:
+        entries = [struct.unpack("<2I", table[i*8:i*8+8]) for i in range(num_entries)]
+    else:
+        entries = []
+    if len(entries) > 0 and all([x[0] >= 16 + 8 * num_entries and x[0] + x[1] <= archive_size for x in entries]):
+        blobs = []
+        for offset, size in entries:
+            f.seek(base_offset + offset)
+            blobs.append(f.read(size))
+    else:
+        f.seek(base_offset + 16)
+        blobs = [f.read(archive_size - 16)]
+    strings = []
+    for blob in blobs:
+        for raw_string in blob.split(b'\x00'):
+            try:
+                string = raw_string.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            if len(string) > 0 and string.isprintable():
+                strings.append(string)
+    return(strings)
@@ -0,0 +1,140 @@
+# A small library to time the individual stages of the vato tools and to collect
+# byte and object counts per file.  Results are written to a JSON report, which is
+# accumulated if the report already exists so that a batch can be summed over several runs.
+# With start_memory_tracking(), the peak memory allocated (by Python and numpy, as traced by
+# tracemalloc) is also recorded for each stage and for each file.
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import json, os, time, tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Stages used by the tools, in the order they are listed in the report
+profile_stages = ['section_parse', 'string_lookup', 'vertex_decode', 'index_decode', 'lod_decimation', 'batching', 'keyframe_decode',\
+    'palette_bake', 'buffer_packing', 'json_encoding', 'decompression', 'compression', 'pixel_decode', 'png_encoding', 'texture_encoding', 'pixel_encode', 'file_write']
+
+def new_profile (filename, tool):
+    profile = {'file': filename, 'tool': tool, 'stages': {}, 'bytes': {}, 'counts': {},\
+        '_stack': [], '_start': time.perf_counter()}
+    if tracemalloc.is_tracing():
+        # Memory is counted from what is already allocated when the file is started
+        tracemalloc.reset_peak()
+        profile['memory'] = {'peak': 0, 'stages': {}}
+        profile['_memory_base'] = tracemalloc.get_traced_memory()[0]
+    return(profile)
+
+def start_memory_tracking ():
+    # Tracing slows down allocations, so it is only turned on when memory is to be reported
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return
+
+def memory_in_use ():
+    # Bytes currently allocated, or 0 if memory is not being tracked
+    return(tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0)
+
+def _memory_checkpoint (profile, stage = None):
+    # Adds the peak since the last checkpoint to stage (if any) and to the peak of the file
+    if 'memory' in profile and tracemalloc.is_tracing():
+        peak = max(tracemalloc.get_traced_memory()[1] - profile['_memory_base'], 0)
+        if stage is not None:
+            profile['memory']['stages'][stage] = max(profile['memory']['stages'].get(stage, 0), peak)
+        profile['memory']['peak'] = max(profile['memory']['peak'], peak)
+        tracemalloc.reset_peak()
+    return
+
+@contextmanager
+def _timed_stage (profile, stage):
+    # Stage times are exclusive, e.g. string lookups are not counted again in section_parse.
+    stack = profile['_stack']
+    _memory_checkpoint(profile, stack[-1][0] if len(stack) > 0 else None)
+    start = time.perf_counter()
+    if len(stack) > 0:
+        profile['stages'][stack[-1][0]] = profile['stages'].get(stack[-1][0], 0.0) + start - stack[-1][1]
+    stack.append([stage, start])
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _memory_checkpoint(profile, stage)
+        resume = stack.pop()[1]
+        profile['stages'][stage] = profile['stages'].get(stage, 0.0) + end - resume
+        if len(stack) > 0:
+            stack[-1][1] = end
+
+def profile_stage (profile, stage):
+    if profile is None:
+        return(nullcontext())
+    return(_timed_stage(profile, stage))
+
+def add_bytes (profile, key, num_bytes):
+    if profile is not None:
+        profile['bytes'][key] = profile['bytes'].get(key, 0) + num_bytes
+    return
+
+def add_count (profile, key, count = 1):
+    if profile is not None:
+        profile['counts'][key] = profile['counts'].get(key, 0) + count
+    return
+
+def merge_profile (profile, other):
+    # Adds the stage times, bytes and counts of other (e.g. from a worker process) to profile.
+    # Stage times from parallel workers are summed, so they can add up to more than the wall time.
+    if profile is not None and other is not None:
+        for key in ['stages', 'bytes', 'counts']:
+            for name in other[key]:
+                profile[key][name] = profile[key].get(name, 0) + other[key][name]
+    return
+
+def finish_profile (profile):
+    # Records the wall time and strips internal bookkeeping so the profile can be JSON encoded
+    if profile is not None and '_start' in profile:
+        profile['wall_time'] = time.perf_counter() - profile['_start']
+        _memory_checkpoint(profile)
+        del(profile['_start'])
+        del(profile['_stack'])
+        if '_memory_base' in profile:
+            del(profile['_memory_base'])
+    return(profile)
+
+def sum_profiles (profiles, totals = None):
+    if totals is None:
+        totals = {'files': 0, 'wall_time': 0.0, 'stages': {}, 'bytes': {}, 'counts': {}}
+    for profile in profiles:
+        totals['files'] += 1
+        totals['wall_time'] += profile.get('wall_time', 0.0)
+        for key in ['stages', 'bytes', 'counts']:
+            for name in profile[key]:
+                totals[key][name] = totals[key].get(name, 0) + profile[key][name]
+        if 'memory' in profile:
+            # Memory is not summed: the peak of the batch is the largest peak of any file
+            totals['peak_memory'] = max(totals.get('peak_memory', 0), profile['memory']['peak'])
+    totals['stages'] = {x:totals['stages'][x] for x in\
+        sorted(totals['stages'], key = lambda x: profile_stages.index(x) if x in profile_stages else len(profile_stages))}
+    return(totals)
+
+def print_memory_summary (profiles, memory_budget = None):
+    # The peak memory of each file, and of the batch
+    profiles = [finish_profile(x) for x in profiles if x is not None and 'memory' in x]
+    if len(profiles) > 0:
+        print("Peak memory{}:".format('' if memory_budget is None else ' (budget {:.1f} MiB)'.format(memory_budget / 1048576)))
+        for profile in profiles:
+            print("  {0}: {1:.1f} MiB{2}".format(profile['file'], profile['memory']['peak'] / 1048576,\
+                ', streamed' if profile['counts'].get('streamed', 0) > 0 else ''))
+        print("  Batch: {:.1f} MiB".format(max([x['memory']['peak'] for x in profiles]) / 1048576))
+    return
+
+def write_profile_report (profiles, report_filename):
+    profiles = [finish_profile(x) for x in profiles]
+    report = {'files': [], 'totals': None}
+    if os.path.exists(report_filename):
+        with open(report_filename, 'r') as f:
+            try:
+                report = json.loads(f.read())
+            except json.JSONDecodeError:
+                print("Profile report {} is not valid JSON, starting a new report.".format(report_filename))
+    report['files'].extend(profiles)
+    report['totals'] = sum_profiles(profiles, totals = report['totals'])
+    with open(report_filename, 'wb') as f:
+        f.write(json.dumps(report, indent=4).encode('utf-8'))
+    return(report)
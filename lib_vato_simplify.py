@@ -0,0 +1,138 @@
+# Mesh simplification for levels of detail, by quadric error edge collapse (Garland and Heckbert).
+# Each edge is collapsed onto one of its two vertices, so the simplified meshes only use vertices of
+# the original mesh and can index the same vertex buffer: the UVs, normals and skin weights of the
+# vertices that remain are unchanged.  Vertices on open borders (which includes UV seams, where the
+# mesh is split into several vertices at one position) and vertices shared by several primitives
+# (material borders) are never moved, so the seams and the outline of each material are kept.
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import heapq
+import numpy
+
+def _plane_quadrics (positions, triangles):
+    # Sum of the (area weighted) squared distance to the plane of each triangle around each vertex
+    p0, p1, p2 = positions[triangles[:,0]], positions[triangles[:,1]], positions[triangles[:,2]]
+    normals = numpy.cross(p1 - p0, p2 - p0)
+    area = numpy.linalg.norm(normals, axis = 1)
+    normals = normals / numpy.where(area > 0, area, 1)[:,None]
+    planes = numpy.concatenate([normals, -numpy.sum(normals * p0, axis = 1)[:,None]], axis = 1)
+    triangle_quadrics = planes[:,:,None] * planes[:,None,:] * (area / 2)[:,None,None]
+    quadrics = numpy.zeros((len(positions), 4, 4))
+    for k in range(3):
+        numpy.add.at(quadrics, triangles[:,k], triangle_quadrics)
+    return(quadrics)
+
+def _normal (a, b, c):
+    ab = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+    ac = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+    return((ab[1] * ac[2] - ab[2] * ac[1], ab[2] * ac[0] - ab[0] * ac[2], ab[0] * ac[1] - ab[1] * ac[0]))
+
+def simplify_mesh (positions, index_buffers, targets):
+    # positions is a list or array of (x, y, z), index_buffers a list of triangle lists (one per
+    # primitive, all into the same vertices) and targets a list of decreasing triangle counts.
+    # Returns a list of index buffers (one per primitive, in the same order) for each target.  A
+    # target may not be reached if no more edges can be collapsed without folding the surface over
+    # or changing its topology, in which case the smallest mesh found is returned.
+    positions = numpy.array(positions, dtype = 'float64').reshape(-1, 3)
+    triangles, parts = [], []
+    for i in range(len(index_buffers)):
+        for j in range(0, len(index_buffers[i]) - 2, 3):
+            triangle = list(index_buffers[i][j:j+3])
+            # Degenerate triangles draw nothing and would confuse the topology checks
+            if len(set(triangle)) == 3:
+                triangles.append(triangle)
+                parts.append(i)
+    alive = [True] * len(triangles)
+    live_count = len(triangles)
+    vertex_triangles = [set() for _ in range(len(positions))]
+    edge_use = {}
+    for t in range(len(triangles)):
+        for k in range(3):
+            vertex_triangles[triangles[t][k]].add(t)
+            edge = tuple(sorted((triangles[t][k], triangles[t][(k+1) % 3])))
+            edge_use[edge] = edge_use.get(edge, 0) + 1
+    locked = [False] * len(positions)
+    for edge in edge_use:
+        if edge_use[edge] != 2:
+            locked[edge[0]], locked[edge[1]] = True, True
+    for v in range(len(positions)):
+        if len(set([parts[t] for t in vertex_triangles[v]])) > 1:
+            locked[v] = True
+    _, weld, weld_count = numpy.unique(positions, axis = 0, return_inverse = True, return_counts = True)
+    for v in numpy.nonzero(weld_count[weld.reshape(-1)] > 1)[0]:
+        locked[v] = True
+    quadrics = _plane_quadrics(positions, numpy.array(triangles, dtype = 'int64').reshape(-1, 3))
+    homogeneous = numpy.concatenate([positions, numpy.ones((len(positions), 1))], axis = 1)
+    points = positions.tolist()
+    versions = [0] * len(positions)
+    removed = [False] * len(positions)
+
+    def neighbours (v):
+        return(set([x for t in vertex_triangles[v] for x in triangles[t]]) - {v})
+
+    def collapse_cost (u, v):
+        return(float(homogeneous[v] @ (quadrics[u] + quadrics[v]) @ homogeneous[v]))
+
+    # Heap of (cost, u, v, versions of u and v) for moving u onto v; entries go stale when the
+    # quadric of either vertex changes
+    edges = numpy.array([[u, v] for (a, b) in edge_use for (u, v) in [(a, b), (b, a)] if not locked[u]],\
+        dtype = 'int64').reshape(-1, 2)
+    costs = numpy.einsum('ni,nij,nj->n', homogeneous[edges[:,1]], quadrics[edges[:,0]] + quadrics[edges[:,1]],\
+        homogeneous[edges[:,1]])
+    heap = [(costs[i], int(edges[i,0]), int(edges[i,1]), 0, 0) for i in range(len(edges))]
+    heapq.heapify(heap)
+
+    def can_collapse (u, v):
+        # The vertices shared by the neighbourhoods of u and v must be exactly the corners opposite the
+        # edge, otherwise the collapse would pinch the surface
+        shared = [t for t in vertex_triangles[u] if v in triangles[t]]
+        if len(shared) == 0:
+            return(False)
+        opposite = set([x for t in shared for x in triangles[t]]) - {u, v}
+        if neighbours(u) & neighbours(v) != opposite:
+            return(False)
+        # No remaining triangle may flip over or become degenerate
+        for t in vertex_triangles[u]:
+            if v in triangles[t]:
+                continue
+            corners = [points[x] for x in triangles[t]]
+            before = _normal(*corners)
+            corners[triangles[t].index(u)] = points[v]
+            after = _normal(*corners)
+            if before[0] * after[0] + before[1] * after[1] + before[2] * after[2] <= 0\
+                    or after[0] * after[0] + after[1] * after[1] + after[2] * after[2] == 0:
+                return(False)
+        return(True)
+
+    results = []
+    for target in targets:
+        while live_count > target and len(heap) > 0:
+            cost, u, v, version_u, version_v = heapq.heappop(heap)
+            if removed[u] or removed[v] or version_u != versions[u] or version_v != versions[v]\
+                    or not can_collapse(u, v):
+                continue
+            for t in list(vertex_triangles[u]):
+                if v in triangles[t]:
+                    alive[t] = False
+                    live_count -= 1
+                    for x in triangles[t]:
+                        vertex_triangles[x].discard(t)
+                else:
+                    triangles[t][triangles[t].index(u)] = v
+                    vertex_triangles[v].add(t)
+            vertex_triangles[u] = set()
+            removed[u] = True
+            quadrics[v] += quadrics[u]
+            versions[v] += 1
+            for w in neighbours(v):
+                if not locked[w]:
+                    heapq.heappush(heap, (collapse_cost(w, v), w, v, versions[w], versions[v]))
+                if not locked[v]:
+                    heapq.heappush(heap, (collapse_cost(v, w), v, w, versions[v], versions[w]))
+        level = [[] for _ in range(len(index_buffers))]
+        for t in range(len(triangles)):
+            if alive[t]:
+                level[parts[t]].extend(triangles[t])
+        results.append(level)
+    return(results)
@@ -0,0 +1,257 @@
+# A small library to generate synthetic but format-accurate files in the formats used by
+# Valkyrie Anatomia: The Origin (imdl, imtn, txp and pck).  The contents are random, but the
+# layouts match what the extraction tools read, so the files can be used to measure performance.
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import random, struct
+
+identity_matrix = [1.0,0.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,0.0,1.0]
+
+def align (value, alignment):
+    return(value + (-value % alignment))
+
+def make_string_dictionary (strings):
+    dictionary = bytearray()
+    string_offsets = {}
+    for string in strings:
+        if not string in string_offsets:
+            string_offsets[string] = len(dictionary)
+            dictionary.extend(string.encode() + b'\x00')
+    return(dictionary, string_offsets)
+
+def make_section (magic, count, records):
+    body = struct.pack("<2I", 1, count) + b''.join(records)
+    return(magic + struct.pack("<I", len(body) + 8) + body)
+
+def make_node_tree (num_nodes, rng):
+    # Random tree, returned in preorder as (num_children, postorder_traversal)
+    children = [[] for _ in range(num_nodes)]
+    for i in range(1, num_nodes):
+        children[rng.randrange(max(1, i - 4), i) if i > 1 else 0].append(i)
+    preorder, postorder = [], {}
+    def walk (i):
+        preorder.append(i)
+        for j in children[i]:
+            walk(j)
+        postorder[i] = len(postorder)
+    walk(0)
+    return([(len(children[i]), postorder[i]) for i in preorder])
+
+def make_grid_triangles (num_vertices):
+    # Triangulates the vertices as a grid, as many rows of 16 as will fit
+    width = min(16, num_vertices)
+    height = num_vertices // width
+    triangles = []
+    for y in range(height - 1):
+        for x in range(width - 1):
+            v = y * width + x
+            triangles.extend([v, v + width, v + 1, v + 1, v + width, v + width + 1])
+    if len(triangles) == 0:
+        triangles = [0, min(1, num_vertices - 1), min(2, num_vertices - 1)]
+    return(triangles)
+
+def make_imdl (num_geoms = 4, num_vertices = 1000, num_bones = 16, meshes_per_geom = 2, seed = 0):
+    # Every fourth geom is rigid (no weights), the rest are skinned to up to num_bones bones.
+    rng = random.Random(seed)
+    textures = ['body.tga', 'face.tga']
+    material_names = ['mt_body', 'mt_face']
+    node_names = ['root'] + ['bone{0:03d}'.format(i) for i in range(num_bones)]\
+        + ['geom{0:03d}'.format(i) for i in range(num_geoms)]
+    geom_names = ['geom{0:03d}'.format(i) for i in range(num_geoms)]
+    dictionary, string_offsets = make_string_dictionary(textures + material_names + node_names + geom_names)
+    # Node hierarchy: root, then the bone tree, then one node per geom attached to the root
+    bone_tree = make_node_tree(num_bones + 1, rng)
+    node_records = []
+    for i in range(len(bone_tree)):
+        num_children = bone_tree[i][0] + (num_geoms if i == 0 else 0)
+        matrix = identity_matrix[:12] + [rng.uniform(-1,1), rng.uniform(-1,1), rng.uniform(-1,1), 1.0]
+        node_records.append(struct.pack("<If16f2I", string_offsets[node_names[i]], 1.0, *matrix,\
+            num_children, bone_tree[i][1]))
+    for i in range(num_geoms):
+        node_records.append(struct.pack("<If16f2I", string_offsets[node_names[num_bones + 1 + i]], 1.0,\
+            *identity_matrix, 0, num_bones + 1 + i))
+    # Buffers
+    vertices = bytearray()
+    blend_indices = bytearray()
+    triangles = bytearray()
+    shape_records, mesh_records, geom_records = [], [], []
+    grid_triangles = make_grid_triangles(num_vertices)
+    for i in range(num_geoms):
+        skinned = (num_bones > 0) and (i % 4 != 3)
+        palette_size = min(num_bones, 32) if skinned else 0
+        pos_offset = len(vertices) // 4
+        vertices.extend(struct.pack("<{}f".format(num_vertices * 3), *[rng.uniform(-1,1) for _ in range(num_vertices * 3)]))
+        uv_offset = len(vertices) // 4
+        vertices.extend(struct.pack("<{}f".format(num_vertices * 2), *[rng.random() for _ in range(num_vertices * 2)]))
+        norm_offset = len(vertices) // 4
+        vertices.extend(struct.pack("<{}f".format(num_vertices * 3), *[rng.uniform(-1,1) for _ in range(num_vertices * 3)]))
+        blendweight_offset, blend_indices_offset, bone_palette_offset = 0, 0, 0
+        if skinned:
+            blendweight_offset = len(vertices) // 4
+            weights = []
+            for _ in range(num_vertices):
+                w = [rng.random() for _ in range(4)]
+                weights.extend([x / sum(w) for x in w])
+            vertices.extend(struct.pack("<{}f".format(num_vertices * 4), *weights))
+            for _ in range(palette_size):
+                vertices.extend(struct.pack("<16f", *identity_matrix))
+            blend_indices_offset = len(blend_indices)
+            blend_indices.extend(bytes([rng.randrange(palette_size) for _ in range(num_vertices * 4)]))
+        shape_records.append(struct.pack("<9I", 0, 0, num_vertices, pos_offset, uv_offset, i * num_vertices,\
+            norm_offset, blend_indices_offset, blendweight_offset))
+        # Index buffers, the grid triangles are split evenly between the meshes
+        first_index_buffer = len(mesh_records)
+        num_triangles = len(grid_triangles) // 3
+        for j in range(meshes_per_geom):
+            ib = grid_triangles[(num_triangles * j // meshes_per_geom) * 3:(num_triangles * (j+1) // meshes_per_geom) * 3]
+            mesh_records.append(struct.pack("<2H3I", j % len(material_names), 0, 0, len(ib), len(triangles) // 2))
+            triangles.extend(struct.pack("<{}H".format(len(ib)), *ib))
+        if skinned:
+            bone_palette_offset = len(triangles) // 2
+            palette = rng.sample(range(1, num_bones + 1), palette_size)
+            triangles.extend(struct.pack("<{}H".format(palette_size), *palette))
+        triangles.extend(b'\x00' * (-len(triangles) % 4))
+        geom_records.append(struct.pack("<IHhIHH", string_offsets[geom_names[i]], num_bones + 1 + i, 0, 0, 0, i)\
+            + struct.pack("<16f", *identity_matrix) + struct.pack("<9f", *[0.0]*9) + struct.pack("<4I", 0, 0, 0, 0)\
+            + struct.pack("<2H", meshes_per_geom, first_index_buffer) + struct.pack("<I", palette_size)\
+            + struct.pack("<2I", 0, bone_palette_offset) + struct.pack("<3I", 0, 0, 0))
+    texture_records = [struct.pack("<I", string_offsets[x]) for x in textures]
+    material_records = [struct.pack("<IiI", string_offsets[material_names[i]], 0, 0x02)\
+        + struct.pack("<IfIfIfIfIf", *[0, 1.0]*5) + struct.pack("<f2H", 1.0, 0, 0) + struct.pack("<4I", 0, 0, i, 0)\
+        for i in range(len(material_names))]
+    sections = make_section(b'tex ', len(texture_records), texture_records)\
+        + make_section(b'mate', len(material_records), material_records)\
+        + make_section(b'mesh', len(mesh_records), mesh_records)\
+        + make_section(b'shap', len(shape_records), shape_records)\
+        + make_section(b'geom', len(geom_records), geom_records)\
+        + make_section(b'node', len(node_records), node_records)
+    block_offsets = [32 + len(sections)]
+    dictionary.extend(b'\x00' * (-len(dictionary) % 16))
+    blend_indices.extend(b'\x00' * (-len(blend_indices) % 16))
+    triangles.extend(b'\x00' * (-len(triangles) % 16))
+    unknown_blanks = b'\x00' * 16
+    for block in [dictionary, blend_indices, triangles, unknown_blanks]:
+        block_offsets.append(block_offsets[-1] + len(block))
+    return(b'IMDL' + struct.pack("<4H", 1, 0, 0, 6) + struct.pack("<5I", *block_offsets) + sections\
+        + dictionary + blend_indices + triangles + unknown_blanks + vertices)
+
+def make_imtn (node_names, num_channels = 32, num_keys = 60, num_visK = 0, num_smpK = 0, seed = 0):
+    # Channels alternate between translation and rotation, and are assigned to the nodes in order.
+    rng = random.Random(seed)
+    channel_nodes = [node_names[i % len(node_names)] for i in range(num_channels)]
+    dictionary, string_offsets = make_string_dictionary(channel_nodes + ['vis', 'smp'])
+    times = bytearray()
+    trs_vals = bytearray()
+    block1 = bytearray()
+    nodK_records = []
+    for i in range(num_channels):
+        channel = [2, 14][i % 2]
+        num_vals = {2:3, 14:4}[channel]
+        nodK_records.append(struct.pack("<5I", string_offsets[channel_nodes[i]], num_keys,\
+            len(times) // 2, channel, len(trs_vals) // 4))
+        times.extend(struct.pack("<{}H".format(num_keys), *range(num_keys)))
+        values = []
+        for _ in range(num_keys):
+            if channel == 2:
+                values.extend([rng.uniform(-1,1) for _ in range(3)])
+            else:
+                q = [rng.uniform(-1,1) for _ in range(4)]
+                values.extend([x / sum([y*y for y in q])**0.5 for x in q])
+        trs_vals.extend(struct.pack("<{}f".format(num_keys * num_vals), *values))
+    visK_records = []
+    for i in range(num_visK):
+        visK_records.append(struct.pack("<4I", string_offsets['vis'], num_keys, len(block1), 0))
+        block1.extend(bytes([rng.randrange(2) for _ in range(num_keys)]))
+    smpK_records = [struct.pack("<4I", string_offsets['smp'], 0, 0, 0) for _ in range(num_smpK)]
+    sections = make_section(b'nodK', len(nodK_records), nodK_records)
+    if num_visK > 0:
+        sections += make_section(b'visK', len(visK_records), visK_records)
+    if num_smpK > 0:
+        sections += make_section(b'smpK', len(smpK_records), smpK_records)
+    for block in [dictionary, block1, times]:
+        block.extend(b'\x00' * (-len(block) % 16))
+    # Block 3 is empty, so it has the same offset as the TRS values
+    block_offsets = [32 + len(sections)]
+    for block in [dictionary, block1, times, b'']:
+        block_offsets.append(block_offsets[-1] + len(block))
+    return(b'IMTN' + struct.pack("<4H", 1, 0, 0, 1 + (num_visK > 0) + (num_smpK > 0)) + struct.pack("<5I", *block_offsets)\
+        + sections + dictionary + block1 + times + trs_vals)
+
+def make_texture_data (tex_format, width, height, seed = 0):
+    # Random tile repeated across the texture, so the data is compressible like real textures
+    rng = random.Random(seed)
+    bytes_per_pixel = {4:2, 5:2, 6:3, 7:4}[tex_format]
+    tile = rng.randbytes(16 * bytes_per_pixel)
+    row = (tile * (width // 16 + 1))[:width * bytes_per_pixel]
+    rows = [row if (y % 8) else rng.randbytes(width * bytes_per_pixel) for y in range(height)]
+    return(b''.join(rows))
+
+def make_txp (textures, version = 1, seed = 0):
+    # textures is a list of (name, tex_format, width, height), e.g. ('00_body.tga', 7, 256, 256)
+    num_files = len(textures)
+    names = bytearray()
+    name_offsets = []
+    header_size = 0x20 * (num_files + 1)
+    for texture in textures:
+        name_offsets.append(header_size + len(names))
+        names.extend(texture[0].encode() + b'\x00')
+    hash_offset = align(header_size + len(names), 4)
+    data_offset = align(hash_offset + 4 * num_files, 16)
+    output = bytearray(b'GLTP' + struct.pack("<3I", version, num_files, hash_offset) + b'\x00' * 16)
+    pixel_data = bytearray()
+    for i in range(num_files):
+        name, tex_format, width, height = textures[i]
+        data = make_texture_data(tex_format, width, height, seed = seed + i)
+        output.extend(struct.pack("<4I2H3I", name_offsets[i], len(data), data_offset + len(pixel_data), tex_format,\
+            width, height, 1, 0, 0))
+        pixel_data.extend(data)
+        pixel_data.extend(b'\x00' * (-len(pixel_data) % 16))
+    output.extend(names)
+    output.extend(b'\x00' * (hash_offset - len(output)))
+    output.extend(struct.pack("<{}I".format(num_files), *[random.Random(seed + i).getrandbits(32) for i in range(num_files)]))
+    output.extend(b'\x00' * (data_offset - len(output)))
+    output.extend(pixel_data)
+    return(bytes(output))
+
+def compress_taiko_v_simple (data, flags = 0):
+    # Minimal taiko_v encoder for synthetic data: each 128-byte block is either a repeat of the data
+    # 32 bytes back (sent as long back-references) or sent as literals.
+    output = bytearray(struct.pack("<I", (len(data) << 8) | flags))
+    pos = 0
+    while pos < len(data):
+        block = data[pos:pos+128]
+        if pos >= 32 and data[pos-32:pos-32+len(block)] == block and len(block) >= 4:
+            length = len(block)
+            while length > 0:
+                run = min(length, 131)
+                if run < 4: # Too short for a long back-reference, send as literals instead
+                    output.append(run)
+                    output.extend(data[pos:pos+run])
+                else:
+                    output.extend([0xBE + run // 2, 0x80 * (run % 2), 31])
+                pos += run
+                length -= run
+        else:
+            for i in range(0, len(block), 63): # Short literal runs are at most 0x3F bytes
+                output.append(len(block[i:i+63]))
+                output.extend(block[i:i+63])
+            pos += len(block)
+    output.extend(b'\x00\x00\x00\x00')
+    return(bytes(output))
+
+def make_pck (entries, flags = 0, names = None, alignment = 0x10):
+    # entries is a list of bytes objects (which may themselves be pck archives)
+    table_entry_size = 8 + (0x80 if flags == 0x80 else 0)
+    data_offset = align(16 + table_entry_size * len(entries), alignment)
+    table = bytearray()
+    data = bytearray()
+    for i in range(len(entries)):
+        table.extend(struct.pack("<2I", data_offset + len(data), len(entries[i])))
+        if flags == 0x80:
+            name = (names[i] if names is not None else '').encode()
+            table.extend(name + b'\x00' * (0x80 - len(name)))
+        data.extend(entries[i])
+        data.extend(b'\x00' * (-len(data) % alignment))
+    header = struct.pack("<4I", len(entries), flags, 0, 0)
+    return(header + table + b'\x00' * (data_offset - 16 - len(table)) + bytes(data))
@@ -0,0 +1,77 @@
+# Round trip tests of compress_taiko_v() (vato_compress_txp.py) against the decompressor of
+# vato_extract_txp.py, at every compression level.
+#
+# Run from the repository folder with:
+# /path/to/python3 -m pytest tests
+#
+# GitHub eArmada8/vato_mdl_tool
+
+import io, os, random, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vato_compress_txp import compress_taiko_v, compression_levels
+from vato_extract_txp import decompress_taiko_v
+
+levels = sorted(compression_levels)
+
+def round_trip (data, level):
+    compressed = compress_taiko_v(data, level)
+    assert bytes(decompress_taiko_v(io.BytesIO(compressed))) == data
+    return(compressed)
+
+def random_bytes (size, seed = 0):
+    return(random.Random(seed).randbytes(size))
+
+def repeat_at (length, distance, seed = 0):
+    # Random data with one copy of length bytes from distance bytes back, and nothing else to match
+    data = random_bytes(distance + length + 64, seed)
+    return(data[:distance] + data[:length] + data[distance + length:])
+
+@pytest.mark.parametrize('level', levels)
+@pytest.mark.parametrize('data', [b'', b'a', b'ab', b'abc', b'abcd', b'aaaa', b'\x00\x00\x00\x00'])
+def test_tiny_inputs (data, level):
+    round_trip(data, level)
+
+@pytest.mark.parametrize('level', levels)
+def test_incompressible (level):
+    data = random_bytes(100000, level)
+    compressed = round_trip(data, level)
+    # Mostly literal runs, split now and then by a chance 4 byte match
+    assert len(compressed) <= len(data) + len(data) // 1000 + 8
+
+@pytest.mark.parametrize('level', levels)
+def test_zero_runs (level):
+    compressed = round_trip(b'\x00' * 1000000, level)
+    if level > 0:
+        assert len(compressed) < 30000
+    round_trip(b'\x00' * 40000 + random_bytes(1000) + b'\x00' * 70000, level)
+
+@pytest.mark.parametrize('level', levels)
+@pytest.mark.parametrize('alphabet', [2, 4, 16])
+def test_low_entropy (alphabet, level):
+    rng = random.Random(alphabet * 10 + level)
+    round_trip(bytes([rng.randrange(alphabet) for _ in range(8000)]), level)
+
+@pytest.mark.parametrize('level', levels)
+@pytest.mark.parametrize('length', [2, 3, 4, 5, 6, 17, 18, 19, 130, 131, 132, 300])
+@pytest.mark.parametrize('distance', [1, 2, 15, 16, 17, 1023, 1024, 1025, 32767, 32768, 32769])
+def test_copy_limits (distance, length, level):
+    # The 1 byte copies reach 16 bytes back (2-5 bytes), the 2 byte copies 1024 (3-18 bytes) and the
+    # 3 byte copies 32768 (4-131 bytes)
+    round_trip(repeat_at(length, distance, distance + length), level)
+
+@pytest.mark.parametrize('level', levels)
+def test_overlapping_copies (level):
+    # Copies from closer back than their length repeat the bytes just written
+    for period in [1, 2, 3, 5, 16, 17]:
+        round_trip(random_bytes(period, period) * (40000 // period) + b'end', level)
+
+@pytest.mark.parametrize('level', levels)
+def test_txp (level):
+    from lib_vato_synth import make_txp
+    round_trip(make_txp([('00_body.tga', 7, 64, 64), ('01_face.tga', 4, 32, 32), ('02_x.tga', 6, 16, 8)]), level)
+
+def test_too_large ():
+    with pytest.raises(ValueError):
+        compress_taiko_v(bytes(0x1000000), 0)
@@ -0,0 +1,143 @@
+# Benchmark suite for the vato tools.  Generates synthetic imdl, imtn, txp and pck files at a
+# configurable scale, times every extractor entry point, and compares the results to a stored
+# baseline to flag regressions.
+#
+# Usage:  Run by itself without commandline arguments and it will run the benchmarks at the
+# default scale and print the results.
+#
+# For command line options, run:
+# /path/to/python3 vato_benchmark.py --help
+#
+# Requires lib_vato_synth.py and the tools themselves, put in the same directory
+#
+# GitHub eArmada8/vato_mdl_tool
+
+try:
+    import io, json, os, shutil, statistics, sys, tempfile, time
+    from contextlib import redirect_stdout
+    from lib_vato_synth import *
+    import vato_extract_imdl, vato_extract_imtn, vato_extract_txp, vato_unpack_pck
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+scales = {'small': {'geoms': 4, 'vertices': 500, 'bones': 16, 'channels': 16, 'keys': 30, 'texture_size': 64},
+    'medium': {'geoms': 12, 'vertices': 4000, 'bones': 64, 'channels': 96, 'keys': 120, 'texture_size': 256},
+    'large': {'geoms': 32, 'vertices': 16000, 'bones': 128, 'channels': 256, 'keys': 480, 'texture_size': 1024}}
+
+def generate_benchmark_files (folder, scale, seed = 0):
+    files = {}
+    def write (filename, data):
+        with open(os.path.join(folder, filename), 'wb') as f:
+            f.write(data)
+        files[filename] = len(data)
+        return(data)
+    imdl_data = write('bench.mdl', make_imdl(num_geoms = scale['geoms'], num_vertices = scale['vertices'],\
+        num_bones = scale['bones'], seed = seed))
+    node_names = ['root'] + ['bone{0:03d}'.format(i) for i in range(scale['bones'])]
+    imtn_data = write('bench.mtn', make_imtn(node_names, num_channels = scale['channels'], num_keys = scale['keys'],\
+        num_visK = 1, seed = seed))
+    txp_data = []
+    size = scale['texture_size']
+    for tex_format in [4, 5, 6, 7]:
+        txp_data.append(write('bench_fmt{}.txp'.format(tex_format),\
+            make_txp([('{0:02d}_fmt{1}.tga'.format(tex_format, tex_format), tex_format, size, size)], seed = seed)))
+        write('bench_fmt{}_compressed.txp'.format(tex_format), compress_taiko_v_simple(txp_data[-1]))
+    inner_pck = make_pck(txp_data, flags = 0x80, names = ['fmt4', 'fmt5', 'fmt6', 'fmt7'])
+    write('bench.pck', make_pck([imdl_data, imtn_data, inner_pck], flags = 0))
+    return(files)
+
+def benchmark_cases (folder):
+    # Each case is run with the working directory set to the benchmark folder
+    def decompress ():
+        with open('bench_fmt7_compressed.txp', 'rb') as f:
+            return(vato_extract_txp.decompress_taiko_v(f))
+    skel_struct = vato_extract_imtn.obtain_skeleton_from_imdl(os.path.join(folder, 'bench.mdl'))
+    cases = {'obtain_skeleton_from_imdl': lambda: vato_extract_imtn.obtain_skeleton_from_imdl('bench.mdl'),
+        'process_imdl': lambda: vato_extract_imdl.process_imdl('bench.mdl', overwrite = True),
+        'process_imdl_gltf': lambda: vato_extract_imdl.process_imdl('bench.mdl', write_binary_gltf = False, overwrite = True),
+        'process_imtn': lambda: vato_extract_imtn.process_imtn('bench.mtn', skel_struct, overwrite = True)}
+    for tex_format in [4, 5, 6, 7]:
+        cases['process_txp_file_fmt{}'.format(tex_format)] =\
+            (lambda x: lambda: vato_extract_txp.process_txp_file('bench_fmt{}.txp'.format(x)))(tex_format)
+        cases['process_txp_file_fmt{}_compressed'.format(tex_format)] =\
+            (lambda x: lambda: vato_extract_txp.process_txp_file('bench_fmt{}_compressed.txp'.format(x)))(tex_format)
+    cases['decompress_taiko_v'] = decompress
+    cases['unpack_pck_file'] = lambda: vato_unpack_pck.unpack_pck_file('bench.pck')
+    return(cases)
+
+def run_benchmarks (scale_name = 'small', repeats = 3, cases_filter = None, seed = 0):
+    scale = scales[scale_name]
+    results = {'scale': scale_name, 'parameters': scale, 'python': sys.version.split()[0], 'cases': {}}
+    folder = tempfile.mkdtemp(prefix = 'vato_benchmark_')
+    current_dir = os.getcwd()
+    try:
+        results['files'] = generate_benchmark_files(folder, scale, seed = seed)
+        os.chdir(folder)
+        cases = benchmark_cases(folder)
+        for case in cases:
+            if cases_filter is not None and not any([x in case for x in cases_filter]):
+                continue
+            timings = []
+            for _ in range(repeats):
+                with redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    cases[case]()
+                    timings.append(time.perf_counter() - start)
+            results['cases'][case] = {'median': statistics.median(timings), 'min': min(timings), 'repeats': repeats}
+            print("{0:<40} median {1:9.4f} s   min {2:9.4f} s".format(case, results['cases'][case]['median'],\
+                results['cases'][case]['min']))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(folder, ignore_errors = True)
+    return(results)
+
+def compare_to_baseline (results, baseline, threshold = 0.10):
+    # Compares the best times, which are the least noisy, and returns the list of regressions
+    regressions = []
+    if not baseline.get('scale') == results['scale']:
+        print("Baseline was recorded at scale {0}, not {1}!  Skipping comparison.".format(baseline.get('scale'), results['scale']))
+        return(regressions)
+    for case in results['cases']:
+        if case in baseline['cases']:
+            old, new = baseline['cases'][case]['min'], results['cases'][case]['min']
+            change = (new - old) / old if old > 0 else 0.0
+            flag = ''
+            if change > threshold:
+                flag = 'REGRESSION'
+                regressions.append(case)
+            elif change < -threshold:
+                flag = 'improved'
+            print("{0:<40} {1:9.4f} s -> {2:9.4f} s  {3:+7.1%} {4}".format(case, old, new, change, flag))
+    return(regressions)
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--scale', help="Size of the synthetic files (default: small)", choices = list(scales.keys()), default = 'small')
+    parser.add_argument('-r', '--repeats', help="Number of times each case is run (default: 3)", type = int, default = 3)
+    parser.add_argument('-k', '--cases', help="Only run cases whose names contain one of these strings", nargs = '+')
+    parser.add_argument('-b', '--baseline', help="Baseline JSON file to compare against (default: vato_benchmark_baseline.json)",\
+        default = 'vato_benchmark_baseline.json')
+    parser.add_argument('--save-baseline', help="Store the results as the new baseline", action="store_true")
+    parser.add_argument('--threshold', help="Slowdown that counts as a regression (default: 0.10 = 10%%)", type = float, default = 0.10)
+    args = parser.parse_args()
+    results = run_benchmarks(args.scale, repeats = args.repeats, cases_filter = args.cases)
+    if args.save_baseline:
+        with open(args.baseline, 'wb') as f:
+            f.write(json.dumps(results, indent=4).encode('utf-8'))
+        print("Baseline saved to {}.".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.loads(f.read())
+        regressions = compare_to_baseline(results, baseline, threshold = args.threshold)
+        if len(regressions) > 0:
+            print("{} regression(s) found!".format(len(regressions)))
+            sys.exit(1)
@@ -0,0 +1,197 @@
+# Tool to compress txp files with taiko_v, the compression used by Valkyrie Anatomia: The Origin,
+# so that edited textures can be put back into the game compressed.
+#
+# Usage:  Run by itself without commandline arguments and it will compress every uncompressed
+# txp file it finds in the folder, replacing it (keep a backup, or use -o).
+#
+# The compressed stream is made of these commands (see decompress_taiko_v() in vato_extract_txp.py):
+#   0x01-0x3F               literal run of 1-63 bytes
+#   0x00 1xxxxxxx           literal run of 64-191 bytes
+#   0x00 0xxxxxxx xxxxxxxx  literal run of 192-32958 bytes (0x00 0x00 0x00 0x00 ends the stream)
+#   01LLDDDD                copy 2-5 bytes from 1-16 bytes back
+#   10LLLLDD DDDDDDDD       copy 3-18 bytes from up to 1024 bytes back
+#   11LLLLLL LDDDDDDD ...   copy 4-131 bytes from up to 32768 bytes back (3 bytes)
+#
+# For command line options, run:
+# /path/to/python3 vato_compress_txp.py --help
+#
+# Requires vato_extract_txp.py (and its requirements), put in the same directory
+#
+# GitHub eArmada8/vato_mdl_tool
+
+try:
+    import struct, os, sys, glob, time
+    import numpy
+    from vato_extract_txp import decompress_taiko_v
+    from lib_vato_profile import *
+    from lib_vato_io import *
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Candidates searched per position and the match length that is good enough to stop searching, at
+# each level (0 only stores literals).  From level 4 on, a match shorter than the good length is put
+# off by a byte if a longer one starts there (lazy matching).
+compression_levels = {0: (0, 0), 1: (1, 131), 2: (2, 131), 3: (4, 131), 4: (8, 32), 5: (16, 64), 6: (32, 131),\
+    7: (64, 131), 8: (256, 131), 9: (4096, 131)}
+default_level = 3
+
+def _previous_occurrences (data):
+    # For every position, the last earlier position starting with the same 4 bytes (-1 if none).
+    # Together these form the hash chains of all the positions, found at once with a stable sort.
+    # Every candidate is then at least a 4 byte match, which any copy command can encode.  Also
+    # returns, for every position, the first position from there on that has a candidate at all, so
+    # the search can jump over the bytes that can only be literals.
+    if len(data) < 4:
+        return([-1] * len(data), [len(data)] * (len(data) + 1))
+    b = numpy.frombuffer(data, dtype = numpy.uint8).astype(numpy.uint32)
+    keys = (b[:-3] << 24) | (b[1:-2] << 16) | (b[2:-1] << 8) | b[3:]
+    order = numpy.argsort(keys, kind = 'stable')
+    previous = numpy.full(len(data), -1, dtype = numpy.int64)
+    same = keys[order[1:]] == keys[order[:-1]]
+    previous[order[1:][same]] = order[:-1][same]
+    # Copies reach back 32768 bytes at most, and the chains only go further back
+    previous[numpy.arange(len(data)) - previous > 32768] = -1
+    candidates = numpy.where(previous >= 0, numpy.arange(len(data)), len(data))
+    following = numpy.append(numpy.minimum.accumulate(candidates[::-1])[::-1], len(data))
+    return(previous.tolist(), following.tolist())
+
+def _match_length (data, a, b, max_length):
+    # Length of the common prefix of data[a:] and data[b:], up to max_length.  Matches in textures
+    # often run to the maximum; otherwise the length is bracketed by doubling, then found by halving.
+    if data[a:a+max_length] == data[b:b+max_length]:
+        return(max_length)
+    low, high = 0, 4
+    while high < max_length and data[a+low:a+high] == data[b+low:b+high]:
+        low, high = high, high * 2 if high * 2 < max_length else max_length
+    while high - low > 1:
+        middle = (low + high) // 2
+        if data[a:a+middle] == data[b:b+middle]:
+            low = middle
+        else:
+            high = middle
+    return(low)
+
+def _copy_limits (distance, position):
+    # Longest copy of each size (1, 2 and 3 bytes) for a distance.  The 1 and 2 byte copies are not
+    # decoded correctly if they are longer than the output written so far (plus one).
+    return(min(position + 1, 5) if distance <= 16 else 0, min(position + 1, 18) if distance <= 1024 else 0,\
+        131 if distance <= 32768 else 0)
+
+def _encode_copy (output, length, distance, position):
+    # Uses the smallest command that can encode the copy
+    short_limit, medium_limit, long_limit = _copy_limits(distance, position)
+    if 2 <= length <= short_limit:
+        output.append(((length + 2) << 4) | (distance - 1))
+    elif 3 <= length <= medium_limit:
+        output.extend([0x80 | ((length - 3) << 2) | ((distance - 1) >> 8), (distance - 1) & 0xFF])
+    else:
+        output.extend([0xBE + length // 2, ((length & 1) << 7) | ((distance - 1) >> 8), (distance - 1) & 0xFF])
+    return
+
+def _encode_literals (output, data, start, end):
+    while start < end:
+        length = min(end - start, 32958)
+        if length <= 63:
+            output.append(length)
+        elif length <= 191:
+            output.extend([0x00, 0x80 | (length - 64)])
+        else:
+            output.extend([0x00, (length - 191) >> 8, (length - 191) & 0xFF])
+        output.extend(data[start:start+length])
+        start += length
+    return
+
+def compress_taiko_v (data, level = default_level, profile = None):
+    # Returns data compressed in the taiko_v format, as read by decompress_taiko_v()
+    if len(data) > 0xFFFFFF:
+        raise ValueError("taiko_v can only store up to 16 MiB, got {} bytes".format(len(data)))
+    data = bytes(data)
+    with profile_stage(profile, 'compression'):
+        output = bytearray(struct.pack("<I", len(data) << 8))
+        max_chain, good_length = compression_levels[level]
+        previous, following = _previous_occurrences(data) if max_chain > 0 else ([], [len(data)])
+        def find_match (i):
+            best_length, best_distance = 0, 0
+            candidate, chain = previous[i], max_chain
+            max_length = min(131, len(data) - i)
+            enough = min(good_length, max_length)
+            while candidate >= 0 and chain > 0 and i - candidate <= 32768:
+                # A candidate can only be longer if it also matches at the best length so far
+                if best_length == 0 or data[candidate + best_length] == data[i + best_length]:
+                    length = _match_length(data, candidate, i, max_length)
+                    if length > best_length:
+                        best_length, best_distance = length, i - candidate
+                        if length >= enough:
+                            break
+                candidate, chain = previous[candidate], chain - 1
+            return(best_length, best_distance)
+        literal_start, i, end = 0, following[0], len(data) - 3
+        while i < end:
+            length, distance = find_match(i)
+            if length < good_length and level >= 4 and i + 1 < end and find_match(i + 1)[0] > length:
+                length = 0
+            if length == 0:
+                i = following[i + 1]
+                continue
+            _encode_literals(output, data, literal_start, i)
+            _encode_copy(output, length, distance, i)
+            i += length
+            literal_start = i
+        _encode_literals(output, data, literal_start, len(data))
+        output.extend(b'\x00\x00\x00\x00')
+    add_bytes(profile, 'compressed', len(output))
+    return(bytes(output))
+
+def compress_txp (txp_file, output_file = None, level = default_level, verify = False, profile = None):
+    with open(txp_file, 'rb') as f:
+        data = f.read()
+    add_bytes(profile, 'read', len(data))
+    if not data[0:4] == b'GLTP':
+        print("{} is not an uncompressed txp, skipping!".format(txp_file))
+        return
+    start_time = time.perf_counter()
+    compressed = compress_taiko_v(data, level, profile)
+    seconds = time.perf_counter() - start_time
+    print("{0}: {1} bytes to {2} ({3:.1f}%) in {4:.2f}s, {5:.2f} MB/s".format(txp_file, len(data), len(compressed),\
+        100 * len(compressed) / max(len(data), 1), seconds, len(data) / 1000000 / max(seconds, 1e-9)))
+    if verify == True:
+        with open_input(txp_file, compressed) as f:
+            if not decompress_taiko_v(f) == data:
+                raise ValueError("Compressed {} does not decompress to the original!".format(txp_file))
+    with profile_stage(profile, 'file_write'):
+        with open(txp_file if output_file is None else output_file, 'wb') as f:
+            f.write(compressed)
+    add_bytes(profile, 'written', len(compressed))
+    return
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    # If argument given, attempt to compress file in argument
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-l', '--level', help="Compression level, 0 (store) to 9 (smallest, slowest) (default: {})".format(default_level),\
+            type = int, default = default_level, choices = range(10))
+        parser.add_argument('-o', '--output', help="Write to this file instead of replacing the original")
+        parser.add_argument('-v', '--verify', help="Decompress the result and check it against the original before writing", action="store_true")
+        parser.add_argument('-p', '--profile', help="Write per-stage timings to a JSON report (added to the report if it exists)")
+        parser.add_argument('txp_filename', help="Name of txp file to compress.")
+        args = parser.parse_args()
+        if os.path.exists(args.txp_filename) and args.txp_filename[-4:].lower() == '.txp':
+            profile = new_profile(args.txp_filename, 'vato_compress_txp') if args.profile else None
+            compress_txp(args.txp_filename, output_file = args.output, level = args.level, verify = args.verify, profile = profile)
+            if profile is not None:
+                write_profile_report([profile], args.profile)
+    else:
+        txp_files = glob.glob('*.txp')
+        for i in range(len(txp_files)):
+            with open(txp_files[i], 'rb') as f:
+                if f.read(4) == b'GLTP':
+                    compress_txp(txp_files[i], verify = True)
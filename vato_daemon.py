@@ -0,0 +1,267 @@
+# Extraction daemon for the vato tools.  It keeps the tools loaded in a pool of worker processes and
+# serves extract requests over HTTP on localhost (or a Unix socket), so that an asset server does
+# not have to start a new Python process for each file.
+#
+# Usage:  Run it, then POST a JSON request to /extract, e.g.
+#   curl -d '{"file": "/path/to/00_base.mdl"}' http://127.0.0.1:8372/extract
+# The type is taken from the extension (mdl, mtn, txp or pck), or from "type".  Optional fields:
+#   "output":          folder to write to (default: the folder of the file)
+#   "embed_textures":  (mdl) embed the textures from the .txp files next to the model
+#   "only":            (mdl) list of parts of the model to export, as vato_extract_imdl.py --only
+#   "lods", "lod_ratio": (mdl) levels of detail, as vato_extract_imdl.py --lods / --lod-ratio
+#   "merge_skins":     (mdl) one skin for the whole model, as vato_extract_imdl.py --merge-skins
+#   "batch":           (mdl) merge the meshes that share a material, as vato_extract_imdl.py --batch
+#   "skeleton":        (mtn) model with the skeleton (default: 00_base.mdl or the first .mdl next to the file)
+#   "format", "native": (txp) texture format, as vato_extract_txp.py --format / --native
+#   "extract":         (pck) send the models, animations and textures to the extractors
+# The reply lists the files written.  GET /metrics returns the queue length, job counts and latencies.
+#
+# Skeletons and decoded textures are cached in each worker, and reloaded when the file changes.
+#
+# For command line options, run:
+# /path/to/python3 vato_daemon.py --help
+#
+# Requires lib_vato_api.py and the vato_extract_*.py / vato_unpack_pck.py scripts, put in the same directory
+#
+# GitHub eArmada8/vato_mdl_tool
+
+try:
+    import json, glob, os, sys, time, threading, collections, socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from concurrent.futures import ProcessPoolExecutor
+    import lib_vato_api
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+default_port = 8372
+
+# Worker processes
+
+_skeleton_cache = {} # model filename: (mtime_ns, size, skeleton)
+_texture_cache = {} # texture cache of vato_extract_imdl.find_txp_textures()
+_texture_stamps = {} # txp filename: (mtime_ns, size) when cached
+
+def _init_worker ():
+    # Loads the tools (and numpy / pillow) once, so that the first request does not pay for it
+    import vato_extract_imdl, vato_extract_imtn, vato_extract_txp, vato_unpack_pck
+    # There is nobody to answer questions
+    vato_extract_imdl.ask_if_texture_does_not_match = False
+    sys.stdin = open(os.devnull)
+
+def _file_stamp (filename):
+    stat = os.stat(filename)
+    return(stat.st_mtime_ns, stat.st_size)
+
+def cached_skeleton (imdl_file):
+    stamp = _file_stamp(imdl_file)
+    if not (imdl_file in _skeleton_cache and _skeleton_cache[imdl_file][0:2] == stamp):
+        _skeleton_cache[imdl_file] = stamp + (lib_vato_api.read_skeleton(imdl_file),)
+    return(_skeleton_cache[imdl_file][2])
+
+def refresh_texture_cache (txp_folder):
+    # Drops the cached textures of any .txp in the folder that changed since they were read
+    for txp_file in glob.glob(os.path.join(glob.escape(txp_folder), '*.txp')):
+        stamp = _file_stamp(txp_file)
+        if txp_file in _texture_cache and not _texture_stamps.get(txp_file) == stamp:
+            del(_texture_cache[txp_file])
+        _texture_stamps[txp_file] = stamp
+    return
+
+def list_pck_files (pck_manifest):
+    files = []
+    for entry in pck_manifest['entries']:
+        if 'pck' in entry:
+            files.extend(list_pck_files(entry['pck']))
+        elif 'file' in entry:
+            files.append(entry['file'])
+    return(files)
+
+def run_job (job):
+    # Runs in a worker process.  Returns the files written, any warnings and the time taken.
+    start_time = time.perf_counter()
+    filename = os.path.abspath(job['file'])
+    file_type = job.get('type', os.path.splitext(filename)[1][1:].lower())
+    output_folder = os.path.abspath(job.get('output', os.path.dirname(filename)))
+    base_name = os.path.join(output_folder, os.path.splitext(os.path.basename(filename))[0])
+    outputs, messages = [], []
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    if file_type == 'mdl':
+        if job.get('embed_textures', False) == True:
+            refresh_texture_cache(os.path.dirname(filename))
+        gltf_data, buffer = lib_vato_api.export_imdl(filename, {'embed_textures': job.get('embed_textures', False),\
+            'only': job.get('only'), 'lods': job.get('lods', 0), 'lod_ratio': job.get('lod_ratio', 0.5),\
+            'merge_skins': job.get('merge_skins', False), 'batch': job.get('batch', False), 'texture_cache': _texture_cache, 'log': messages.append})
+        outputs.append(base_name + '.glb')
+    elif file_type == 'mtn':
+        if 'skeleton' in job:
+            imdl_file = os.path.abspath(job['skeleton'])
+        elif os.path.exists(os.path.join(os.path.dirname(filename), '00_base.mdl')):
+            imdl_file = os.path.join(os.path.dirname(filename), '00_base.mdl')
+        else:
+            imdl_files = sorted(glob.glob(os.path.join(glob.escape(os.path.dirname(filename)), '*.mdl')))
+            if len(imdl_files) == 0:
+                raise ValueError("No .mdl found to use as a skeleton for {}".format(filename))
+            imdl_file = imdl_files[0]
+        gltf_data, buffer = lib_vato_api.export_imtn(filename, cached_skeleton(imdl_file))
+        outputs.append(base_name + '.glb')
+    elif file_type == 'txp':
+        textures = lib_vato_api.export_txp(filename, {'texture_format': job.get('format', 'png'),\
+            'native': job.get('native', False), 'log': messages.append})
+        for name in textures:
+            for extension, data in textures[name]:
+                outputs.append(os.path.join(output_folder, '{0}.{1}'.format(name, extension)))
+                with open(outputs[-1], 'wb') as f:
+                    f.write(data)
+    elif file_type == 'pck':
+        import vato_unpack_pck
+        if job.get('extract', False) == True:
+            # The extractors write to the current directory; each worker runs one job at a time
+            start_ns = time.time_ns()
+            extract = vato_unpack_pck.new_extract_state(overwrite = True)
+            current_dir = os.getcwd()
+            os.chdir(output_folder)
+            try:
+                with open(filename, 'rb') as f:
+                    vato_unpack_pck.unpack_pck(f, base_name + '.pck', extract = extract)
+                vato_unpack_pck.finish_extraction(extract)
+            finally:
+                os.chdir(current_dir)
+            outputs.extend(sorted([x.path for x in os.scandir(output_folder) if x.is_file() and x.stat().st_mtime_ns >= start_ns]))
+        else:
+            with open(filename, 'rb') as f:
+                outputs.extend(list_pck_files(vato_unpack_pck.unpack_pck(f, base_name + '.pck')))
+    else:
+        raise ValueError("Unknown file type {}".format(file_type))
+    if file_type in ['mdl', 'mtn']:
+        with open(outputs[-1], 'wb') as f:
+            f.write(lib_vato_api.make_glb(gltf_data, buffer))
+    return({'outputs': outputs, 'messages': messages, 'seconds': time.perf_counter() - start_time})
+
+# Server
+
+def new_metrics (history = 1000):
+    # Latency is from the request arriving to the reply, work time is the time spent in the worker
+    return({'lock': threading.Lock(), 'started': time.time(), 'pending': 0, 'completed': 0, 'failed': 0,\
+        'types': {}, 'history': history})
+
+def record_job (metrics, file_type, latency, work_seconds, failed = False):
+    with metrics['lock']:
+        metrics['pending'] -= 1
+        metrics['failed' if failed else 'completed'] += 1
+        if not file_type in metrics['types']:
+            metrics['types'][file_type] = {'count': 0, 'failed': 0, 'latency': collections.deque(maxlen = metrics['history']),\
+                'work_seconds': collections.deque(maxlen = metrics['history'])}
+        stats = metrics['types'][file_type]
+        stats['count'] += 1
+        if failed:
+            stats['failed'] += 1
+        else:
+            stats['latency'].append(latency)
+            stats['work_seconds'].append(work_seconds)
+    return
+
+def summarize_times (times):
+    times = sorted(times)
+    if len(times) == 0:
+        return({})
+    return({'mean': sum(times) / len(times), 'p50': times[len(times) // 2], 'p95': times[min(len(times) - 1, len(times) * 95 // 100)],\
+        'max': times[-1]})
+
+def metrics_report (metrics):
+    with metrics['lock']:
+        return({'uptime': time.time() - metrics['started'], 'pending': metrics['pending'],\
+            'completed': metrics['completed'], 'failed': metrics['failed'],\
+            'types': {x: {'count': metrics['types'][x]['count'], 'failed': metrics['types'][x]['failed'],\
+            'latency': summarize_times(metrics['types'][x]['latency']),\
+            'work_seconds': summarize_times(metrics['types'][x]['work_seconds'])} for x in metrics['types']}})
+
+class DaemonRequestHandler (BaseHTTPRequestHandler):
+    def address_string (self):
+        # Unix socket clients have no address
+        return(self.client_address[0] if isinstance(self.client_address, tuple) else 'local')
+
+    def log_message (self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def send_json (self, status, reply):
+        body = json.dumps(reply, indent=4).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET (self):
+        if self.path == '/metrics':
+            self.send_json(200, metrics_report(self.server.metrics))
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST (self):
+        if not self.path == '/extract':
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        start_time = time.perf_counter()
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            file_type = job.get('type', os.path.splitext(job['file'])[1][1:].lower())
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': 'Invalid request: {}'.format(e)})
+            return
+        metrics = self.server.metrics
+        with metrics['lock']:
+            metrics['pending'] += 1
+        try:
+            result = self.server.pool.submit(run_job, job).result()
+        except Exception as e:
+            record_job(metrics, file_type, time.perf_counter() - start_time, 0, failed = True)
+            self.send_json(500, {'error': '{0}: {1}'.format(type(e).__name__, e)})
+            return
+        record_job(metrics, file_type, time.perf_counter() - start_time, result['seconds'])
+        self.send_json(200, result)
+
+class ThreadingUnixHTTPServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def run_daemon (port = default_port, socket_path = None, workers = None, quiet = False):
+    pool = ProcessPoolExecutor(max_workers = workers, initializer = _init_worker)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, DaemonRequestHandler)
+        print("Listening on {}".format(socket_path))
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), DaemonRequestHandler)
+        print("Listening on http://127.0.0.1:{}/".format(server.server_address[1]))
+    server.pool, server.metrics, server.quiet = pool, new_metrics(), quiet
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', help="Port to listen on, on 127.0.0.1 (default: {})".format(default_port),\
+        type = int, default = default_port)
+    parser.add_argument('-s', '--socket', help="Listen on this Unix socket instead of a port")
+    parser.add_argument('-w', '--workers', help="Number of worker processes (default: the number of cores)", type = int)
+    parser.add_argument('-q', '--quiet', help="Do not log each request", action="store_true")
+    args = parser.parse_args()
+    run_daemon(port = args.port, socket_path = args.socket, workers = args.workers, quiet = args.quiet)
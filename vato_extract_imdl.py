@@ -11,9 +11,15 @@
 # GitHub eArmada8/vato_mdl_tool
 
 try:
-    import io, struct, copy, json, glob, os, sys
+    import io, re, struct, copy, json, glob, os, sys, time, tempfile
+    import numpy
     from itertools import chain
-    from lib_fmtibvb import *
+    from lib_fmtibvb import get_stride_from_dxgi_format, pack_vb_column, write_fmt, write_ib, write_ib_stream, write_vb, write_vb_stream
+    from lib_vato_profile import *
+    from lib_vato_io import *
+    from lib_vato_container import imdl_block_names, read_container, seek_section, read_from_string_dictionary
+    from lib_vato_simplify import simplify_mesh
+    from lib_vato_names import default_names_file, load_name_index, resolve_string, output_name
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
@@ -55,15 +61,6 @@ def make_fmt(uv = True, normals = True, weights = True):
     fmt['stride'] = str(stride)
     return(fmt)
 
-def read_from_string_dictionary (f, start_offset):
-    current_loc = f.tell()
-    f.seek(start_offset)
-    null_term_string = f.read(1)
-    while null_term_string[-1] != 0:
-        null_term_string += f.read(1)
-    f.seek(current_loc)
-    return(null_term_string[:-1].decode())
-
 def convert_format_for_gltf(dxgi_format):
     dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
     dxgi_format_split = dxgi_format.split('_')
@@ -127,8 +124,569 @@ def fix_strides(submesh):
         offset += submesh['vb'][i]['stride']
     return(submesh)
 
-def process_imdl (imdl_file, write_raw_buffers = False, write_binary_gltf = True, overwrite = False):
-    global ask_if_texture_does_not_match
+def find_txp_textures (txp_folder, image_names, texture_cache = None, profile = None, log = None):
+    # Searches the .txp files in txp_folder for the named textures, and returns them as PNG data.
+    # Each .txp is opened at most once per cache, and only the textures that are asked for are decoded.
+    import vato_extract_txp
+    if texture_cache is None:
+        texture_cache = {}
+    found = {}
+    for txp_file in sorted(glob.glob(os.path.join(glob.escape(txp_folder), '*.txp'))):
+        if not txp_file in texture_cache:
+            texture_cache[txp_file] = {'names': None, 'png': {}}
+        cached = texture_cache[txp_file]
+        wanted = [x for x in image_names if not x in found and (cached['names'] is None or x in cached['names'])]
+        missing = [x for x in wanted if not x in cached['png']]
+        if len(missing) > 0:
+            cached['names'], textures = vato_extract_txp.read_txp_textures(txp_file, names = missing, profile = profile, log = log)
+            for name in textures:
+                cached['png'][name] = vato_extract_txp.encode_png(textures[name], profile)
+        for name in wanted:
+            if name in cached['png']:
+                found[name] = cached['png'][name]
+    return(found)
+
+def lod_screen_coverage (lod_levels, lod_ratio = 0.5):
+    # MSFT_screencoverage of a node with lod_levels levels of detail: the full mesh is shown above
+    # half of the screen, each level below that down to lod_ratio of the previous threshold, and the
+    # last level is never culled
+    return([0.5 * lod_ratio ** k for k in range(lod_levels)] + [0.0])
+
+def process_geom (f, i, geom, shape, meshes, block_offsets, node_list, raw_buffer_folder = None, lod_levels = 0,\
+        lod_ratio = 0.5, skin_joints = None, profile = None, low_memory = False):
+    # Decodes geom i (with its shape and its slice of the meshes) into a glTF mesh, with its own
+    # accessors, bufferViews and buffer numbered from zero.  Geoms do not depend on each other, so
+    # they can be decoded in any order, or in parallel; merge_geom() adds them to the glTF in order.
+    # With lod_levels, that many simplified meshes are also made, each keeping lod_ratio of the
+    # triangles of the one before; they index the same vertices as the full mesh.  With skin_joints (the
+    # joints of a model-wide skin, see read_model_skin()), the blend indices are remapped to it and the
+    # weights renormalized.  With low_memory, the buffers are kept as numpy arrays instead of a Python
+    # list for every vertex, which takes a fraction of the memory; the output is the same.
+    geom_gltf = {'accessors': [], 'bufferViews': [], 'skin': None, 'lods': [], 'lod_triangles': [], 'lod_seconds': 0.0}
+    geom_buffer = bytes()
+    uv = (not shape['uv_offset'] == 0)
+    normals = (not shape['norm_offset'] == 0)
+    weights = (not shape['blendweight_offset'] == 0)
+    fmt = make_fmt(uv, normals, weights)
+    gltf_fmt = convert_fmt_for_gltf(fmt)
+    # Vertex Buffer
+    primitives = []
+    vb = []
+    with profile_stage(profile, 'vertex_decode'):
+        # Cheating here, seeking only once since the sample files have no padding between buffers
+        f.seek(block_offsets["vertices"] + (shape['pos_offset'] * 4))
+        if low_memory == True:
+            read_column = lambda dtype, width: numpy.frombuffer(f.read(shape['num_vertices'] * width * numpy.dtype(dtype).itemsize),\
+                dtype = dtype).reshape(-1, width)
+            vb.append({'Buffer': read_column('<f4', 3)})
+            if uv == True:
+                vb.append({'Buffer': read_column('<f4', 2)})
+            if normals == True:
+                vb.append({'Buffer': read_column('<f4', 3)})
+            if weights == True:
+                wt_buffer = read_column('<f4', 4)
+                bind_matrix_buffer = f.read(64 * geom['num_bones'])
+                f.seek(block_offsets["blend_indices"] + (shape['blend_indices_offset'] * 1))
+                wt_index_buffer = read_column('u1', 4)
+                vb.extend([{'Buffer': wt_index_buffer}, {'Buffer': wt_buffer}])
+        else:
+            pos_buffer = list(struct.unpack("<{}f".format(shape['num_vertices']*3),
+                f.read(shape['num_vertices'] * 4 * 3)))
+            vb.append({'Buffer': [pos_buffer[j*3:j*3+3] for j in range(len(pos_buffer)//3)]})
+            if uv == True:
+                uv_buffer = list(struct.unpack("<{}f".format(shape['num_vertices']*2),
+                    f.read(shape['num_vertices'] * 4 * 2)))
+                vb.append({'Buffer': [uv_buffer[j*2:j*2+2] for j in range(len(uv_buffer)//2)]})
+            if normals == True:
+                norm_buffer = list(struct.unpack("<{}f".format(shape['num_vertices']*3),
+                    f.read(shape['num_vertices'] * 4 * 3)))
+                vb.append({'Buffer': [norm_buffer[j*3:j*3+3] for j in range(len(norm_buffer)//3)]})
+            if weights == True:
+                wt_buffer = list(struct.unpack("<{}f".format(shape['num_vertices']*4),
+                    f.read(shape['num_vertices'] * 4 * 4)))
+                bind_matrix_buffer = f.read(64 * geom['num_bones'])
+                f.seek(block_offsets["blend_indices"] + (shape['blend_indices_offset'] * 1))
+                wt_index_buffer = list(struct.unpack("<{}B".format(shape['num_vertices']*4),
+                    f.read(shape['num_vertices'] * 4)))
+                vb.append({'Buffer': [wt_index_buffer[j*4:j*4+4] for j in range(len(wt_index_buffer)//4)]})
+                vb.append({'Buffer': [wt_buffer[j*4:j*4+4] for j in range(len(wt_buffer)//4)]})
+        if weights == True:
+            f.seek(block_offsets["triangles"] + (geom['bone_palette_offset'] * 2))
+            bone_palette = list(struct.unpack("<{}H".format(geom['num_bones']), f.read(geom['num_bones'] * 2)))
+    add_count(profile, 'vertices', shape['num_vertices'])
+    # The raw buffers keep the blend indices of the geom (for vato_import_imdl.py), the glTF gets the
+    # model-wide ones if there is a single skin
+    gltf_vb = vb
+    if weights == True and skin_joints is not None:
+        joint_lookup = {skin_joints[j]: j for j in range(len(skin_joints))}
+        joint_lookup = numpy.array([joint_lookup[x] for x in bone_palette], dtype = 'int64')
+        wt_array = numpy.array(wt_buffer, dtype = 'float64').reshape(-1, 4)
+        wt_sums = wt_array.sum(axis = 1, keepdims = True)
+        gltf_vb = vb[:-2] + [{'Buffer': joint_lookup[numpy.array(wt_index_buffer, dtype = 'int64').reshape(-1, 4)]},\
+            {'Buffer': numpy.where(wt_sums > 0, wt_array / numpy.where(wt_sums > 0, wt_sums, 1), wt_array)}]
+        if low_memory == False:
+            gltf_vb[-2:] = [{'Buffer': x['Buffer'].tolist()} for x in gltf_vb[-2:]]
+        if len(skin_joints) > 256:
+            # Model-wide joint indices need 16 bits
+            wide_fmt = copy.deepcopy(fmt)
+            [x for x in wide_fmt['elements'] if x['SemanticName'] == 'BLENDINDICES'][0]['Format'] = 'R16G16B16A16_UINT'
+            gltf_fmt = convert_fmt_for_gltf(wide_fmt)
+    primitive = {"attributes":{}}
+    vb_stream = io.BytesIO()
+    with profile_stage(profile, 'buffer_packing'):
+        if low_memory == True:
+            for element in range(len(gltf_fmt['elements'])):
+                vb_stream.write(pack_vb_column(gltf_vb[element]['Buffer'], gltf_fmt['elements'][element]['componentStride'],\
+                    gltf_fmt['elements'][element]['Format']).tobytes())
+        else:
+            write_vb_stream(gltf_vb, vb_stream, gltf_fmt, e='<', interleave = False)
+    block_offset = len(geom_buffer)
+    for element in range(len(gltf_fmt['elements'])):
+        primitive["attributes"][gltf_fmt['elements'][element]['SemanticName']]\
+            = len(geom_gltf['accessors'])
+        geom_gltf['accessors'].append({"bufferView" : len(geom_gltf['bufferViews']),\
+            "componentType": gltf_fmt['elements'][element]['componentType'],\
+            "count": len(gltf_vb[element]['Buffer']),\
+            "type": gltf_fmt['elements'][element]['accessor_type']})
+        if gltf_fmt['elements'][element]['SemanticName'] == 'POSITION' and low_memory == True:
+            geom_gltf['accessors'][-1]['max'] = gltf_vb[element]['Buffer'].max(axis = 0).tolist()
+            geom_gltf['accessors'][-1]['min'] = gltf_vb[element]['Buffer'].min(axis = 0).tolist()
+        elif gltf_fmt['elements'][element]['SemanticName'] == 'POSITION':
+            geom_gltf['accessors'][-1]['max'] =\
+                [max([x[0] for x in gltf_vb[element]['Buffer']]),\
+                 max([x[1] for x in gltf_vb[element]['Buffer']]),\
+                 max([x[2] for x in gltf_vb[element]['Buffer']])]
+            geom_gltf['accessors'][-1]['min'] =\
+                [min([x[0] for x in gltf_vb[element]['Buffer']]),\
+                 min([x[1] for x in gltf_vb[element]['Buffer']]),\
+                 min([x[2] for x in gltf_vb[element]['Buffer']])]
+        geom_gltf['bufferViews'].append({"buffer": 0,\
+            "byteOffset": block_offset,\
+            "byteLength": len(gltf_vb[element]['Buffer']) *\
+            gltf_fmt['elements'][element]['componentStride'],\
+            "target" : 34962})
+        block_offset += len(gltf_vb[element]['Buffer']) *\
+            gltf_fmt['elements'][element]['componentStride']
+    vb_stream.seek(0)
+    geom_buffer += vb_stream.read()
+    vb_stream.close()
+    del(vb_stream)
+    # Index Buffers
+    combined_ib = []
+    index_buffers = []
+    for j in range(geom['num_index_buffers']):
+        current_primitive = copy.deepcopy(primitive)
+        with profile_stage(profile, 'index_decode'):
+            f.seek(block_offsets["triangles"] + (meshes[j]['index_buffer_offset'] * 2))
+            if low_memory == True:
+                ib = numpy.frombuffer(f.read(meshes[j]['index_buffer_len'] * 2), dtype = '<u2')
+            else:
+                ib = list(struct.unpack("<{}H".format(meshes[j]['index_buffer_len']),
+                    f.read(meshes[j]['index_buffer_len'] * 2)))
+        add_count(profile, 'meshes')
+        add_count(profile, 'triangles', len(ib) // 3)
+        if low_memory == False:
+            combined_ib.extend(ib)
+        index_buffers.append(ib)
+        ib_stream = io.BytesIO()
+        with profile_stage(profile, 'buffer_packing'):
+            if low_memory == True:
+                ib_stream.write(ib.tobytes())
+            else:
+                write_ib_stream(ib, ib_stream, gltf_fmt, e='<')
+            # IB is 16-bit so can be misaligned, unlike VB
+            while (ib_stream.tell() % 4) > 0:
+                ib_stream.write(b'\x00')
+        current_primitive["indices"] = len(geom_gltf['accessors'])
+        geom_gltf['accessors'].append({"bufferView" : len(geom_gltf['bufferViews']),\
+            "componentType": gltf_fmt['componentType'],\
+            "count": meshes[j]['index_buffer_len'],\
+            "type": gltf_fmt['accessor_type']})
+        geom_gltf['bufferViews'].append({"buffer": 0,\
+            "byteOffset": len(geom_buffer),\
+            "byteLength": ib_stream.tell(),\
+            "target" : 34963})
+        ib_stream.seek(0)
+        geom_buffer += ib_stream.read()
+        ib_stream.close()
+        del(ib_stream)
+        current_primitive["mode"] = 4 #TRIANGLES
+        current_primitive["material"] = meshes[j]['material']
+        primitives.append(current_primitive)
+    geom_gltf['mesh'] = {"primitives": primitives, "name": geom['name']}
+    if low_memory == True:
+        combined_ib = numpy.concatenate(index_buffers + [numpy.zeros(0, dtype = '<u2')])
+    # Skinning
+    vgmap = {}
+    if weights == True and skin_joints is not None:
+        vgmap = {node_list[bone_palette[i]]: i for i in range(len(bone_palette))}
+        # The model-wide skin and its inverse bind matrices are added by build_imdl_gltf()
+        geom_gltf['skin'] = {"inverseBindMatrices": None, "joints": skin_joints}
+    elif weights == True:
+        vgmap = {node_list[bone_palette[i]]: i for i in range(len(bone_palette))}
+        geom_gltf['skin'] = {"inverseBindMatrices": len(geom_gltf['accessors']), "joints": bone_palette}
+        geom_gltf['accessors'].append({"bufferView" : len(geom_gltf['bufferViews']),\
+            "componentType": 5126,\
+            "count": geom['num_bones'],\
+            "type": "MAT4"})
+        geom_gltf['bufferViews'].append({"buffer": 0,\
+            "byteOffset": len(geom_buffer),\
+            "byteLength": len(bind_matrix_buffer)})
+        geom_buffer += bind_matrix_buffer
+    # Levels of detail
+    if lod_levels > 0 and len(combined_ib) > 0:
+        start_time = time.perf_counter()
+        with profile_stage(profile, 'lod_decimation'):
+            targets = [int(len(combined_ib) // 3 * lod_ratio ** (k + 1)) for k in range(lod_levels)]
+            lod_index_buffers = simplify_mesh(vb[0]['Buffer'], [x.tolist() for x in index_buffers] if low_memory == True\
+                else index_buffers, targets)
+        geom_gltf['lod_seconds'] = time.perf_counter() - start_time
+        geom_gltf['lod_triangles'].append(len(combined_ib) // 3) # The full mesh, then each level
+        for k in range(lod_levels):
+            lod_primitives = []
+            for j in range(len(primitives)):
+                ib = lod_index_buffers[k][j]
+                # A primitive that simplified away entirely is left out of the level
+                if len(ib) == 0:
+                    continue
+                lod_primitive = copy.deepcopy(primitives[j])
+                ib_stream = io.BytesIO()
+                with profile_stage(profile, 'buffer_packing'):
+                    write_ib_stream(ib, ib_stream, gltf_fmt, e='<')
+                    while (ib_stream.tell() % 4) > 0:
+                        ib_stream.write(b'\x00')
+                lod_primitive["indices"] = len(geom_gltf['accessors'])
+                geom_gltf['accessors'].append({"bufferView" : len(geom_gltf['bufferViews']),\
+                    "componentType": gltf_fmt['componentType'],\
+                    "count": len(ib),\
+                    "type": gltf_fmt['accessor_type']})
+                geom_gltf['bufferViews'].append({"buffer": 0,\
+                    "byteOffset": len(geom_buffer),\
+                    "byteLength": ib_stream.tell(),\
+                    "target" : 34963})
+                geom_buffer += ib_stream.getvalue()
+                lod_primitives.append(lod_primitive)
+            geom_gltf['lods'].append({"primitives": lod_primitives, "name": "{0}_LOD{1}".format(geom['name'], k + 1)})
+            geom_gltf['lod_triangles'].append(sum([len(x) for x in lod_index_buffers[k]]) // 3)
+            add_count(profile, 'lod{}_triangles'.format(k + 1), geom_gltf['lod_triangles'][-1])
+        geom_gltf['lod_coverage'] = lod_screen_coverage(lod_levels, lod_ratio)
+    add_count(profile, 'geoms')
+    if raw_buffer_folder is not None:
+        with profile_stage(profile, 'file_write'):
+            write_fmt(fmt, "{0}/{1:02d}_{2}.fmt".format(raw_buffer_folder, i, geom['name']))
+            if low_memory == True:
+                # The same interleaved layout as write_vb(), a column at a time
+                with open("{0}/{1:02d}_{2}.vb".format(raw_buffer_folder, i, geom['name']), 'wb') as ff:
+                    ff.write(numpy.concatenate([pack_vb_column(vb[j]['Buffer'], get_stride_from_dxgi_format(fmt['elements'][j]['Format']),\
+                        fmt['elements'][j]['Format']) for j in range(len(fmt['elements']))], axis = 1).tobytes())
+                with open("{0}/{1:02d}_{2}.ib".format(raw_buffer_folder, i, geom['name']), 'wb') as ff:
+                    ff.write(combined_ib.astype('<u2').tobytes())
+            else:
+                write_vb(vb, "{0}/{1:02d}_{2}.vb".format(raw_buffer_folder, i, geom['name']), fmt)
+                write_ib(combined_ib, "{0}/{1:02d}_{2}.ib".format(raw_buffer_folder, i, geom['name']), fmt)
+            with open("{0}/{1:02d}_{2}.vgmap".format(raw_buffer_folder, i, geom['name']), 'wb') as ff:
+                ff.write(json.dumps(vgmap, indent=4).encode('utf-8'))
+    geom_gltf['buffer'] = geom_buffer
+    return(geom_gltf)
+
+def buffer_length (giant_buffer):
+    # giant_buffer is bytes, or a temporary file that it is spooled to when memory is short
+    return(len(giant_buffer) if isinstance(giant_buffer, bytes) else giant_buffer.tell())
+
+def append_buffer (giant_buffer, data):
+    # Returns the new giant_buffer
+    if isinstance(giant_buffer, bytes):
+        return(giant_buffer + data)
+    giant_buffer.write(data)
+    return(giant_buffer)
+
+def merge_geom (gltf_data, giant_buffer, geom, geom_gltf):
+    # Renumbers the accessors and bufferViews of a decoded geom and appends it, exactly as if it had
+    # been decoded straight into gltf_data.  Returns the new giant_buffer.
+    first_accessor, first_buffer_view = len(gltf_data['accessors']), len(gltf_data['bufferViews'])
+    for accessor in geom_gltf['accessors']:
+        accessor['bufferView'] += first_buffer_view
+    for buffer_view in geom_gltf['bufferViews']:
+        buffer_view['byteOffset'] += buffer_length(giant_buffer)
+    for primitive in geom_gltf['mesh']['primitives'] + [x for y in geom_gltf['lods'] for x in y['primitives']]:
+        primitive['attributes'] = {x:primitive['attributes'][x] + first_accessor for x in primitive['attributes']}
+        primitive['indices'] += first_accessor
+    gltf_data['accessors'].extend(geom_gltf['accessors'])
+    gltf_data['bufferViews'].extend(geom_gltf['bufferViews'])
+    if not geom['node'] == 0xFFFF:
+        gltf_data['nodes'][geom['node']]['mesh'] = len(gltf_data['meshes'])
+    else: # Add new node
+        gltf_data['nodes'][0]['children'].append(len(gltf_data['nodes']))
+        gltf_data['nodes'].append({'name': geom['name'], 'mesh': len(gltf_data['meshes'])})
+    mesh_node = gltf_data['nodes'][geom['node']] if not geom['node'] == 0xFFFF else gltf_data['nodes'][-1]
+    gltf_data['meshes'].append(geom_gltf['mesh'])
+    if geom_gltf['skin'] is not None and geom_gltf['skin']['inverseBindMatrices'] is None:
+        gltf_data['nodes'][geom['node']]['skin'] = 0 # The model-wide skin
+    elif geom_gltf['skin'] is not None:
+        gltf_data['nodes'][geom['node']]['skin'] = len(gltf_data['skins'])
+        gltf_data['skins'].append({"inverseBindMatrices": geom_gltf['skin']['inverseBindMatrices'] + first_accessor,\
+            "joints": geom_gltf['skin']['joints']})
+    if len(geom_gltf['lods']) > 0:
+        # MSFT_lod: the levels are nodes outside of the scene, which take the place of the mesh node
+        lod_nodes = []
+        for lod_mesh in geom_gltf['lods']:
+            lod_node = {'name': lod_mesh['name'], 'mesh': len(gltf_data['meshes'])}
+            for key in ['matrix', 'skin']:
+                if key in mesh_node:
+                    lod_node[key] = mesh_node[key]
+            lod_nodes.append(len(gltf_data['nodes']))
+            gltf_data['nodes'].append(lod_node)
+            gltf_data['meshes'].append(lod_mesh)
+        mesh_node['extensions'] = {'MSFT_lod': {'ids': lod_nodes}}
+        mesh_node['extras'] = {'MSFT_screencoverage': geom_gltf['lod_coverage']}
+        if not 'MSFT_lod' in gltf_data.get('extensionsUsed', []):
+            gltf_data['extensionsUsed'] = gltf_data.get('extensionsUsed', []) + ['MSFT_lod']
+    return(append_buffer(giant_buffer, geom_gltf['buffer']))
+
+def read_model_skin (f, geoms, shapes, block_offsets):
+    # Collects the bone palettes of the skinned geoms into one list of joints (node indices) for the
+    # whole model, and returns it with the inverse bind matrices of those joints.  Raises ValueError if
+    # two geoms bind the same joint differently, since one skin could not reproduce both.
+    bind_matrices = {}
+    for geom in geoms:
+        shape = shapes[geom['vertex_buffer']]
+        if shape['blendweight_offset'] == 0:
+            continue
+        f.seek(block_offsets["triangles"] + (geom['bone_palette_offset'] * 2))
+        bone_palette = struct.unpack("<{}H".format(geom['num_bones']), f.read(geom['num_bones'] * 2))
+        # The inverse bind matrices follow the weights
+        f.seek(block_offsets["vertices"] + (shape['blendweight_offset'] * 4) + (shape['num_vertices'] * 16))
+        matrices = numpy.frombuffer(f.read(64 * geom['num_bones']), dtype = '<f4').reshape(-1, 16)
+        for bone, matrix in zip(bone_palette, matrices):
+            if bone in bind_matrices and not numpy.allclose(bind_matrices[bone], matrix, rtol = 1e-4, atol = 1e-5):
+                raise ValueError("geom {0} binds node {1} differently from another geom".format(geom['name'], bone))
+            bind_matrices[bone] = matrix
+    joints = sorted(bind_matrices)
+    return(joints, b''.join([bind_matrices[x].tobytes() for x in joints]))
+
+gltf_component_dtypes = {5121: 'u1', 5123: '<u2', 5125: '<u4', 5126: '<f4'}
+gltf_type_widths = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT4': 16}
+
+def read_accessor (gltf_data, buffer, accessor_index):
+    # Returns the data of a (tightly packed) accessor as a (count, width) array
+    accessor = gltf_data['accessors'][accessor_index]
+    buffer_view = gltf_data['bufferViews'][accessor['bufferView']]
+    width = gltf_type_widths[accessor['type']]
+    return(numpy.frombuffer(buffer, dtype = gltf_component_dtypes[accessor['componentType']], count = accessor['count'] * width,\
+        offset = buffer_view['byteOffset'] + accessor.get('byteOffset', 0)).reshape(accessor['count'], width))
+
+def compact_gltf_buffer (gltf_data, buffer):
+    # Drops the accessors and bufferViews that nothing uses any more, and returns the buffer rebuilt
+    # from the ones that are left
+    used_accessors = sorted(set([x for mesh in gltf_data['meshes'] for primitive in mesh['primitives']\
+        for x in list(primitive['attributes'].values()) + ([primitive['indices']] if 'indices' in primitive else [])]\
+        + [x['inverseBindMatrices'] for x in gltf_data['skins'] if 'inverseBindMatrices' in x]))
+    used_buffer_views = sorted(set([gltf_data['accessors'][x]['bufferView'] for x in used_accessors]\
+        + [x['bufferView'] for x in gltf_data.get('images', []) if 'bufferView' in x]))
+    accessor_map = {used_accessors[i]: i for i in range(len(used_accessors))}
+    buffer_view_map = {used_buffer_views[i]: i for i in range(len(used_buffer_views))}
+    chunks, buffer_views, new_length = [], [], 0
+    for i in used_buffer_views:
+        buffer_view = dict(gltf_data['bufferViews'][i])
+        chunks.append(b'\x00' * (-new_length % 4))
+        new_length += len(chunks[-1])
+        chunks.append(buffer[buffer_view['byteOffset']:buffer_view['byteOffset'] + buffer_view['byteLength']])
+        buffer_view['byteOffset'] = new_length
+        new_length += buffer_view['byteLength']
+        buffer_views.append(buffer_view)
+    gltf_data['accessors'] = [gltf_data['accessors'][x] for x in used_accessors]
+    for accessor in gltf_data['accessors']:
+        accessor['bufferView'] = buffer_view_map[accessor['bufferView']]
+    gltf_data['bufferViews'] = buffer_views
+    for mesh in gltf_data['meshes']:
+        for primitive in mesh['primitives']:
+            primitive['attributes'] = {x:accessor_map[primitive['attributes'][x]] for x in primitive['attributes']}
+            if 'indices' in primitive:
+                primitive['indices'] = accessor_map[primitive['indices']]
+    for skin in gltf_data['skins']:
+        if 'inverseBindMatrices' in skin:
+            skin['inverseBindMatrices'] = accessor_map[skin['inverseBindMatrices']]
+    for image in gltf_data.get('images', []):
+        if 'bufferView' in image:
+            image['bufferView'] = buffer_view_map[image['bufferView']]
+    return(b''.join(chunks))
+
+def batch_primitives (gltf_data, giant_buffer, profile = None, log = None):
+    # Merges the primitives that share a material, a skin and a vertex layout into one primitive each,
+    # to save draw calls.  Rigid meshes have the transforms of their nodes applied to their vertices and
+    # go on one new node at the root of the scene; skinned meshes go on a new node for each skin (the
+    # transform of a skinned mesh node is not used).  Only the vertices each primitive uses are copied.
+    # Returns the new buffer.
+    nodes = gltf_data['nodes']
+    parents = {x: i for i in range(len(nodes)) for x in nodes[i].get('children', [])}
+    def world_matrix (i):
+        matrix = numpy.array(nodes[i].get('matrix', numpy.eye(4).reshape(-1).tolist()), dtype = 'float64').reshape(4,4).T
+        return(matrix if not i in parents else world_matrix(parents[i]) @ matrix)
+    groups = {}
+    draw_calls = 0
+    for i in range(len(nodes)):
+        if 'mesh' in nodes[i]:
+            for primitive in gltf_data['meshes'][nodes[i]['mesh']]['primitives']:
+                layout = tuple(sorted([(x, gltf_data['accessors'][primitive['attributes'][x]]['componentType'],\
+                    gltf_data['accessors'][primitive['attributes'][x]]['type']) for x in primitive['attributes']]))
+                key = (primitive.get('material'), nodes[i].get('skin'), layout)
+                groups[key] = groups.get(key, []) + [(i, primitive)]
+                draw_calls += 1
+    batched = {}
+    chunks, buffer_length = [giant_buffer], len(giant_buffer)
+    def add_accessor (array, component_type, accessor_type, target):
+        nonlocal buffer_length
+        chunks.append(b'\x00' * (-buffer_length % 4))
+        buffer_length += len(chunks[-1])
+        chunks.append(numpy.ascontiguousarray(array, dtype = gltf_component_dtypes[component_type]).tobytes())
+        gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+            "componentType": component_type,\
+            "count": len(array),\
+            "type": accessor_type})
+        gltf_data['bufferViews'].append({"buffer": 0,\
+            "byteOffset": buffer_length,\
+            "byteLength": len(chunks[-1]),\
+            "target" : target})
+        buffer_length += len(chunks[-1])
+        return(len(gltf_data['accessors']) - 1)
+    with profile_stage(profile, 'batching'):
+        for (material, skin, layout) in groups:
+            attributes = {x[0]: [] for x in layout}
+            indices, num_vertices = [], 0
+            for i, primitive in groups[(material, skin, layout)]:
+                used_vertices, ib = numpy.unique(read_accessor(gltf_data, giant_buffer, primitive['indices']).reshape(-1),\
+                    return_inverse = True)
+                indices.append(ib.reshape(-1) + num_vertices)
+                num_vertices += len(used_vertices)
+                matrix = world_matrix(i) if skin is None else None
+                for semantic in attributes:
+                    values = read_accessor(gltf_data, giant_buffer, primitive['attributes'][semantic])[used_vertices]
+                    if matrix is not None and semantic == 'POSITION':
+                        values = values @ matrix[:3,:3].T + matrix[:3,3]
+                    elif matrix is not None and semantic == 'NORMAL':
+                        values = values @ numpy.linalg.inv(matrix[:3,:3])
+                        lengths = numpy.linalg.norm(values, axis = 1, keepdims = True)
+                        values = values / numpy.where(lengths > 0, lengths, 1)
+                    attributes[semantic].append(values)
+            new_primitive = {"attributes": {}}
+            for (semantic, component_type, accessor_type) in layout:
+                values = numpy.concatenate(attributes[semantic])
+                new_primitive["attributes"][semantic] = add_accessor(values, component_type, accessor_type, 34962)
+                if semantic == 'POSITION':
+                    gltf_data['accessors'][-1]['max'] = values.max(axis = 0).astype('float32').tolist()
+                    gltf_data['accessors'][-1]['min'] = values.min(axis = 0).astype('float32').tolist()
+            # 65535 is the primitive restart value, so 16-bit indices can only address 65535 vertices
+            new_primitive["indices"] = add_accessor(numpy.concatenate(indices), 5123 if num_vertices <= 65535 else 5125,\
+                "SCALAR", 34963)
+            new_primitive["mode"] = 4 #TRIANGLES
+            if material is not None:
+                new_primitive["material"] = material
+            batched[skin] = batched.get(skin, []) + [new_primitive]
+        for node in nodes:
+            for key in ['mesh', 'skin']:
+                if key in node:
+                    del(node[key])
+        for skin in batched:
+            new_node = {'name': 'batched' if skin is None else 'batched_skin{}'.format(skin), 'mesh': len(gltf_data['meshes'])}
+            if skin is not None:
+                new_node['skin'] = skin
+            gltf_data['meshes'].append({"primitives": batched[skin], "name": new_node['name']})
+            gltf_data['scenes'][0]['nodes'].append(len(nodes))
+            nodes.append(new_node)
+        gltf_data['meshes'] = [gltf_data['meshes'][x['mesh']] for x in nodes if 'mesh' in x]
+        mesh_nodes = [x for x in nodes if 'mesh' in x]
+        for i in range(len(mesh_nodes)):
+            mesh_nodes[i]['mesh'] = i
+        giant_buffer = compact_gltf_buffer(gltf_data, b''.join(chunks))
+    add_count(profile, 'draw_calls_before_batching', draw_calls)
+    add_count(profile, 'draw_calls_after_batching', len(groups))
+    if log is not None:
+        log("Draw calls: {0} before batching, {1} after".format(draw_calls, len(groups)))
+    return(giant_buffer)
+
+def log_lods (geom, geom_gltf, log = None):
+    if log is not None and len(geom_gltf['lods']) > 0:
+        log("{0}: {1} triangles, levels of detail {2} ({3:.2f}s)".format(geom['name'],\
+            geom_gltf['lod_triangles'][0],\
+            ', '.join([str(x) for x in geom_gltf['lod_triangles'][1:]]), geom_gltf['lod_seconds']))
+    return
+
+# Approximate bytes used by the default decode for each vertex of a geom (a Python list for each
+# element of each vertex), and the extra for each index
+list_bytes_per_vertex = 1000
+list_bytes_per_index = 40
+
+def project_imdl_memory (input_size, shapes, geoms, meshes):
+    # Rough peak memory of decoding geoms into a glTF buffer in memory: the input, the Python lists
+    # of the largest geom, and the buffer twice over (it is copied as it grows).
+    largest_geom, buffer_size = 0, 0
+    for geom in geoms:
+        shape = shapes[geom['vertex_buffer']]
+        num_indices = sum([x['index_buffer_len'] for x in meshes[geom['first_index_buffer']:geom['first_index_buffer'] + geom['num_index_buffers']]])
+        largest_geom = max(largest_geom, shape['num_vertices'] * list_bytes_per_vertex + num_indices * list_bytes_per_index)
+        buffer_size += shape['num_vertices'] * 52 + num_indices * 2 + geom['num_bones'] * 64
+    return(input_size + largest_geom + 2 * buffer_size)
+
+def _init_geom_worker (imdl_data):
+    # Each worker process keeps its own copy of the file
+    global _geom_worker_data
+    _geom_worker_data = imdl_data
+
+def _process_geom_worker (args):
+    profile = new_profile('', 'geom_worker') if args[-1] == True else None
+    with io.BytesIO(_geom_worker_data) as f:
+        geom_gltf = process_geom(f, *args[:-1], profile = profile)
+    return(geom_gltf, profile)
+
+def parse_selection (only = None):
+    # only is a list of 'nodes', 'materials' and/or 'geoms=<name>,<name>,...' (None for everything).
+    # The node tree is always exported.  Geoms need the materials, so selecting geoms includes them.
+    selection = {'materials': True, 'geoms': None}
+    if only is not None and len(only) > 0:
+        selection = {'materials': False, 'geoms': []}
+        for item in only:
+            if item == 'materials':
+                selection['materials'] = True
+            elif item[0:6] == 'geoms=':
+                selection['materials'] = True
+                selection['geoms'].extend([x for x in item[6:].split(',') if len(x) > 0])
+            elif not item == 'nodes':
+                raise ValueError("Unknown selection {}, use nodes, materials or geoms=<names>".format(item))
+    return(selection)
+
+def ask_texture_choice (material_name, image_list):
+    print("Material {} does not have a matching image!  Which image is correct?".format(material_name))
+    for j in range(len(image_list)):
+        print("{0}. {1}".format(j, image_list[j]))
+    img_choice = -1
+    while not img_choice in range(len(image_list)):
+        raw_input = input("Please select choice by number: ")
+        try:
+            img_choice = int(raw_input)
+        except:
+            pass
+    return(img_choice)
+
+def build_imdl_gltf (imdl_file, data = None, profile = None, only = None, embed_textures = False, texture_cache = None,\
+        txp_folder = None, geom_workers = 1, raw_buffer_folder = None, choose_texture = None, log = None, lod_levels = 0,\
+        lod_ratio = 0.5, merge_skins = False, batch = False, names = None, memory_budget = None):
+    # Decodes the model into a glTF document and its binary buffer, and returns (gltf_data, buffer),
+    # or None if it is not an IMDL file.  Nothing is written (except the raw buffers, if raw_buffer_folder
+    # is given) and nothing is asked: choose_texture(material_name, image_list) picks the texture of a
+    # material whose name does not match any image (otherwise the first one is used), and warnings are
+    # passed to log(message).  only selects part of the model, see parse_selection(); the vertex and
+    # index data of geoms that are not selected are never read.  txp_folder is searched for the textures
+    # to embed, by default the folder of imdl_file.  lod_levels simplified meshes are added to each geom
+    # with MSFT_lod, see process_geom(); their triangle counts are passed to log.  With merge_skins, the
+    # skinned geoms share one skin, unless their bind matrices disagree.  With batch, the primitives that
+    # can be drawn together are merged, see batch_primitives().  The images are named the way
+    # vato_extract_txp.py names the textures with the name index names, see lib_vato_names.py.  If
+    # decoding the model is projected to take more than memory_budget bytes, the geoms are decoded
+    # with numpy (see process_geom()) one at a time, and the buffer is spooled to a temporary file,
+    # which is returned in its place (see buffer_length()).
+    selection = parse_selection(only)
+    if batch == True and lod_levels > 0:
+        raise ValueError("Batching cannot be combined with levels of detail")
     def add_child_to_node (nodes, i):
         current_node = i
         nodes[i]['children'] = []
@@ -137,7 +695,6 @@ def process_imdl (imdl_file, write_raw_buffers = False, write_binary_gltf = True
             nodes[current_node]['children'].append(i)
             nodes, i = add_child_to_node(nodes, i)
         return (nodes, i)
-    print("Processing {}...".format(imdl_file))
     gltf_data = {}
     gltf_data['asset'] = { 'version': '2.0' }
     gltf_data['accessors'] = []
@@ -154,114 +711,105 @@ def process_imdl (imdl_file, write_raw_buffers = False, write_binary_gltf = True
     gltf_data['textures'] = []
     giant_buffer = bytes()
     buffer_view = 0
-    with open(imdl_file, "rb") as f:
-        magic = f.read(4)
-        if magic == b'IMDL':
-            unk0, unk1, unk2, num_sections = struct.unpack("<4H", f.read(8))
-            block_offsets = {}
-            block_offsets["dictionary"], block_offsets["blend_indices"], block_offsets["triangles"],\
-                block_offsets["unknown_blanks"], block_offsets["vertices"] = struct.unpack("<5I", f.read(20))
-            while f.tell() < block_offsets["dictionary"]:
-                section_magic = f.read(4)
-                section_size, = struct.unpack("<I", f.read(4))
-                if section_magic == b'tex ':
-                    textures = []
-                    num_sections, num_textures = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_textures):
-                        string_offset, = struct.unpack("<I", f.read(4))
-                        texture = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
-                        textures.append(texture)
-                elif section_magic == b'mate':
-                    materials = []
-                    num_sections, num_materials = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_materials):
-                        material = {}
-                        string_offset, = struct.unpack("<I", f.read(4))
-                        material['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
-                        material['unk0'], material['flags'] = struct.unpack("<iI", f.read(8))
-                        material['unk_parameters'] = list(struct.unpack("<IfIfIfIfIf", f.read(40)))
-                        material['unk2'], material['unk3'], material['unk4'] = struct.unpack("<f2H", f.read(8))
-                        material['unk_values'] = list(struct.unpack("<4I", f.read(16)))
-                        materials.append(material)
-                elif section_magic == b'mesh':
-                    meshes = []
-                    num_sections, num_meshes = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_meshes):
-                        mesh = {}
-                        mesh['material'], mesh['unk0'], mesh['unk1'], mesh['index_buffer_len'], mesh['index_buffer_offset']\
-                            = struct.unpack("<2H3I", f.read(16))
-                        meshes.append(mesh)
-                elif section_magic == b'shap':
-                    shapes = []
-                    num_sections, num_shapes = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_shapes):
-                        shape = {}
-                        shape['unk0'], shape['unk1'], shape['num_vertices'], shape['pos_offset'],\
-                        shape['uv_offset'], shape['abs_vert_start'], shape['norm_offset'],\
-                        shape['blend_indices_offset'], shape['blendweight_offset'] = struct.unpack("<9I", f.read(36))
-                        shapes.append(shape)
-                elif section_magic == b'geom':
-                    geoms = []
-                    num_sections, num_geoms = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_geoms):
-                        geom = {}
-                        string_offset, = struct.unpack("<I", f.read(4))
-                        geom['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
-                        geom['node'], geom['unk1'], geom['unk2'], geom['unk3'],\
-                            geom['vertex_buffer'] = struct.unpack("<HhIHH", f.read(12))
-                        geom['matrix'] = list(struct.unpack("<16f", f.read(64)))
-                        geom['bbox'] = list(struct.unpack("<9f", f.read(36)))
-                        geom['zeroes0'] = list(struct.unpack("<4I", f.read(16)))
-                        geom['num_index_buffers'], geom['first_index_buffer'] = struct.unpack("<2H", f.read(4))
-                        geom['num_bones'], = struct.unpack("<I", f.read(4))
-                        geom['unk7'], geom['bone_palette_offset'] = struct.unpack("<2I", f.read(8))
-                        geom['zeroes1'] = list(struct.unpack("<3I", f.read(12)))
-                        geoms.append(geom)
-                elif section_magic == b'node':
-                    nodes = []
-                    num_sections, num_nodes = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_nodes):
-                        node = {}
-                        string_offset, = struct.unpack("<I", f.read(4))
-                        node['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
-                        node['unk1'], = struct.unpack("<f", f.read(4))
-                        node['matrix'] = list(struct.unpack("<16f", f.read(64)))
-                        node['num_children'], node['postorder_traversal'] = struct.unpack("<2I", f.read(8))
-                        nodes.append(node)
-                    nodes, _ = add_child_to_node(nodes, 0)
-                else:
-                    #print("Skipping section {}...".format(section_magic.decode()))
-                    f.seek(section_size - 8, 1)
+    with open_input(imdl_file, data) as f:
+        add_bytes(profile, 'read', stream_size(f))
+        with profile_stage(profile, 'section_parse'):
+            container = read_container(f)
+        if container is not None and container['magic'] == b'IMDL':
+            block_offsets = dict(zip(imdl_block_names, container['block_offsets']))
+            with profile_stage(profile, 'section_parse'):
+                for section_magic in container['sections']:
+                    if section_magic == b'tex ':
+                        textures = []
+                        num_textures = seek_section(f, container, section_magic)
+                        for _ in range(num_textures):
+                            string_offset, = struct.unpack("<I", f.read(4))
+                            texture = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset, profile)
+                            textures.append(texture)
+                    elif section_magic == b'mate':
+                        materials = []
+                        num_materials = seek_section(f, container, section_magic)
+                        for _ in range(num_materials):
+                            material = {}
+                            string_offset, = struct.unpack("<I", f.read(4))
+                            material['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset, profile)
+                            material['unk0'], material['flags'] = struct.unpack("<iI", f.read(8))
+                            material['unk_parameters'] = list(struct.unpack("<IfIfIfIfIf", f.read(40)))
+                            material['unk2'], material['unk3'], material['unk4'] = struct.unpack("<f2H", f.read(8))
+                            material['unk_values'] = list(struct.unpack("<4I", f.read(16)))
+                            materials.append(material)
+                    elif section_magic == b'mesh':
+                        meshes = []
+                        num_meshes = seek_section(f, container, section_magic)
+                        for _ in range(num_meshes):
+                            mesh = {}
+                            mesh['material'], mesh['unk0'], mesh['unk1'], mesh['index_buffer_len'], mesh['index_buffer_offset']\
+                                = struct.unpack("<2H3I", f.read(16))
+                            meshes.append(mesh)
+                    elif section_magic == b'shap':
+                        shapes = []
+                        num_shapes = seek_section(f, container, section_magic)
+                        for _ in range(num_shapes):
+                            shape = {}
+                            shape['unk0'], shape['unk1'], shape['num_vertices'], shape['pos_offset'],\
+                            shape['uv_offset'], shape['abs_vert_start'], shape['norm_offset'],\
+                            shape['blend_indices_offset'], shape['blendweight_offset'] = struct.unpack("<9I", f.read(36))
+                            shapes.append(shape)
+                    elif section_magic == b'geom':
+                        geoms = []
+                        num_geoms = seek_section(f, container, section_magic)
+                        for _ in range(num_geoms):
+                            geom = {}
+                            string_offset, = struct.unpack("<I", f.read(4))
+                            geom['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset, profile)
+                            geom['node'], geom['unk1'], geom['unk2'], geom['unk3'],\
+                                geom['vertex_buffer'] = struct.unpack("<HhIHH", f.read(12))
+                            geom['matrix'] = list(struct.unpack("<16f", f.read(64)))
+                            geom['bbox'] = list(struct.unpack("<9f", f.read(36)))
+                            geom['zeroes0'] = list(struct.unpack("<4I", f.read(16)))
+                            geom['num_index_buffers'], geom['first_index_buffer'] = struct.unpack("<2H", f.read(4))
+                            geom['num_bones'], = struct.unpack("<I", f.read(4))
+                            geom['unk7'], geom['bone_palette_offset'] = struct.unpack("<2I", f.read(8))
+                            geom['zeroes1'] = list(struct.unpack("<3I", f.read(12)))
+                            geoms.append(geom)
+                    elif section_magic == b'node':
+                        nodes = []
+                        num_nodes = seek_section(f, container, section_magic)
+                        for _ in range(num_nodes):
+                            node = {}
+                            string_offset, = struct.unpack("<I", f.read(4))
+                            node['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset, profile)
+                            node['unk1'], = struct.unpack("<f", f.read(4))
+                            node['matrix'] = list(struct.unpack("<16f", f.read(64)))
+                            node['num_children'], node['postorder_traversal'] = struct.unpack("<2I", f.read(8))
+                            nodes.append(node)
+                        nodes, _ = add_child_to_node(nodes, 0)
+            add_count(profile, 'textures', len(textures))
+            add_count(profile, 'materials', len(materials))
+            add_count(profile, 'nodes', len(nodes))
+            if selection['materials'] == False:
+                textures, materials = [], []
             # Materials
-            gltf_data['images'] = [{'uri':'{0:02d}_{1}.png'.format(i, textures[i])} for i in range(len(textures))]
+            image_names = ['{0:02d}_{1}'.format(i, textures[i]) for i in range(len(textures))]
+            with profile_stage(profile, 'string_lookup'):
+                image_files = [resolve_string(names, x) for x in image_names]
+            image_files = [image_names[i] if image_files[i] is None else output_name(image_files[i]) for i in range(len(image_names))]
+            gltf_data['images'] = [{'uri':'{}.png'.format(x)} for x in image_files]
             # I can't figure out how to assign textures, so my best guess is via the names of the materials
             image_list = [x.split('.tga')[0] for x in textures]
             image_assignments_names = ['_'.join(x['name'].split('_')[1:]) if '_' in x['name'] else x for x in materials]
             internal_assignments = [x['unk_values'][2] for x in materials]
             if all([x < len(image_list) for x in internal_assignments]):
                 image_assignments = internal_assignments
-            elif ask_if_texture_does_not_match == True:
+            else:
                 image_assignments = []
                 for i in range(len(image_assignments_names)):
                     if image_assignments_names[i] in image_list:
                         image_assignments.append(image_list.index(image_assignments_names[i]))
+                    elif choose_texture is not None and len(image_list) > 1:
+                        image_assignments.append(choose_texture(image_assignments_names[i], image_list))
                     else:
-                        if len(image_list) > 1:
-                            print("Material {} does not have a matching image!  Which image is correct?".format(image_assignments_names[i]))
-                            for j in range(len(image_list)):
-                                print("{0}. {1}".format(j, image_list[j]))
-                            img_choice = -1
-                            while not img_choice in range(len(image_assignments_names)):
-                                raw_input = input("Please select choice by number: ")
-                                try:
-                                    img_choice = int(raw_input)
-                                except:
-                                    pass
-                            image_assignments.append(img_choice)
-                        else:
-                            image_assignments.append(0)
-            else:
-                image_assignments = [image_list.index(x) if x in image_list else 0 for x in image_assignments_names]
+                        image_assignments.append(0)
             for i in range(len(materials)):
                 g_material = { 'name': materials[i]['name'] }
                 sampler = { 'wrapS': 10497, 'wrapT': 10497 } # I have no idea if this setting exists
@@ -285,154 +833,139 @@ def process_imdl (imdl_file, write_raw_buffers = False, write_binary_gltf = True
             # Meshes
             node_list = [x['name'] for x in nodes]
             material_dict = {gltf_data['materials'][i]['name']:i for i in range(len(gltf_data['materials']))}
-            if write_raw_buffers == True:
-                overwrite_buffers = copy.deepcopy(overwrite)
-                if os.path.exists(imdl_file[:-4]) and (os.path.isdir(imdl_file[:-4])) and (overwrite_buffers == False):
-                    if str(input(imdl_file[:-4] + " folder exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
-                        overwrite_buffers = True
-                if (overwrite_buffers == True) or not os.path.exists(imdl_file[:-4]):
-                    if not os.path.exists(imdl_file[:-4]):
-                        os.mkdir(imdl_file[:-4])
-                    overwrite_buffers = True
-            for i in range(len(geoms)):
-                uv = (not shapes[geoms[i]['vertex_buffer']]['uv_offset'] == 0)
-                normals = (not shapes[geoms[i]['vertex_buffer']]['norm_offset'] == 0)
-                weights = (not shapes[geoms[i]['vertex_buffer']]['blendweight_offset'] == 0)
-                fmt = make_fmt(uv, normals, weights)
-                gltf_fmt = convert_fmt_for_gltf(fmt)
-                # Vertex Buffer
-                primitives = []
-                vb = []
-                # Cheating here, seeking only once since the sample files have no padding between buffers
-                f.seek(block_offsets["vertices"] + (shapes[geoms[i]['vertex_buffer']]['pos_offset'] * 4))
-                pos_buffer = list(struct.unpack("<{}f".format(shapes[geoms[i]['vertex_buffer']]['num_vertices']*3),
-                    f.read(shapes[geoms[i]['vertex_buffer']]['num_vertices'] * 4 * 3)))
-                vb.append({'Buffer': [pos_buffer[j*3:j*3+3] for j in range(len(pos_buffer)//3)]})
-                if uv == True:
-                    uv_buffer = list(struct.unpack("<{}f".format(shapes[geoms[i]['vertex_buffer']]['num_vertices']*2),
-                        f.read(shapes[geoms[i]['vertex_buffer']]['num_vertices'] * 4 * 2)))
-                    vb.append({'Buffer': [uv_buffer[j*2:j*2+2] for j in range(len(uv_buffer)//2)]})
-                if normals == True:
-                    norm_buffer = list(struct.unpack("<{}f".format(shapes[geoms[i]['vertex_buffer']]['num_vertices']*3),
-                        f.read(shapes[geoms[i]['vertex_buffer']]['num_vertices'] * 4 * 3)))
-                    vb.append({'Buffer': [norm_buffer[j*3:j*3+3] for j in range(len(norm_buffer)//3)]})
-                if weights == True:
-                    wt_buffer = list(struct.unpack("<{}f".format(shapes[geoms[i]['vertex_buffer']]['num_vertices']*4),
-                        f.read(shapes[geoms[i]['vertex_buffer']]['num_vertices'] * 4 * 4)))
-                    bind_matrix_buffer = f.read(64 * geoms[i]['num_bones'])
-                    f.seek(block_offsets["blend_indices"] + (shapes[geoms[i]['vertex_buffer']]['blend_indices_offset'] * 1))
-                    wt_index_buffer = list(struct.unpack("<{}B".format(shapes[geoms[i]['vertex_buffer']]['num_vertices']*4),
-                        f.read(shapes[geoms[i]['vertex_buffer']]['num_vertices'] * 4)))
-                    vb.append({'Buffer': [wt_index_buffer[j*4:j*4+4] for j in range(len(wt_index_buffer)//4)]})
-                    vb.append({'Buffer': [wt_buffer[j*4:j*4+4] for j in range(len(wt_buffer)//4)]})
-                primitive = {"attributes":{}}
-                vb_stream = io.BytesIO()
-                write_vb_stream(vb, vb_stream, gltf_fmt, e='<', interleave = False)
-                block_offset = len(giant_buffer)
-                for element in range(len(gltf_fmt['elements'])):
-                    primitive["attributes"][gltf_fmt['elements'][element]['SemanticName']]\
-                        = len(gltf_data['accessors'])
-                    gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                        "componentType": gltf_fmt['elements'][element]['componentType'],\
-                        "count": len(vb[element]['Buffer']),\
-                        "type": gltf_fmt['elements'][element]['accessor_type']})
-                    if gltf_fmt['elements'][element]['SemanticName'] == 'POSITION':
-                        gltf_data['accessors'][-1]['max'] =\
-                            [max([x[0] for x in vb[element]['Buffer']]),\
-                             max([x[1] for x in vb[element]['Buffer']]),\
-                             max([x[2] for x in vb[element]['Buffer']])]
-                        gltf_data['accessors'][-1]['min'] =\
-                            [min([x[0] for x in vb[element]['Buffer']]),\
-                             min([x[1] for x in vb[element]['Buffer']]),\
-                             min([x[2] for x in vb[element]['Buffer']])]
-                    gltf_data['bufferViews'].append({"buffer": 0,\
-                        "byteOffset": block_offset,\
-                        "byteLength": len(vb[element]['Buffer']) *\
-                        gltf_fmt['elements'][element]['componentStride'],\
-                        "target" : 34962})
-                    block_offset += len(vb[element]['Buffer']) *\
-                        gltf_fmt['elements'][element]['componentStride']
-                vb_stream.seek(0)
-                giant_buffer += vb_stream.read()
-                vb_stream.close()
-                del(vb_stream)
-                # Index Buffers
-                combined_ib = []
-                for j in range(geoms[i]['num_index_buffers']):
-                    current_primitive = copy.deepcopy(primitive)
-                    f.seek(block_offsets["triangles"] + (meshes[geoms[i]['first_index_buffer']+j]['index_buffer_offset'] * 2))
-                    ib = list(struct.unpack("<{}H".format(meshes[geoms[i]['first_index_buffer']+j]['index_buffer_len']),
-                        f.read(meshes[geoms[i]['first_index_buffer']+j]['index_buffer_len'] * 2)))
-                    combined_ib.extend(ib)
-                    ib_stream = io.BytesIO()
-                    write_ib_stream(ib, ib_stream, gltf_fmt, e='<')
-                    # IB is 16-bit so can be misaligned, unlike VB
-                    while (ib_stream.tell() % 4) > 0:
-                        ib_stream.write(b'\x00')
-                    current_primitive["indices"] = len(gltf_data['accessors'])
-                    gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                        "componentType": gltf_fmt['componentType'],\
-                        "count": meshes[geoms[i]['first_index_buffer']+j]['index_buffer_len'],\
-                        "type": gltf_fmt['accessor_type']})
-                    gltf_data['bufferViews'].append({"buffer": 0,\
-                        "byteOffset": len(giant_buffer),\
-                        "byteLength": ib_stream.tell(),\
-                        "target" : 34963})
-                    ib_stream.seek(0)
-                    giant_buffer += ib_stream.read()
-                    ib_stream.close()
-                    del(ib_stream)
-                    current_primitive["mode"] = 4 #TRIANGLES
-                    current_primitive["material"] = meshes[geoms[i]['first_index_buffer']+j]['material']
-                    primitives.append(current_primitive)
-                if not geoms[i]['node'] == 0xFFFF:
-                    gltf_data['nodes'][geoms[i]['node']]['mesh'] = len(gltf_data['meshes'])
-                else: # Add new node
-                    gltf_data['nodes'][0]['children'].append(len(gltf_data['nodes']))
-                    gltf_data['nodes'].append({'name': geoms[i]['name'], 'mesh': len(gltf_data['meshes'])})
-                gltf_data['meshes'].append({"primitives": primitives, "name": geoms[i]['name']})
-                # Skinning
-                if weights == True:
-                    f.seek(block_offsets["triangles"] + (geoms[i]['bone_palette_offset'] * 2))
-                    bone_palette = list(struct.unpack("<{}H".format(geoms[i]['num_bones']), f.read(geoms[i]['num_bones'] * 2)))
-                    vgmap = {node_list[bone_palette[i]]: i for i in range(len(bone_palette))}
-                    gltf_data['nodes'][geoms[i]['node']]['skin'] = len(gltf_data['skins'])
-                    gltf_data['skins'].append({"inverseBindMatrices": len(gltf_data['accessors']), "joints": bone_palette})
-                    gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                        "componentType": 5126,\
-                        "count": geoms[i]['num_bones'],\
-                        "type": "MAT4"})
-                    gltf_data['bufferViews'].append({"buffer": 0,\
-                        "byteOffset": len(giant_buffer),\
-                        "byteLength": len(bind_matrix_buffer)})
-                    giant_buffer += bind_matrix_buffer
-                if write_raw_buffers == True and overwrite_buffers == True:
-                    write_fmt(fmt, "{0}/{1:02d}_{2}.fmt".format(imdl_file[:-4], i, geoms[i]['name']))
-                    write_vb(vb, "{0}/{1:02d}_{2}.vb".format(imdl_file[:-4], i, geoms[i]['name']), fmt)
-                    write_ib(combined_ib, "{0}/{1:02d}_{2}.ib".format(imdl_file[:-4], i, geoms[i]['name']), fmt)
-                    with open("{0}/{1:02d}_{2}.vgmap".format(imdl_file[:-4], i, geoms[i]['name']), 'wb') as ff:
-                        ff.write(json.dumps(vgmap, indent=4).encode('utf-8'))
-            # Write GLB
-            gltf_data['buffers'].append({"byteLength": len(giant_buffer)})
-            if (os.path.exists(imdl_file[:-4] + '.gltf') or os.path.exists(imdl_file[:-4] + '.glb')) and (overwrite == False):
-                if str(input(imdl_file[:-4] + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
-                    overwrite = True
-            if (overwrite == True) or not (os.path.exists(imdl_file[:-4] + '.gltf') or os.path.exists(imdl_file[:-4] + '.glb')):
-                if write_binary_gltf == True:
-                    with open(imdl_file[:-4]+'.glb', 'wb') as f:
-                        jsondata = json.dumps(gltf_data).encode('utf-8')
-                        jsondata += b' ' * (4 - len(jsondata) % 4)
-                        f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(giant_buffer)))
-                        f.write(struct.pack('<II', len(jsondata), 1313821514))
-                        f.write(jsondata)
-                        f.write(struct.pack('<II', len(giant_buffer), 5130562))
-                        f.write(giant_buffer)
-                else:
-                    gltf_data['buffers'][0]["uri"] = imdl_file[:-4]+'.bin'
-                    with open(imdl_file[:-4]+'.bin', 'wb') as f:
-                        f.write(giant_buffer)
-                    with open(imdl_file[:-4]+'.gltf', 'wb') as f:
-                        f.write(json.dumps(gltf_data, indent=4).encode("utf-8"))
+            if selection['geoms'] is None:
+                selected_geoms = list(range(len(geoms)))
+            else:
+                selected_geoms = [i for i in range(len(geoms)) if geoms[i]['name'] in selection['geoms']]
+                missing_geoms = [x for x in selection['geoms'] if not x in [y['name'] for y in geoms]]
+                if len(missing_geoms) > 0 and log is not None:
+                    log("Geoms not found in {0}: {1}".format(imdl_file, ', '.join(missing_geoms)))
+            skin_joints = None
+            if merge_skins == True:
+                try:
+                    skin_joints, bind_matrix_buffer = read_model_skin(f, [geoms[i] for i in selected_geoms], shapes, block_offsets)
+                except ValueError as e:
+                    if log is not None:
+                        log("Keeping a skin per geom in {0}: {1}".format(imdl_file, e))
+            low_memory = False
+            if memory_budget is not None:
+                projected = project_imdl_memory(stream_size(f), shapes, [geoms[i] for i in selected_geoms], meshes) + memory_in_use()
+                if projected > memory_budget:
+                    low_memory = True
+                    add_count(profile, 'streamed')
+                    if log is not None:
+                        log("{0} is projected to need {1:.1f} MiB, over the budget of {2:.1f} MiB; decoding with low memory."\
+                            .format(imdl_file, projected / 1048576, memory_budget / 1048576))
+                    if batch == True:
+                        # Batching reads the merged buffer back, so it stays in memory
+                        if log is not None:
+                            log("The buffer of {} is kept in memory for batching.".format(imdl_file))
+                    else:
+                        giant_buffer = tempfile.TemporaryFile()
+            geom_args = [(i, geoms[i], shapes[geoms[i]['vertex_buffer']],\
+                meshes[geoms[i]['first_index_buffer']:geoms[i]['first_index_buffer'] + geoms[i]['num_index_buffers']],\
+                block_offsets, node_list, raw_buffer_folder, lod_levels, lod_ratio, skin_joints) for i in selected_geoms]
+            if geom_workers > 1 and len(geom_args) > 1 and low_memory == False:
+                # Geoms are decoded by worker processes, and merged in order so the output is the same
+                from concurrent.futures import ProcessPoolExecutor
+                f.seek(0)
+                with ProcessPoolExecutor(max_workers = geom_workers, initializer = _init_geom_worker, initargs = (f.read(),)) as pool:
+                    geom_results = pool.map(_process_geom_worker, [x + (profile is not None,) for x in geom_args])
+                    for i, (geom_gltf, geom_profile) in zip(selected_geoms, geom_results):
+                        merge_profile(profile, geom_profile)
+                        log_lods(geoms[i], geom_gltf, log)
+                        giant_buffer = merge_geom(gltf_data, giant_buffer, geoms[i], geom_gltf)
+            else:
+                for args in geom_args:
+                    geom_gltf = process_geom(f, *args, profile = profile, low_memory = low_memory)
+                    log_lods(args[1], geom_gltf, log)
+                    giant_buffer = merge_geom(gltf_data, giant_buffer, args[1], geom_gltf)
+            if skin_joints is not None and len(skin_joints) > 0:
+                gltf_data['skins'].append({"inverseBindMatrices": len(gltf_data['accessors']), "joints": skin_joints})
+                gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+                    "componentType": 5126,\
+                    "count": len(skin_joints),\
+                    "type": "MAT4"})
+                gltf_data['bufferViews'].append({"buffer": 0,\
+                    "byteOffset": buffer_length(giant_buffer),\
+                    "byteLength": len(bind_matrix_buffer)})
+                giant_buffer = append_buffer(giant_buffer, bind_matrix_buffer)
+            if batch == True and len(gltf_data['meshes']) > 0:
+                giant_buffer = batch_primitives(gltf_data, giant_buffer, profile, log)
+            # Embedded textures
+            if embed_textures == True:
+                png_images = find_txp_textures(os.path.dirname(imdl_file) if txp_folder is None else txp_folder,\
+                    image_names, texture_cache, profile, log)
+                for i in range(len(image_names)):
+                    if image_names[i] in png_images:
+                        giant_buffer = append_buffer(giant_buffer, b'\x00' * (-buffer_length(giant_buffer) % 4))
+                        gltf_data['images'][i] = {'name': image_files[i], 'mimeType': 'image/png',\
+                            'bufferView': len(gltf_data['bufferViews'])}
+                        gltf_data['bufferViews'].append({"buffer": 0,\
+                            "byteOffset": buffer_length(giant_buffer),\
+                            "byteLength": len(png_images[image_names[i]])})
+                        giant_buffer = append_buffer(giant_buffer, png_images[image_names[i]])
+                    elif log is not None:
+                        log("Texture {} not found in any .txp file, leaving it as an external image.".format(image_names[i]))
+                add_count(profile, 'embedded_textures', len(png_images))
+            gltf_data['buffers'].append({"byteLength": buffer_length(giant_buffer)})
+            return(gltf_data, giant_buffer)
+    return(None)
+
+def process_imdl (imdl_file, write_raw_buffers = False, write_binary_gltf = True, overwrite = False, profile = None, data = None,\
+        writer = None, embed_textures = False, texture_cache = None, geom_workers = 1, only = None, lod_levels = 0,\
+        lod_ratio = 0.5, merge_skins = False, batch = False, names = None, memory_budget = None):
+    # imdl_file names the outputs; if data (bytes or a binary stream) is given, it is read instead of the file.
+    # only selects part of the model, see parse_selection().  lod_levels adds levels of detail, see process_geom().
+    print("Processing {}...".format(imdl_file))
+    raw_buffer_folder = None
+    if write_raw_buffers == True:
+        overwrite_buffers = copy.deepcopy(overwrite)
+        if os.path.exists(imdl_file[:-4]) and (os.path.isdir(imdl_file[:-4])) and (overwrite_buffers == False):
+            if str(input(imdl_file[:-4] + " folder exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
+                overwrite_buffers = True
+        if (overwrite_buffers == True) or not os.path.exists(imdl_file[:-4]):
+            if not os.path.exists(imdl_file[:-4]):
+                os.mkdir(imdl_file[:-4])
+            raw_buffer_folder = imdl_file[:-4]
+    gltf = build_imdl_gltf(imdl_file, data = data, profile = profile, only = only, embed_textures = embed_textures,\
+        texture_cache = texture_cache, geom_workers = geom_workers, raw_buffer_folder = raw_buffer_folder,\
+        choose_texture = ask_texture_choice if ask_if_texture_does_not_match == True else None, log = print,\
+        lod_levels = lod_levels, lod_ratio = lod_ratio, merge_skins = merge_skins,\
+        batch = batch, names = names, memory_budget = memory_budget)
+    if gltf is not None:
+        gltf_data, giant_buffer = gltf
+        buffer_size = buffer_length(giant_buffer)
+        # Write GLB
+        if (os.path.exists(imdl_file[:-4] + '.gltf') or os.path.exists(imdl_file[:-4] + '.glb')) and (overwrite == False):
+            if str(input(imdl_file[:-4] + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
+                overwrite = True
+        if (overwrite == True) or not (os.path.exists(imdl_file[:-4] + '.gltf') or os.path.exists(imdl_file[:-4] + '.glb')):
+            if write_binary_gltf == True:
+                with profile_stage(profile, 'json_encoding'):
+                    jsondata = json.dumps(gltf_data).encode('utf-8')
+                    jsondata += b' ' * (4 - len(jsondata) % 4)
+                glb_chunks = [struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + buffer_size),\
+                    struct.pack('<II', len(jsondata), 1313821514), jsondata, struct.pack('<II', buffer_size, 5130562)]
+                with profile_stage(profile, 'file_write'):
+                    if isinstance(giant_buffer, bytes):
+                        write_output(writer, imdl_file[:-4]+'.glb', glb_chunks + [giant_buffer])
+                    else:
+                        write_output_stream(writer, imdl_file[:-4]+'.glb', glb_chunks, giant_buffer)
+                add_bytes(profile, 'written', 28 + len(jsondata) + buffer_size)
+            else:
+                gltf_data['buffers'][0]["uri"] = imdl_file[:-4]+'.bin'
+                with profile_stage(profile, 'json_encoding'):
+                    jsondata = json.dumps(gltf_data, indent=4).encode("utf-8")
+                with profile_stage(profile, 'file_write'):
+                    if isinstance(giant_buffer, bytes):
+                        write_output(writer, imdl_file[:-4]+'.bin', giant_buffer)
+                    else:
+                        write_output_stream(writer, imdl_file[:-4]+'.bin', [], giant_buffer)
+                    write_output(writer, imdl_file[:-4]+'.gltf', jsondata)
+                add_bytes(profile, 'written', len(jsondata) + buffer_size)
+        if not isinstance(giant_buffer, bytes):
+            giant_buffer.close()
     return
 
 if __name__ == "__main__":
@@ -449,12 +982,70 @@ if __name__ == "__main__":
         parser.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
         parser.add_argument('-d', '--dumprawbuffers', help="Write fmt/ib/vb/vgmap files in addition to glb", action="store_true")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
-        parser.add_argument('imdl_filename', help="Name of imdl file to export from (required).")
+        parser.add_argument('-e', '--embedtextures', help="Embed the textures from the .txp files in the folder instead of linking to .png files", action="store_true")
+        parser.add_argument('-p', '--profile', help="Write per-stage timings to a JSON report (added to the report if it exists)")
+        parser.add_argument('--only', help="Only export part of the model: nodes (the skeleton), materials or geoms=<name>,<name>,... (can be repeated)",\
+            action = 'append', metavar = 'SELECTION')
+        parser.add_argument('-g', '--geom-workers', help="Number of processes decoding the geoms of each model (default: 1)",\
+            type = int, default = 1)
+        parser.add_argument('--lods', help="Number of simplified levels of detail to add to each mesh (MSFT_lod, default: 0)",\
+            type = int, default = 0)
+        parser.add_argument('--lod-ratio', help="Fraction of the triangles kept by each level of detail (default: 0.5)",\
+            type = float, default = 0.5)
+        parser.add_argument('--merge-skins', help="Use one skin for the whole model instead of one per mesh", action="store_true")
+        parser.add_argument('--batch', help="Merge the meshes that share a material (and skin) to save draw calls", action="store_true")
+        parser.add_argument('--names', help="Name index to name the textures from (default: {})".format(default_names_file),\
+            default = default_names_file)
+        parser.add_argument('--memory-budget', help="Memory budget in MiB: models projected to need more are decoded with low memory, and the peak memory of each file is reported",\
+            type = float)
+        parser.add_argument('--writer-threads', help="Number of background writer threads, 0 to write in order (default: 2)",\
+            type = int, default = 2)
+        parser.add_argument('imdl_filename', nargs='?', help="Name of imdl file to export from (default: all .mdl files in the folder).")
         args = parser.parse_args()
-        if os.path.exists(args.imdl_filename) and args.imdl_filename[-4:].lower() == '.mdl':
-            process_imdl(args.imdl_filename, write_raw_buffers = args.dumprawbuffers,\
-                write_binary_gltf = args.textformat, overwrite = args.overwrite)
+        try:
+            parse_selection(args.only)
+        except ValueError as e:
+            parser.error(str(e))
+        if not (args.lods >= 0 and 0 < args.lod_ratio < 1):
+            parser.error("--lods must be 0 or more and --lod-ratio between 0 and 1")
+        if args.batch and args.lods > 0:
+            parser.error("--batch cannot be combined with --lods")
+        if args.imdl_filename is None:
+            imdl_files = glob.glob('*.mdl')
+        elif os.path.exists(args.imdl_filename) and args.imdl_filename[-4:].lower() == '.mdl':
+            imdl_files = [args.imdl_filename]
+        else:
+            imdl_files = []
+        names = load_name_index(args.names)
+        memory_budget = int(args.memory_budget * 1048576) if args.memory_budget is not None else None
+        if memory_budget is not None:
+            # Files are read as they are decoded instead of ahead, and fewer writes are queued
+            start_memory_tracking()
+            inputs = [(x, None) for x in imdl_files]
+            writer = start_writer(args.writer_threads, memory_budget // 4) if args.writer_threads > 0 else None
+        else:
+            inputs = prefetch_inputs(imdl_files)
+            writer = start_writer(args.writer_threads) if args.writer_threads > 0 else None
+        profiles = []
+        texture_cache = {}
+        for imdl_file, imdl_data in inputs:
+            profile = new_profile(imdl_file, 'vato_extract_imdl') if args.profile or memory_budget is not None else None
+            process_imdl(imdl_file, write_raw_buffers = args.dumprawbuffers, write_binary_gltf = args.textformat,\
+                overwrite = args.overwrite, profile = profile, data = imdl_data, writer = writer,\
+                embed_textures = args.embedtextures, texture_cache = texture_cache, geom_workers = args.geom_workers,\
+                only = args.only, lod_levels = args.lods, lod_ratio = args.lod_ratio, merge_skins = args.merge_skins,\
+                batch = args.batch, names = names, memory_budget = memory_budget)
+            if profile is not None:
+                profiles.append(profile)
+        finish_writer(writer)
+        if memory_budget is not None:
+            print_memory_summary(profiles, memory_budget)
+        if args.profile:
+            write_profile_report(profiles, args.profile)
     else:
         imdl_files = glob.glob('*.mdl')
-        for i in range(len(imdl_files)):
-            process_imdl(imdl_files[i])
+        names = load_name_index()
+        writer = start_writer()
+        for imdl_file, imdl_data in prefetch_inputs(imdl_files):
+            process_imdl(imdl_file, data = imdl_data, writer = writer, names = names)
+        finish_writer(writer)
@@ -11,6 +11,9 @@
 
 try:
     import struct, json, glob, numpy, os, sys
+    from lib_vato_profile import *
+    from lib_vato_io import *
+    from lib_vato_container import imdl_block_names, imtn_block_names, read_container, seek_section, read_from_string_dictionary
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
@@ -18,16 +21,7 @@ except ModuleNotFoundError as e:
 
 ani_fps = 24
 
-def read_from_string_dictionary (f, start_offset):
-    current_loc = f.tell()
-    f.seek(start_offset)
-    null_term_string = f.read(1)
-    while null_term_string[-1] != 0:
-        null_term_string += f.read(1)
-    f.seek(current_loc)
-    return(null_term_string[:-1].decode())
-
-def obtain_skeleton_from_imdl (imdl_file):
+def obtain_skeleton_from_imdl (imdl_file, data = None):
     def add_child_to_node (nodes, i):
         current_node = i
         nodes[i]['children'] = []
@@ -37,29 +31,22 @@ def obtain_skeleton_from_imdl (imdl_file):
             nodes, i = add_child_to_node(nodes, i)
         return (nodes, i)
     nodes = []
-    with open(imdl_file, "rb") as f:
-        magic = f.read(4)
-        if magic == b'IMDL':
-            unk0, unk1, unk2, num_sections = struct.unpack("<4H", f.read(8))
-            block_offsets = {}
-            block_offsets["dictionary"], block_offsets["blend_indices"], block_offsets["triangles"],\
-                block_offsets["unknown_blanks"], block_offsets["vertices"] = struct.unpack("<5I", f.read(20))
-            while f.tell() < block_offsets["dictionary"]:
-                section_magic = f.read(4)
-                section_size, = struct.unpack("<I", f.read(4))
-                if section_magic == b'node':
-                    num_sections, num_nodes = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_nodes):
-                        node = {}
-                        string_offset, = struct.unpack("<I", f.read(4))
-                        node['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
-                        node['unk1'], = struct.unpack("<f", f.read(4))
-                        node['matrix'] = list(struct.unpack("<16f", f.read(64)))
-                        node['num_children'], node['postorder_traversal'] = struct.unpack("<2I", f.read(8))
-                        nodes.append(node)
-                    nodes, _ = add_child_to_node(nodes, 0)
-                else:
-                    f.seek(section_size - 8, 1)
+    with open_input(imdl_file, data) as f:
+        container = read_container(f)
+        if container is not None and container['magic'] == b'IMDL':
+            block_offsets = dict(zip(imdl_block_names, container['block_offsets']))
+            # Only the node tree is read
+            if b'node' in container['sections']:
+                num_nodes = seek_section(f, container, b'node')
+                for _ in range(num_nodes):
+                    node = {}
+                    string_offset, = struct.unpack("<I", f.read(4))
+                    node['name'] = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
+                    node['unk1'], = struct.unpack("<f", f.read(4))
+                    node['matrix'] = list(struct.unpack("<16f", f.read(64)))
+                    node['num_children'], node['postorder_traversal'] = struct.unpack("<2I", f.read(8))
+                    nodes.append(node)
+                nodes, _ = add_child_to_node(nodes, 0)
     skel_struct = []
     for i in range(len(nodes)):
         g_node = {'name': nodes[i]['name']}
@@ -70,9 +57,24 @@ def obtain_skeleton_from_imdl (imdl_file):
         skel_struct.append(g_node)
     return(skel_struct)
 
-def process_imtn (imtn_file, skel_struct, write_binary_gltf = True, overwrite = False):
-    global ani_fps
-    print("Processing {}...".format(imtn_file))
+def read_visK (imtn_file, data = None, profile = None):
+    # Returns the visK records (node name and the three values after it), which are not used for glTF
+    visK_blocks = []
+    with open_input(imtn_file, data) as f:
+        container = read_container(f)
+        if container is not None and b'visK' in container['sections']:
+            with profile_stage(profile, 'section_parse'):
+                num_visK_data = seek_section(f, container, b'visK')
+                for _ in range(num_visK_data):
+                    string_offset, = struct.unpack("<I", f.read(4))
+                    node_name = read_from_string_dictionary (f, container['block_offsets'][0] + string_offset, profile)
+                    visK_data = struct.unpack("<3I", f.read(12))
+                    visK_blocks.append([node_name,visK_data])
+    return(visK_blocks)
+
+def build_imtn_gltf (imtn_file, skel_struct, data = None, profile = None, fps = ani_fps):
+    # Decodes the animation into a glTF document and its binary buffer, and returns (gltf_data, buffer),
+    # or None if it is not an IMTN file.  Nothing is written or asked.
     gltf_data = {}
     gltf_data['asset'] = { 'version': '2.0' }
     gltf_data['accessors'] = []
@@ -86,105 +88,229 @@ def process_imtn (imtn_file, skel_struct, write_binary_gltf = True, overwrite =
     gltf_data['skins'] = []
     giant_buffer = bytes()
     buffer_view = 0
-    with open(imtn_file, "rb") as f:
-        magic = f.read(4)
-        if magic == b'IMTN':
-            unk0, unk1, unk2, num_sections = struct.unpack("<4H", f.read(8))
-            block_offsets = {}
-            #block 1 is unknown - may visK data
-            #block 2 is keyframes
-            #block 3 is actually empty in my sample file (same offset as block 4)
-            #block 4 is animation data (TRS)
-            block_offsets["dictionary"], block_offsets["block1"], block_offsets["times"],\
-                block_offsets["block3"], block_offsets["trs_vals"] = struct.unpack("<5I", f.read(20))
-            while f.tell() < block_offsets["dictionary"]:
-                section_magic = f.read(4)
-                section_size, = struct.unpack("<I", f.read(4))
-                if section_magic == b'nodK':
-                    keyframes = []
-                    num_sections, num_keyframes = struct.unpack("<2I", f.read(8))
+    with open_input(imtn_file, data) as f:
+        add_bytes(profile, 'read', stream_size(f))
+        with profile_stage(profile, 'section_parse'):
+            container = read_container(f)
+        if container is not None and container['magic'] == b'IMTN':
+            block_offsets = dict(zip(imtn_block_names, container['block_offsets']))
+            # Only nodK is decoded, see read_visK() for visK.  smpK is not understood yet.
+            with profile_stage(profile, 'section_parse'):
+                keyframes = []
+                if b'nodK' in container['sections']:
+                    num_keyframes = seek_section(f, container, b'nodK')
                     for _ in range(num_keyframes):
                         string_offset, = struct.unpack("<I", f.read(4))
-                        node_name = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
+                        node_name = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset, profile)
                         kf_data = struct.unpack("<4I", f.read(16))
                         keyframes.append({'node_name': node_name, 'num_keyframes': kf_data[0], 'times': kf_data[1],
                             'channel': kf_data[2], 'trs_values': kf_data[3]})
-                if section_magic == b'visK':
-                    visK_blocks = []
-                    num_sections, num_visK_data = struct.unpack("<2I", f.read(8))
-                    for _ in range(num_visK_data):
-                        string_offset, = struct.unpack("<I", f.read(4))
-                        node_name = read_from_string_dictionary (f, block_offsets["dictionary"] + string_offset)
-                        visK_data = struct.unpack("<3I", f.read(12))
-                        visK_blocks.append([node_name,visK_data])
             ani_struct = []
-            for i in range(len(keyframes)):
-                ani_block = {'bone': keyframes[i]['node_name'], 'channel': {2:'translation', 14:'rotation'}[keyframes[i]['channel']]}
-                f.seek(block_offsets["times"] + keyframes[i]['times'] * 2)
-                times = struct.unpack("<{}H".format(keyframes[i]['num_keyframes']),
-                    f.read(keyframes[i]['num_keyframes']*2))
-                ani_block['inputs'] = [float(x) / ani_fps for x in times]
-                f.seek(block_offsets["trs_vals"] + keyframes[i]['trs_values'] * 4)
-                ani_block['outputs'] = []
-                num_vals = {2:3, 14:4}[keyframes[i]['channel']]
-                for _ in range(keyframes[i]['num_keyframes']):
-                    ani_block['outputs'].append(list(struct.unpack("<{}f".format(num_vals), f.read(num_vals*4))))
-                ani_struct.append(ani_block)
+            with profile_stage(profile, 'keyframe_decode'):
+                for i in range(len(keyframes)):
+                    ani_block = {'bone': keyframes[i]['node_name'], 'channel': {2:'translation', 14:'rotation'}[keyframes[i]['channel']]}
+                    f.seek(block_offsets["times"] + keyframes[i]['times'] * 2)
+                    times = struct.unpack("<{}H".format(keyframes[i]['num_keyframes']),
+                        f.read(keyframes[i]['num_keyframes']*2))
+                    ani_block['inputs'] = [float(x) / fps for x in times]
+                    f.seek(block_offsets["trs_vals"] + keyframes[i]['trs_values'] * 4)
+                    ani_block['outputs'] = []
+                    num_vals = {2:3, 14:4}[keyframes[i]['channel']]
+                    for _ in range(keyframes[i]['num_keyframes']):
+                        ani_block['outputs'].append(list(struct.unpack("<{}f".format(num_vals), f.read(num_vals*4))))
+                    ani_struct.append(ani_block)
+                    add_count(profile, 'channels')
+                    add_count(profile, 'keys', keyframes[i]['num_keyframes'])
             node_dict = {gltf_data['nodes'][j]['name']:j for j in range(len(gltf_data['nodes']))}
-            for i in range(len(ani_struct)):
-                if ani_struct[i]['bone'] in node_dict.keys():
-                    sampler = { 'input': len(gltf_data['accessors']), 'interpolation': 'LINEAR', 'output':  len(gltf_data['accessors'])+1 }
-                    channel = { 'sampler': len(gltf_data['animations'][0]['samplers']),\
-                        'target': { 'node': node_dict[ani_struct[i]['bone']],\
-                        'path': ani_struct[i]['channel'] } }
-                    gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                        "componentType": 5126,\
-                        "count": len(ani_struct[i]['inputs']),\
-                        "type": 'SCALAR',\
-                        "max": [max(ani_struct[i]['inputs'])], "min": [min(ani_struct[i]['inputs'])]})
-                    input_buffer = numpy.array(ani_struct[i]['inputs'],dtype='float32').tobytes()
-                    gltf_data['bufferViews'].append({"buffer": 0,\
-                        "byteOffset": len(giant_buffer),\
-                        "byteLength": len(input_buffer)})
-                    giant_buffer += input_buffer
-                    gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                        "componentType": 5126,\
-                        "count": len(ani_struct[i]['outputs']),\
-                        "type": {'translation':'VEC3', 'rotation':'VEC4', 'scale':'VEC3'}[ani_struct[i]['channel']]})
-                    output_buffer = numpy.array(ani_struct[i]['outputs'],dtype='float32').tobytes()
-                    gltf_data['bufferViews'].append({"buffer": 0,\
-                        "byteOffset": len(giant_buffer),\
-                        "byteLength": len(output_buffer)})
-                    giant_buffer +=output_buffer
-                    gltf_data['animations'][0]['channels'].append(channel)
-                    gltf_data['animations'][0]['samplers'].append(sampler)
+            with profile_stage(profile, 'buffer_packing'):
+                for i in range(len(ani_struct)):
+                    if ani_struct[i]['bone'] in node_dict.keys():
+                        sampler = { 'input': len(gltf_data['accessors']), 'interpolation': 'LINEAR', 'output':  len(gltf_data['accessors'])+1 }
+                        channel = { 'sampler': len(gltf_data['animations'][0]['samplers']),\
+                            'target': { 'node': node_dict[ani_struct[i]['bone']],\
+                            'path': ani_struct[i]['channel'] } }
+                        gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+                            "componentType": 5126,\
+                            "count": len(ani_struct[i]['inputs']),\
+                            "type": 'SCALAR',\
+                            "max": [max(ani_struct[i]['inputs'])], "min": [min(ani_struct[i]['inputs'])]})
+                        input_buffer = numpy.array(ani_struct[i]['inputs'],dtype='float32').tobytes()
+                        gltf_data['bufferViews'].append({"buffer": 0,\
+                            "byteOffset": len(giant_buffer),\
+                            "byteLength": len(input_buffer)})
+                        giant_buffer += input_buffer
+                        gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+                            "componentType": 5126,\
+                            "count": len(ani_struct[i]['outputs']),\
+                            "type": {'translation':'VEC3', 'rotation':'VEC4', 'scale':'VEC3'}[ani_struct[i]['channel']]})
+                        output_buffer = numpy.array(ani_struct[i]['outputs'],dtype='float32').tobytes()
+                        gltf_data['bufferViews'].append({"buffer": 0,\
+                            "byteOffset": len(giant_buffer),\
+                            "byteLength": len(output_buffer)})
+                        giant_buffer +=output_buffer
+                        gltf_data['animations'][0]['channels'].append(channel)
+                        gltf_data['animations'][0]['samplers'].append(sampler)
             skin = {}
             skin['skeleton'] = 0
             joints = [i for i in range(len(gltf_data['nodes'])) if i != 0]
             if len(joints) > 0:
                 skin['joints'] = joints
             gltf_data['skins'].append(skin)
-            # Write GLB
             gltf_data['buffers'].append({"byteLength": len(giant_buffer)})
-            if (os.path.exists(imtn_file[:-4] + '.gltf') or os.path.exists(imtn_file[:-4] + '.glb')) and (overwrite == False):
-                if str(input(imtn_file[:-4] + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
-                    overwrite = True
-            if (overwrite == True) or not (os.path.exists(imtn_file[:-4] + '.gltf') or os.path.exists(imtn_file[:-4] + '.glb')):
-                if write_binary_gltf == True:
-                    with open(imtn_file[:-4]+'.glb', 'wb') as f:
-                        jsondata = json.dumps(gltf_data).encode('utf-8')
-                        jsondata += b' ' * (4 - len(jsondata) % 4)
-                        f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(giant_buffer)))
-                        f.write(struct.pack('<II', len(jsondata), 1313821514))
-                        f.write(jsondata)
-                        f.write(struct.pack('<II', len(giant_buffer), 5130562))
-                        f.write(giant_buffer)
-                else:
-                    gltf_data['buffers'][0]["uri"] = imtn_file[:-4]+'.bin'
-                    with open(imtn_file[:-4]+'.bin', 'wb') as f:
-                        f.write(giant_buffer)
-                    with open(imtn_file[:-4]+'.gltf', 'wb') as f:
-                        f.write(json.dumps(gltf_data, indent=4).encode("utf-8"))
+            return(gltf_data, giant_buffer)
+    return(None)
+
+def matrix_to_trs (matrix):
+    # Splits a glTF node matrix (column-major) into translation, rotation (x, y, z, w) and scale
+    m = numpy.array(matrix, dtype = 'float64').reshape(4,4).T
+    scale = numpy.linalg.norm(m[:3,:3], axis = 0)
+    r = m[:3,:3] / numpy.where(scale > 0, scale, 1)
+    trace = r[0,0] + r[1,1] + r[2,2]
+    if trace > 0:
+        s = 2 * numpy.sqrt(trace + 1)
+        rotation = [(r[2,1] - r[1,2]) / s, (r[0,2] - r[2,0]) / s, (r[1,0] - r[0,1]) / s, s / 4]
+    elif r[0,0] > r[1,1] and r[0,0] > r[2,2]:
+        s = 2 * numpy.sqrt(1 + r[0,0] - r[1,1] - r[2,2])
+        rotation = [s / 4, (r[0,1] + r[1,0]) / s, (r[0,2] + r[2,0]) / s, (r[2,1] - r[1,2]) / s]
+    elif r[1,1] > r[2,2]:
+        s = 2 * numpy.sqrt(1 + r[1,1] - r[0,0] - r[2,2])
+        rotation = [(r[0,1] + r[1,0]) / s, s / 4, (r[1,2] + r[2,1]) / s, (r[0,2] - r[2,0]) / s]
+    else:
+        s = 2 * numpy.sqrt(1 + r[2,2] - r[0,0] - r[1,1])
+        rotation = [(r[0,2] + r[2,0]) / s, (r[1,2] + r[2,1]) / s, s / 4, (r[1,0] - r[0,1]) / s]
+    return(m[:3,3], numpy.array(rotation), scale)
+
+def quaternions_to_matrices (q):
+    # q is (..., 4) in x, y, z, w order; returns (..., 3, 3) rotation matrices
+    q = q / numpy.linalg.norm(q, axis = -1, keepdims = True)
+    x, y, z, w = q[...,0], q[...,1], q[...,2], q[...,3]
+    return(numpy.stack([numpy.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis = -1),\
+        numpy.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis = -1),\
+        numpy.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis = -1)], axis = -2))
+
+def sample_channel (inputs, outputs, times, rotation = False):
+    # Linear interpolation of a glTF sampler at the given times (spherical for rotations),
+    # holding the first and last keys outside of the animation
+    i = numpy.clip(numpy.searchsorted(inputs, times, side = 'right') - 1, 0, len(inputs) - 1)
+    j = numpy.minimum(i + 1, len(inputs) - 1)
+    span = inputs[j] - inputs[i]
+    a = numpy.clip((times - inputs[i]) / numpy.where(span > 0, span, 1), 0, 1)[:,None]
+    v0, v1 = outputs[i], outputs[j]
+    if rotation == False:
+        return(v0 + (v1 - v0) * a)
+    dot = numpy.sum(v0 * v1, axis = -1, keepdims = True)
+    v1 = numpy.where(dot < 0, -v1, v1)
+    dot = numpy.abs(dot)
+    theta = numpy.arccos(numpy.clip(dot, 0, 1))
+    sin_theta = numpy.sin(theta)
+    # Nearly identical rotations are interpolated linearly
+    close = sin_theta < 1e-6
+    w0 = numpy.where(close, 1 - a, numpy.sin((1 - a) * theta) / numpy.where(close, 1, sin_theta))
+    w1 = numpy.where(close, a, numpy.sin(a * theta) / numpy.where(close, 1, sin_theta))
+    q = w0 * v0 + w1 * v1
+    return(q / numpy.linalg.norm(q, axis = -1, keepdims = True))
+
+def bake_joint_palette (gltf_data, buffer, sample_rate = ani_fps):
+    # Evaluates the animation of a glTF from build_imtn_gltf() at sample_rate frames per second.
+    # Returns the sample times and the world-space matrix of every node at every frame, as a
+    # (frames, nodes, 4, 4) array (row-major, i.e. transposed from glTF).
+    nodes = gltf_data['nodes']
+    parents = [-1] * len(nodes)
+    for i in range(len(nodes)):
+        for child in nodes[i].get('children', []):
+            parents[child] = i
+    rest = [matrix_to_trs(x['matrix'] if 'matrix' in x else [1.0,0.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,0.0,1.0])\
+        for x in nodes]
+    def read_accessor (accessor_index):
+        accessor = gltf_data['accessors'][accessor_index]
+        buffer_view = gltf_data['bufferViews'][accessor['bufferView']]
+        width = {'SCALAR': 1, 'VEC3': 3, 'VEC4': 4}[accessor['type']]
+        return(numpy.frombuffer(buffer, dtype = '<f4', count = accessor['count'] * width,\
+            offset = buffer_view['byteOffset']).reshape(accessor['count'], width).astype('float64'))
+    channels = []
+    for animation in gltf_data.get('animations', []):
+        for channel in animation['channels']:
+            sampler = animation['samplers'][channel['sampler']]
+            channels.append((channel['target']['node'], channel['target']['path'],\
+                read_accessor(sampler['input'])[:,0], read_accessor(sampler['output'])))
+    duration = max([x[2][-1] for x in channels if len(x[2]) > 0] + [0])
+    times = numpy.arange(int(numpy.floor(duration * sample_rate + 1e-6)) + 1) / sample_rate
+    translation = numpy.broadcast_to(numpy.array([x[0] for x in rest]), (len(times), len(nodes), 3)).copy()
+    rotation = numpy.broadcast_to(numpy.array([x[1] for x in rest]), (len(times), len(nodes), 4)).copy()
+    scale = numpy.broadcast_to(numpy.array([x[2] for x in rest]), (len(times), len(nodes), 3)).copy()
+    for node, path, inputs, outputs in channels:
+        if len(inputs) > 0:
+            {'translation': translation, 'rotation': rotation, 'scale': scale}[path][:,node]\
+                = sample_channel(inputs, outputs, times, rotation = (path == 'rotation'))
+    # Local matrices of every node at every frame at once
+    local = numpy.zeros((len(times), len(nodes), 4, 4))
+    local[:,:,:3,:3] = quaternions_to_matrices(rotation) * scale[:,:,None,:]
+    local[:,:,:3,3] = translation
+    local[:,:,3,3] = 1
+    # Then down the hierarchy, all the nodes at the same depth at once
+    depth = [0] * len(nodes)
+    for i in range(len(nodes)):
+        if parents[i] >= 0:
+            depth[i] = depth[parents[i]] + 1 # Parents are listed before their children
+    world = local.copy()
+    for level in range(1, max(depth + [0]) + 1):
+        level_nodes = [i for i in range(len(nodes)) if depth[i] == level]
+        world[:,level_nodes] = world[:,[parents[i] for i in level_nodes]] @ local[:,level_nodes]
+    return(times, world)
+
+def make_joint_palette (gltf_data, buffer, sample_rate = ani_fps, palette_format = 'float16', profile = None):
+    # Returns the palette and its .json sidecar.  Each joint is stored as the top three rows of its
+    # world matrix (a 3x4 affine matrix), so a frame is one row of 3 RGBA texels per joint: the
+    # palette can be uploaded as a (joints * 3) x frames RGBA texture.  Skinning still needs the
+    # inverse bind matrices of the mesh.
+    with profile_stage(profile, 'palette_bake'):
+        times, world = bake_joint_palette(gltf_data, buffer, sample_rate)
+        palette = world[:,:,:3,:].astype({'float16': '<f2', 'float32': '<f4'}[palette_format]).tobytes()
+    add_count(profile, 'palette_frames', len(times))
+    sidecar = {'format': palette_format, 'sample_rate': sample_rate, 'num_frames': len(times),\
+        'num_joints': world.shape[1], 'joints': [x['name'] for x in gltf_data['nodes']],\
+        'texture_width': world.shape[1] * 3, 'texture_height': len(times), 'layout': 'RGBA, 3x4 row-major world matrix per joint'}
+    return(palette, json.dumps(sidecar, indent=4).encode('utf-8'))
+
+def process_imtn (imtn_file, skel_struct, write_binary_gltf = True, overwrite = False, profile = None, data = None,\
+        writer = None, palette_format = None, palette_rate = None):
+    # imtn_file names the outputs; if data (bytes or a binary stream) is given, it is read instead of the file.
+    # With palette_format (float16 or float32), the baked joint matrices are also written, sampled at
+    # palette_rate frames per second (by default the frame rate of the animation).
+    print("Processing {}...".format(imtn_file))
+    gltf = build_imtn_gltf(imtn_file, skel_struct, data = data, profile = profile, fps = ani_fps)
+    if gltf is not None:
+        gltf_data, giant_buffer = gltf
+        # Write GLB
+        if (os.path.exists(imtn_file[:-4] + '.gltf') or os.path.exists(imtn_file[:-4] + '.glb')) and (overwrite == False):
+            if str(input(imtn_file[:-4] + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
+                overwrite = True
+        if (overwrite == True) or not (os.path.exists(imtn_file[:-4] + '.gltf') or os.path.exists(imtn_file[:-4] + '.glb')):
+            if write_binary_gltf == True:
+                with profile_stage(profile, 'json_encoding'):
+                    jsondata = json.dumps(gltf_data).encode('utf-8')
+                    jsondata += b' ' * (4 - len(jsondata) % 4)
+                with profile_stage(profile, 'file_write'):
+                    write_output(writer, imtn_file[:-4]+'.glb',\
+                        [struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(giant_buffer)),\
+                        struct.pack('<II', len(jsondata), 1313821514), jsondata,\
+                        struct.pack('<II', len(giant_buffer), 5130562), giant_buffer])
+                add_bytes(profile, 'written', 28 + len(jsondata) + len(giant_buffer))
+            else:
+                gltf_data['buffers'][0]["uri"] = imtn_file[:-4]+'.bin'
+                with profile_stage(profile, 'json_encoding'):
+                    jsondata = json.dumps(gltf_data, indent=4).encode("utf-8")
+                with profile_stage(profile, 'file_write'):
+                    write_output(writer, imtn_file[:-4]+'.bin', giant_buffer)
+                    write_output(writer, imtn_file[:-4]+'.gltf', jsondata)
+                add_bytes(profile, 'written', len(jsondata) + len(giant_buffer))
+            if palette_format is not None:
+                palette, sidecar = make_joint_palette(gltf_data, giant_buffer,\
+                    ani_fps if palette_rate is None else palette_rate, palette_format, profile)
+                with profile_stage(profile, 'file_write'):
+                    write_output(writer, imtn_file[:-4]+'.palette', palette)
+                    write_output(writer, imtn_file[:-4]+'.palette.json', sidecar)
+                add_bytes(profile, 'written', len(palette) + len(sidecar))
     return
 
 if __name__ == "__main__":
@@ -210,12 +336,36 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
-        parser.add_argument('imtn_filename', help="Name of imtn file to export from (required).")
+        parser.add_argument('-p', '--profile', help="Write per-stage timings to a JSON report (added to the report if it exists)")
+        parser.add_argument('--palette', help="Also write the baked world-space joint matrices, as float16 or float32",\
+            choices = ['float16', 'float32'])
+        parser.add_argument('--palette-rate', help="Frames per second of the baked joint matrices (default: {})".format(ani_fps),\
+            type = float)
+        parser.add_argument('--writer-threads', help="Number of background writer threads, 0 to write in order (default: 2)",\
+            type = int, default = 2)
+        parser.add_argument('imtn_filename', nargs='?', help="Name of imtn file to export from (default: all .mtn files in the folder).")
         args = parser.parse_args()
-        if os.path.exists(args.imtn_filename) and args.imtn_filename[-4:].lower() == '.mdl':
-            process_imtn(args.imtn_filename, skel_struct,\
-                write_binary_gltf = args.textformat, overwrite = args.overwrite)
+        if args.imtn_filename is None:
+            imtn_files = glob.glob('*.mtn')
+        elif os.path.exists(args.imtn_filename) and args.imtn_filename[-4:].lower() == '.mtn':
+            imtn_files = [args.imtn_filename]
+        else:
+            imtn_files = []
+        profiles = []
+        writer = start_writer(args.writer_threads) if args.writer_threads > 0 else None
+        for imtn_file, imtn_data in prefetch_inputs(imtn_files):
+            profile = new_profile(imtn_file, 'vato_extract_imtn') if args.profile else None
+            process_imtn(imtn_file, skel_struct, write_binary_gltf = args.textformat,\
+                overwrite = args.overwrite, profile = profile, data = imtn_data, writer = writer,\
+                palette_format = args.palette, palette_rate = args.palette_rate)
+            if profile is not None:
+                profiles.append(profile)
+        finish_writer(writer)
+        if args.profile:
+            write_profile_report(profiles, args.profile)
     else:
         imtn_files = glob.glob('*.mtn')
-        for i in range(len(imtn_files)):
-            process_imtn(imtn_files[i], skel_struct)
+        writer = start_writer()
+        for imtn_file, imtn_data in prefetch_inputs(imtn_files):
+            process_imtn(imtn_file, skel_struct, data = imtn_data, writer = writer)
+        finish_writer(writer)
@@ -1,21 +1,26 @@
 # Tool to export texture data from the txp format used by Valkyrie Anatomia: The Origin.
 #
 # Usage:  Run by itself without commandline arguments and it will read
-# every txp file it finds in the folder and output png files.
+# every txp file it finds in the folder and output png files.  Textures whose hash is in the name
+# index (vato_names.json, see vato_unpack_pck.py) are named from it.
 #
 # For command line options, run:
 # /path/to/python3 vato_extract_txp.py --help
 #
-# Requires the pillow module, which can be installed by:
-# /path/to/python3 -m pip install pillow
+# Requires the numpy and pillow modules, which can be installed by:
+# /path/to/python3 -m pip install numpy pillow
 #
 # Requires lib_fmtibvb.py, put in the same directory
 #
 # GitHub eArmada8/vato_mdl_tool
 
 try:
-    import struct, io, os, sys, glob
+    import struct, io, json, os, sys, glob
+    import numpy
     from PIL import Image
+    from lib_vato_profile import *
+    from lib_vato_io import *
+    from lib_vato_names import *
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
@@ -28,15 +33,20 @@ def read_null_terminated_string (f):
     return(null_term_string[:-1].decode())
 
 # Thank you to https://github.com/mariodon/taikotools/ for the decompression algorithm
-def decompress_taiko_v (f):
+def decompress_taiko_v (f, max_size = None):
+    # With max_size, only the start of the data is decompressed (and returned), and only as much of
+    # the compressed stream is read as that can take (every command gives at least half as many bytes)
     unc_size_w_flags, = struct.unpack("<I", f.read(4))
     unc_size = (unc_size_w_flags & 0xFFFFFF00) >> 8
+    if max_size is not None:
+        # Room for the longest literal run that can start before max_size
+        unc_size = min(unc_size, max_size + 32958)
     output = bytearray([0]*unc_size)
     out_loc = 0
-    cmp_data = f.read()
+    cmp_data = f.read() if max_size is None else f.read(2 * max_size + 8)
     cmp_data_len = len(cmp_data)
     with io.BytesIO(cmp_data) as f:
-        while f.tell() < cmp_data_len:
+        while f.tell() < cmp_data_len and (max_size is None or out_loc < max_size):
             c = int.from_bytes(f.read(1))
             if (c > 0xBF):
                 len_ = (c - 0xBE) * 2
@@ -89,9 +99,53 @@ def decompress_taiko_v (f):
             else:
                 output[out_loc:out_loc+c] = f.read(c)
                 out_loc += c
+    if max_size is not None:
+        return(output[:max_size])
     return(output)
 
-def convert_vato_tga (f):
+# Bit count and R, G, B, A masks of the texel layouts, for DDS headers and raw sidecars
+texel_layouts = {4: {'name': 'RGBA5551', 'bit_count': 16, 'masks': [0xF800, 0x07C0, 0x003E, 0x0001]},
+    5: {'name': 'RGBA4444', 'bit_count': 16, 'masks': [0xF000, 0x0F00, 0x00F0, 0x000F]},
+    6: {'name': 'RGB888', 'bit_count': 24, 'masks': [0xFF, 0xFF00, 0xFF0000, 0]},
+    7: {'name': 'RGBA8888', 'bit_count': 32, 'masks': [0xFF, 0xFF00, 0xFF0000, 0xFF000000]}}
+
+texture_output_formats = ['png', 'tga', 'dds', 'raw']
+
+# Approximate bytes used by the default decode for each pixel (a tuple for every pixel)
+list_bytes_per_pixel = 120
+
+def decode_vato_image_chunked (data, tex_format, width, height, chunk_pixels = 256 * 1024):
+    # Decodes the texels a strip of rows at a time with numpy, so that only one strip is expanded at
+    # once instead of a tuple for every pixel.  Gives the same image as decode_vato_texture().
+    image = Image.new('RGBA', (width, height))
+    bytes_per_pixel = texel_layouts[tex_format]['bit_count'] // 8
+    num_pixels = min(len(data) // bytes_per_pixel, width * height)
+    strip_rows = max(chunk_pixels // max(width, 1), 1)
+    for start in range(0, num_pixels, strip_rows * width):
+        count = min(strip_rows * width, num_pixels - start)
+        if tex_format in [4,5]:
+            raw = numpy.frombuffer(data, dtype = '<u2', count = count, offset = start * 2)
+            if tex_format == 4:
+                channels = [(raw >> x) & 0x1F for x in [11, 6, 1]]
+                rgba = numpy.stack([(x << 3) | (x >> 2) for x in channels] + [(raw & 0x1) * 255], axis = 1)
+            else:
+                rgba = numpy.stack([((raw >> x) & 0xF) * 17 for x in [12, 8, 4, 0]], axis = 1)
+        else:
+            raw = numpy.frombuffer(data, dtype = 'u1', count = count * bytes_per_pixel, offset = start * bytes_per_pixel)\
+                .reshape(-1, bytes_per_pixel)
+            rgba = raw if tex_format == 7 else numpy.concatenate([raw, numpy.full((count, 1), 255, dtype = 'u1')], axis = 1)
+        rows = -(-count // width)
+        # Pixels after the end of the data are left empty, as by putdata()
+        strip = numpy.zeros((rows * width, 4), dtype = 'u1')
+        strip[:count] = rgba
+        image.paste(Image.frombytes('RGBA', (width, rows), strip.tobytes()), (0, start // width))
+    return(image)
+
+def decode_vato_texture (f, profile = None, decode = True, low_memory = False):
+    # Reads the texture whose descriptor is at the current position.  Returns a dict with the
+    # name, format and size, the texel data as stored, and the decoded image (None if the format
+    # is not supported, or if decode is False).  With low_memory, the image is decoded in strips,
+    # see decode_vato_image_chunked().
      # Thank you to Platinarei for the RBGA code
     def decode_vato_5551 (raw_color):
         return(tuple([x << 3 | x >> 2 for x in
@@ -102,45 +156,172 @@ def convert_vato_tga (f):
             [(raw_color & 0xF000) >> 12, (raw_color & 0x0F00) >> 8, (raw_color & 0x00F0) >> 4, (raw_color & 0x000F)]]))
     desc_offset, tex_size, tex_offset, tex_format, width, height, maybe_mips, unk1, unk2 = struct.unpack("<4I2H3I", f.read(32))
     f.seek(desc_offset, 0)
-    file_desc = read_null_terminated_string (f)
-    print("Processing {}...".format(file_desc))
+    texture = {'name': read_null_terminated_string (f), 'format': tex_format, 'width': width, 'height': height, 'image': None}
     if not tex_format in [4, 5, 6, 7]:
-        input("{0} is in an unsupported format, type {1}, skipping!  Press Enter to continue.".format(file_desc, tex_format))
-        return
+        return(texture)
     f.seek(tex_offset, 0)
-    if tex_format in [4,5]:
-        raw_bitmap = struct.unpack("<{}H".format(tex_size//2), f.read(tex_size))
-        if tex_format == 4:
-            bitmap = [decode_vato_5551(x) for x in raw_bitmap]
-        elif tex_format == 5:
-            bitmap = [decode_vato_4444(x) for x in raw_bitmap]
-    elif tex_format == 6: # Format 6, R8G8B8_UINT
-        raw_bitmap = struct.unpack("<{}B".format(tex_size), f.read(tex_size))
-        bitmap = [(raw_bitmap[i*3], raw_bitmap[i*3+1], raw_bitmap[i*3+2]) for i in range(len(raw_bitmap)//3)]
-    elif tex_format == 7: # Format 7, R8G8B8A8_UINT
-        raw_bitmap = struct.unpack("<{}B".format(tex_size), f.read(tex_size))
-        bitmap = [(raw_bitmap[i*4], raw_bitmap[i*4+1], raw_bitmap[i*4+2], raw_bitmap[i*4+3]) for i in range(len(raw_bitmap)//4)]
-    im = Image.new('RGBA', (width, height))
-    im.putdata(bitmap)
-    im.save('{}.png'.format(file_desc))
+    texture['data'] = f.read(tex_size)
+    if decode == False:
+        return(texture)
+    with profile_stage(profile, 'pixel_decode'):
+        if low_memory == True:
+            texture['image'] = decode_vato_image_chunked(texture['data'], tex_format, width, height)
+        elif tex_format in [4,5]:
+            raw_bitmap = struct.unpack("<{}H".format(tex_size//2), texture['data'])
+            if tex_format == 4:
+                bitmap = [decode_vato_5551(x) for x in raw_bitmap]
+            elif tex_format == 5:
+                bitmap = [decode_vato_4444(x) for x in raw_bitmap]
+        elif tex_format == 6: # Format 6, R8G8B8_UINT
+            raw_bitmap = struct.unpack("<{}B".format(tex_size), texture['data'])
+            bitmap = [(raw_bitmap[i*3], raw_bitmap[i*3+1], raw_bitmap[i*3+2]) for i in range(len(raw_bitmap)//3)]
+        elif tex_format == 7: # Format 7, R8G8B8A8_UINT
+            raw_bitmap = struct.unpack("<{}B".format(tex_size), texture['data'])
+            bitmap = [(raw_bitmap[i*4], raw_bitmap[i*4+1], raw_bitmap[i*4+2], raw_bitmap[i*4+3]) for i in range(len(raw_bitmap)//4)]
+        if low_memory == False:
+            texture['image'] = Image.new('RGBA', (width, height))
+            texture['image'].putdata(bitmap)
+    add_count(profile, 'textures')
+    add_count(profile, 'pixels', width * height)
+    return(texture)
+
+def encode_png (texture, profile = None):
+    with profile_stage(profile, 'png_encoding'):
+        png_stream = io.BytesIO()
+        texture['image'].save(png_stream, 'PNG')
+    return(png_stream.getvalue())
+
+def make_dds_header (width, height, layout):
+    # Uncompressed DDS, with the channel layout given by bit masks (DDPF_RGB, plus DDPF_ALPHAPIXELS)
+    pitch = (width * layout['bit_count'] + 7) // 8
+    pixel_format = struct.pack("<8I", 32, 0x41 if layout['masks'][3] > 0 else 0x40, 0, layout['bit_count'], *layout['masks'])
+    return(b'DDS ' + struct.pack("<7I44x", 124, 0x100F, height, width, pitch, 0, 0) + pixel_format\
+        + struct.pack("<5I", 0x1000, 0, 0, 0, 0))
+
+def encode_texture (texture, output_format = 'png', native = False, profile = None):
+    # Returns a list of (extension, data) to be written.  tga, dds and raw are not compressed.
+    # With native, dds and raw keep the texels as stored (e.g. 16-bit 5551) instead of expanding to RGBA8.
+    if output_format == 'png':
+        return([('png', encode_png(texture, profile))])
+    with profile_stage(profile, 'texture_encoding'):
+        if native == True:
+            layout, pixel_data = texel_layouts[texture['format']], texture['data']
+        else:
+            layout, pixel_data = texel_layouts[7], texture['image'].tobytes()
+        if output_format == 'tga': # 32-bit BGRA, top-left origin
+            outputs = [('tga', struct.pack("<3B2HB4H2B", 0, 0, 2, 0, 0, 0, 0, 0, texture['width'], texture['height'], 32, 0x28)\
+                + texture['image'].tobytes('raw', 'BGRA'))]
+        elif output_format == 'dds':
+            outputs = [('dds', make_dds_header(texture['width'], texture['height'], layout) + pixel_data)]
+        elif output_format == 'raw':
+            sidecar = {'width': texture['width'], 'height': texture['height'], 'layout': layout['name'],\
+                'bit_count': layout['bit_count'], 'masks': layout['masks'], 'source_format': texture['format']}
+            outputs = [('raw', pixel_data), ('json', json.dumps(sidecar, indent=4).encode('utf-8'))]
+    return(outputs)
+
+def convert_vato_tga (f, profile = None, writer = None, output_format = 'png', native = False, names = None, name_hash = 0,\
+        memory_budget = None):
+    # The texture is named after the string with name_hash in the name index names, if there is one.
+    # If decoding it is projected to take more than memory_budget bytes, it is decoded in strips.
+    low_memory = False
+    if memory_budget is not None:
+        width, height = struct.unpack("<2H", f.read(32)[16:20])
+        f.seek(-32, 1)
+        low_memory = width * height * list_bytes_per_pixel + memory_in_use() > memory_budget
+        if low_memory == True:
+            add_count(profile, 'streamed')
+    texture = decode_vato_texture(f, profile, decode = not native, low_memory = low_memory)
+    with profile_stage(profile, 'string_lookup'):
+        resolved_name = resolve_name(names, name_hash)
+    file_desc = texture['name'] if resolved_name is None else output_name(resolved_name)
+    print("Processing {}...".format(file_desc))
+    if not texture['format'] in texel_layouts:
+        input("{0} is in an unsupported format, type {1}, skipping!  Press Enter to continue.".format(file_desc, texture['format']))
+        return
+    for extension, output_data in encode_texture(texture, output_format, native, profile):
+        with profile_stage(profile, 'file_write'):
+            write_output(writer, '{0}.{1}'.format(file_desc, extension), output_data)
+        add_bytes(profile, 'written', len(output_data))
     return
 
-def process_txp_file (txp_file):
-    with open(txp_file, 'rb') as f:
+def read_txp_data (txp_file, profile = None, data = None, log = print):
+    # Returns the uncompressed txp, decompressing it first if needed
+    # If data (bytes or a binary stream) is given, it is read instead of txp_file
+    with open_input(txp_file, data) as f:
+        add_bytes(profile, 'read', stream_size(f))
         magic = f.read(4)
         f.seek(0)
         if magic == b'GLTP':
             unc_data = f.read()
         else: # Assume compressed
-            print("File magic is not GLTP, attempting decompression...")
-            unc_data = decompress_taiko_v(f)
-    with io.BytesIO(unc_data) as f:
+            if log is not None:
+                log("File magic is not GLTP, attempting decompression...")
+            with profile_stage(profile, 'decompression'):
+                unc_data = decompress_taiko_v(f)
+            add_bytes(profile, 'decompressed', len(unc_data))
+    return(unc_data)
+
+def read_txp_textures (txp_file, names = None, profile = None, data = None, log = print, decode = True):
+    # Returns a list of the names of all the textures in the txp, and a dict of the decoded textures
+    # by name.  If names is given, only those textures are decoded.  Textures in unsupported formats
+    # are left out.  With decode False, the textures keep only the texel data as stored.
+    texture_names, textures = [], {}
+    with io.BytesIO(read_txp_data(txp_file, profile, data, log)) as f:
+        if f.read(4) == b'GLTP':
+            version, num_files, hash_offset = struct.unpack("<3I", f.read(12))
+            for i in range(num_files):
+                f.seek(0x20 * (i+1), 0)
+                desc_offset, = struct.unpack("<I", f.read(4))
+                f.seek(desc_offset, 0)
+                texture_names.append(read_null_terminated_string(f))
+                if names is None or texture_names[-1] in names:
+                    f.seek(0x20 * (i+1), 0)
+                    texture = decode_vato_texture(f, profile, decode)
+                    if texture['format'] in texel_layouts:
+                        textures[texture['name']] = texture
+    return(texture_names, textures)
+
+def read_txp_hashes (f, txp_size):
+    # Returns the table at hash_offset, one value for each texture, of the txp of txp_size bytes at
+    # the current position of f.  These appear to be hashes of the texture names, but the hash function
+    # is not known.  Only the header and the table are read (or decompressed), not the textures.
+    start = f.tell()
+    def read_start (size):
+        f.seek(start)
+        if f.read(4) == b'GLTP':
+            f.seek(start)
+            return(f.read(min(size, txp_size)))
+        f.seek(start)
+        with io.BytesIO(f.read(min(2 * size + 12, txp_size))) as ff:
+            return(bytes(decompress_taiko_v(ff, max_size = size)))
+    header = read_start(16)
+    if not header[0:4] == b'GLTP' or len(header) < 16:
+        return([])
+    version, num_files, hash_offset = struct.unpack("<3I", header[4:16])
+    table = read_start(hash_offset + 4 * num_files)[hash_offset:]
+    if len(table) < 4 * num_files:
+        return([])
+    return(list(struct.unpack("<{}I".format(num_files), table)))
+
+def process_txp_file (txp_file, profile = None, data = None, writer = None, output_format = 'png', native = False, names = None,\
+        memory_budget = None):
+    # names is the name index used to name the textures, see lib_vato_names.py.  See convert_vato_tga()
+    # for memory_budget.
+    with io.BytesIO(read_txp_data(txp_file, profile, data)) as f:
         magic = f.read(4)
         if magic == b'GLTP':
-            version, num_files, hash_offset = struct.unpack("<3I", f.read(12))
+            with profile_stage(profile, 'section_parse'):
+                version, num_files, hash_offset = struct.unpack("<3I", f.read(12))
+                hashes = []
+                if has_names(names):
+                    # A table that is cut off (or a bad hash_offset) just leaves the textures unnamed
+                    f.seek(0)
+                    hashes = read_txp_hashes(f, stream_size(f))
+                if len(hashes) == 0:
+                    hashes = [0] * num_files
             for i in range(num_files):
                 f.seek(0x20 * (i+1), 0)
-                convert_vato_tga(f)
+                convert_vato_tga(f, profile, writer, output_format, native, names, hashes[i], memory_budget)
 
 if __name__ == "__main__":
     # Set current directory
@@ -153,11 +334,51 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         import argparse
         parser = argparse.ArgumentParser()
-        parser.add_argument('txp_filename', help="Name of txp file to export from (required).")
+        parser.add_argument('-f', '--format', help="Output format (default: png)", choices = texture_output_formats, default = 'png')
+        parser.add_argument('-n', '--native', help="Keep the texels as stored instead of expanding to RGBA8 (dds and raw only)", action="store_true")
+        parser.add_argument('-p', '--profile', help="Write per-stage timings to a JSON report (added to the report if it exists)")
+        parser.add_argument('--names', help="Name index to name the textures from (default: {})".format(default_names_file),\
+            default = default_names_file)
+        parser.add_argument('--memory-budget', help="Memory budget in MiB: textures projected to need more are decoded in strips, and the peak memory of each file is reported",\
+            type = float)
+        parser.add_argument('--writer-threads', help="Number of background writer threads, 0 to write in order (default: 2)",\
+            type = int, default = 2)
+        parser.add_argument('txp_filename', nargs='?', help="Name of txp file to export from (default: all .txp files in the folder).")
         args = parser.parse_args()
-        if os.path.exists(args.txp_filename) and args.txp_filename[-4:].lower() == '.txp':
-            process_txp_file(args.txp_filename)
+        if args.native and not args.format in ['dds', 'raw']:
+            parser.error("--native is only supported with --format dds or raw")
+        if args.txp_filename is None:
+            txp_files = glob.glob('*.txp')
+        elif os.path.exists(args.txp_filename) and args.txp_filename[-4:].lower() == '.txp':
+            txp_files = [args.txp_filename]
+        else:
+            txp_files = []
+        names = load_name_index(args.names)
+        memory_budget = int(args.memory_budget * 1048576) if args.memory_budget is not None else None
+        if memory_budget is not None:
+            # Files are read as they are decoded instead of ahead, and fewer writes are queued
+            start_memory_tracking()
+            inputs = [(x, None) for x in txp_files]
+            writer = start_writer(args.writer_threads, memory_budget // 4) if args.writer_threads > 0 else None
+        else:
+            inputs = prefetch_inputs(txp_files)
+            writer = start_writer(args.writer_threads) if args.writer_threads > 0 else None
+        profiles = []
+        for txp_file, txp_data in inputs:
+            profile = new_profile(txp_file, 'vato_extract_txp') if args.profile or memory_budget is not None else None
+            process_txp_file(txp_file, profile, data = txp_data, writer = writer, output_format = args.format, native = args.native,\
+                names = names, memory_budget = memory_budget)
+            if profile is not None:
+                profiles.append(profile)
+        finish_writer(writer)
+        if memory_budget is not None:
+            print_memory_summary(profiles, memory_budget)
+        if args.profile:
+            write_profile_report(profiles, args.profile)
     else:
         txp_files = glob.glob('*.txp')
-        for i in range(len(txp_files)):
-            process_txp_file(txp_files[i])
+        names = load_name_index()
+        writer = start_writer()
+        for txp_file, txp_data in prefetch_inputs(txp_files):
+            process_txp_file(txp_file, data = txp_data, writer = writer, names = names)
+        finish_writer(writer)
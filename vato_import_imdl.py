@@ -0,0 +1,244 @@
+# Tool to write edited meshes back into the imdl format used by Valkyrie Anatomia: The Origin.
+#
+# Usage:  Export with vato_extract_imdl.py --dumprawbuffers, edit the .vb/.ib files in the
+# folder with the same name as the .mdl, then run this script by itself without commandline
+# arguments and it will import every .mdl in the folder that has such a folder.
+#
+# If the vertex and index counts of a mesh are unchanged, only the ranges of the vertices,
+# blend_indices and triangles blocks that belong to it are overwritten, in place.  Otherwise the
+# new data is appended to those blocks, the blocks after them are moved, and the file is rewritten.
+#
+# For command line options, run:
+# /path/to/python3 vato_import_imdl.py --help
+#
+# Requires lib_fmtibvb.py, put in the same directory
+#
+# GitHub eArmada8/vato_mdl_tool
+
+try:
+    import struct, glob, os, shutil, sys
+    from lib_fmtibvb import *
+    from lib_vato_container import imdl_block_names, read_container, seek_section, read_from_string_dictionary
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+def read_imdl_layout (f):
+    # Only the sections that locate the vertex and index data are read.  The file position of each
+    # shap and mesh record is kept, so the records can be patched.
+    layout = {'shapes': [], 'meshes': [], 'geoms': []}
+    f.seek(0)
+    container = read_container(f)
+    if container is None or not container['magic'] == b'IMDL':
+        return(None)
+    layout['block_offsets'] = dict(zip(imdl_block_names, container['block_offsets']))
+    for section_magic in [x for x in [b'mesh', b'shap', b'geom'] if x in container['sections']]:
+        if section_magic == b'mesh':
+            num_meshes = seek_section(f, container, section_magic)
+            for _ in range(num_meshes):
+                mesh = {'record_offset': f.tell()}
+                mesh['material'], mesh['unk0'], mesh['unk1'], mesh['index_buffer_len'], mesh['index_buffer_offset']\
+                    = struct.unpack("<2H3I", f.read(16))
+                layout['meshes'].append(mesh)
+        elif section_magic == b'shap':
+            num_shapes = seek_section(f, container, section_magic)
+            for _ in range(num_shapes):
+                shape = {'record_offset': f.tell()}
+                shape['unk0'], shape['unk1'], shape['num_vertices'], shape['pos_offset'],\
+                shape['uv_offset'], shape['abs_vert_start'], shape['norm_offset'],\
+                shape['blend_indices_offset'], shape['blendweight_offset'] = struct.unpack("<9I", f.read(36))
+                layout['shapes'].append(shape)
+        elif section_magic == b'geom':
+            num_geoms = seek_section(f, container, section_magic)
+            for _ in range(num_geoms):
+                geom = {}
+                string_offset, = struct.unpack("<I", f.read(4))
+                geom['name'] = read_from_string_dictionary (f, layout['block_offsets']["dictionary"] + string_offset)
+                geom['node'], geom['unk1'], geom['unk2'], geom['unk3'],\
+                    geom['vertex_buffer'] = struct.unpack("<HhIHH", f.read(12))
+                f.seek(116, 1) # matrix, bbox, zeroes0
+                geom['num_index_buffers'], geom['first_index_buffer'] = struct.unpack("<2H", f.read(4))
+                geom['num_bones'], = struct.unpack("<I", f.read(4))
+                f.seek(20, 1)
+                layout['geoms'].append(geom)
+    return(layout)
+
+def pack_shape_record (shape):
+    return(struct.pack("<9I", shape['unk0'], shape['unk1'], shape['num_vertices'], shape['pos_offset'],\
+        shape['uv_offset'], shape['abs_vert_start'], shape['norm_offset'], shape['blend_indices_offset'],\
+        shape['blendweight_offset']))
+
+def pack_mesh_record (mesh):
+    return(struct.pack("<2H3I", mesh['material'], mesh['unk0'], mesh['unk1'], mesh['index_buffer_len'],\
+        mesh['index_buffer_offset']))
+
+def read_raw_buffers (folder, i, geom):
+    # Returns the edited buffers of a geom packed as in the imdl, or None if it was not dumped
+    filename = "{0}/{1:02d}_{2}".format(folder, i, geom['name'])
+    if not (os.path.exists(filename + '.fmt') and os.path.exists(filename + '.vb') and os.path.exists(filename + '.ib')):
+        return(None)
+    fmt = read_fmt(filename + '.fmt')
+    vb = read_vb(filename + '.vb', fmt)
+    ib = read_ib(filename + '.ib', fmt)
+    element_formats = {'POSITION': 'f', 'TEXCOORD': 'f', 'NORMAL': 'f', 'BLENDWEIGHTS': 'f', 'BLENDINDICES': 'B'}
+    buffers = {'num_vertices': len(vb[0]['Buffer']), 'indices': [x for y in ib for x in y]}
+    for element in vb:
+        if element['SemanticName'] in element_formats and len(element['Buffer']) > 0:
+            width = len(element['Buffer'][0])
+            buffers[element['SemanticName']] = struct.pack("<{0}{1}".format(len(element['Buffer']) * width,\
+                element_formats[element['SemanticName']]), *[x for y in element['Buffer'] for x in y])
+    return(buffers)
+
+def split_indices (indices, meshes):
+    # The dump combines the index buffers of a geom, so they are split again by their original lengths
+    if len(meshes) == 1:
+        return([indices])
+    if not len(indices) == sum([x['index_buffer_len'] for x in meshes]):
+        return(None)
+    split_ib, start = [], 0
+    for mesh in meshes:
+        split_ib.append(indices[start:start + mesh['index_buffer_len']])
+        start += mesh['index_buffer_len']
+    return(split_ib)
+
+def plan_geom_import (f, layout, i, buffers):
+    # Returns a list of (block, offset in block, data) writes if the counts are unchanged, or a list of
+    # (block, data, callback) appends if they are not.  Writes of unchanged data are left out.
+    geom = layout['geoms'][i]
+    shape = layout['shapes'][geom['vertex_buffer']]
+    meshes = layout['meshes'][geom['first_index_buffer']:geom['first_index_buffer'] + geom['num_index_buffers']]
+    split_ib = split_indices(buffers['indices'], meshes)
+    if split_ib is None:
+        print("{0} has {1} index buffers and its index count changed, cannot split it!  Skipping.".format(geom['name'], len(meshes)))
+        return([], [])
+    num_vertices = buffers['num_vertices']
+    attributes = [('POSITION', 'pos_offset', 12), ('TEXCOORD', 'uv_offset', 8), ('NORMAL', 'norm_offset', 12),\
+        ('BLENDWEIGHTS', 'blendweight_offset', 16)]
+    attributes = [x for x in attributes if not shape[x[1]] == 0 or x[0] == 'POSITION']
+    weights = not shape['blendweight_offset'] == 0
+    missing = [x[0] for x in attributes if not x[0] in buffers] + (['BLENDINDICES'] if weights and not 'BLENDINDICES' in buffers else [])
+    if len(missing) > 0:
+        print("{0} is missing {1} in the dump!  Skipping.".format(geom['name'], ', '.join(missing)))
+        return([], [])
+    writes, appends = [], []
+    def changed (block, offset, data):
+        f.seek(layout['block_offsets'][block] + offset)
+        return(not f.read(len(data)) == data)
+    if num_vertices == shape['num_vertices']:
+        for semantic, offset_key, stride in attributes:
+            if changed('vertices', shape[offset_key] * 4, buffers[semantic]):
+                writes.append(('vertices', shape[offset_key] * 4, buffers[semantic]))
+        if weights and changed('blend_indices', shape['blend_indices_offset'], buffers['BLENDINDICES']):
+            writes.append(('blend_indices', shape['blend_indices_offset'], buffers['BLENDINDICES']))
+    else:
+        # The extractor expects the attributes, then the bind matrices, to follow each other
+        vertex_data = b''.join([buffers[x[0]] for x in attributes])
+        if weights:
+            f.seek(layout['block_offsets']['vertices'] + shape['blendweight_offset'] * 4 + shape['num_vertices'] * 16)
+            vertex_data += f.read(64 * geom['num_bones'])
+        def move_vertices (start, shape = shape, attributes = attributes, num_vertices = num_vertices):
+            for semantic, offset_key, stride in attributes:
+                shape[offset_key] = start // 4
+                start += num_vertices * stride
+            shape['num_vertices'] = num_vertices
+        appends.append(('vertices', vertex_data, move_vertices))
+        if weights:
+            def move_blend_indices (start, shape = shape):
+                shape['blend_indices_offset'] = start
+            appends.append(('blend_indices', buffers['BLENDINDICES'], move_blend_indices))
+    for j in range(len(meshes)):
+        index_data = struct.pack("<{}H".format(len(split_ib[j])), *split_ib[j])
+        if len(split_ib[j]) == meshes[j]['index_buffer_len'] and len(appends) == 0:
+            if changed('triangles', meshes[j]['index_buffer_offset'] * 2, index_data):
+                writes.append(('triangles', meshes[j]['index_buffer_offset'] * 2, index_data))
+        elif not len(split_ib[j]) == meshes[j]['index_buffer_len']:
+            def move_indices (start, mesh = meshes[j], index_buffer_len = len(split_ib[j])):
+                mesh['index_buffer_offset'], mesh['index_buffer_len'] = start // 2, index_buffer_len
+            appends.append(('triangles', index_data, move_indices))
+        else:
+            writes.append(('triangles', meshes[j]['index_buffer_offset'] * 2, index_data))
+    return(writes, appends)
+
+def rebuild_imdl (f, layout, writes, appends):
+    # Returns the new file: the blocks are split at their offsets, the appends are added to the end of
+    # their blocks (padded to 16 bytes, so the blocks after them stay aligned), and the blocks are moved.
+    f.seek(0)
+    data = f.read()
+    order = sorted([x for x in imdl_block_names if layout['block_offsets'][x] > 0], key = lambda x: layout['block_offsets'][x])
+    bounds = [layout['block_offsets'][x] for x in order] + [len(data)]
+    blocks = {order[i]: bytearray(data[bounds[i]:bounds[i+1]]) for i in range(len(order))}
+    for block, offset, block_data in writes:
+        blocks[block][offset:offset+len(block_data)] = block_data
+    for block, block_data, move in appends:
+        blocks[block].extend(b'\x00' * (-len(blocks[block]) % 16))
+        move(len(blocks[block]))
+        blocks[block].extend(block_data)
+    for block in blocks:
+        blocks[block].extend(b'\x00' * (-len(blocks[block]) % 16))
+    new_data = bytearray(data[:bounds[0]])
+    for block in order:
+        layout['block_offsets'][block] = len(new_data)
+        new_data.extend(blocks[block])
+    new_data[12:32] = struct.pack("<5I", *[layout['block_offsets'][x] for x in imdl_block_names])
+    for shape in layout['shapes']:
+        new_data[shape['record_offset']:shape['record_offset'] + 36] = pack_shape_record(shape)
+    for mesh in layout['meshes']:
+        new_data[mesh['record_offset']:mesh['record_offset'] + 16] = pack_mesh_record(mesh)
+    return(new_data)
+
+def import_imdl (imdl_file, raw_buffer_folder = None, output_file = None):
+    # Returns the number of geoms that were changed
+    if raw_buffer_folder is None:
+        raw_buffer_folder = imdl_file[:-4]
+    if output_file is not None and not os.path.abspath(output_file) == os.path.abspath(imdl_file):
+        shutil.copyfile(imdl_file, output_file)
+        imdl_file = output_file
+    print("Processing {}...".format(imdl_file))
+    with open(imdl_file, 'r+b') as f:
+        layout = read_imdl_layout(f)
+        if layout is None:
+            print("{} is not an IMDL file!".format(imdl_file))
+            return(0)
+        writes, appends, num_changed = [], [], 0
+        for i in range(len(layout['geoms'])):
+            buffers = read_raw_buffers(raw_buffer_folder, i, layout['geoms'][i])
+            if buffers is not None:
+                geom_writes, geom_appends = plan_geom_import(f, layout, i, buffers)
+                writes.extend(geom_writes)
+                appends.extend(geom_appends)
+                num_changed += 1 if len(geom_writes) + len(geom_appends) > 0 else 0
+        if len(appends) == 0:
+            for block, offset, block_data in writes:
+                f.seek(layout['block_offsets'][block] + offset)
+                f.write(block_data)
+            print("Patched {0} meshes in place ({1} bytes).".format(num_changed, sum([len(x[2]) for x in writes])))
+            return(num_changed)
+        new_data = rebuild_imdl(f, layout, writes, appends)
+    with open(imdl_file + '.tmp', 'wb') as f:
+        f.write(new_data)
+    os.replace(imdl_file + '.tmp', imdl_file)
+    print("Rebuilt {0} with {1} changed meshes.".format(imdl_file, num_changed))
+    return(num_changed)
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    # If argument given, attempt to import into file in argument
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-i', '--input', help="Folder with the edited raw buffers (default: the .mdl name without extension)")
+        parser.add_argument('-o', '--output', help="Write to this .mdl instead of modifying the original")
+        parser.add_argument('imdl_filename', help="Name of imdl file to import into.")
+        args = parser.parse_args()
+        if os.path.exists(args.imdl_filename) and args.imdl_filename[-4:].lower() == '.mdl':
+            import_imdl(args.imdl_filename, raw_buffer_folder = args.input, output_file = args.output)
+    else:
+        imdl_files = [x for x in glob.glob('*.mdl') if os.path.isdir(x[:-4])]
+        for i in range(len(imdl_files)):
+            import_imdl(imdl_files[i])
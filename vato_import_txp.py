@@ -0,0 +1,217 @@
+# Tool to write textures into the txp format used by Valkyrie Anatomia: The Origin.
+#
+# Usage:  Export with vato_extract_txp.py, edit the .png files (named after the textures, e.g.
+# 00_body.tga.png), then run this script by itself without commandline arguments and it will
+# replace the textures of every .txp in the folder that has edited .png files.  Each texture keeps
+# its format (RGBA5551, RGBA4444, RGB888 or RGBA8888), and the .txp stays compressed if it was.
+# The .txp is replaced, so keep a backup (or use -o).
+#
+# A new .txp can be made from a list of .png files with the command line.
+#
+# For command line options, run:
+# /path/to/python3 vato_import_txp.py --help
+#
+# Requires numpy and pillow, which can be installed by:
+# /path/to/python3 -m pip install numpy pillow
+#
+# Requires vato_extract_txp.py and vato_compress_txp.py, put in the same directory
+#
+# GitHub eArmada8/vato_mdl_tool
+
+try:
+    import struct, io, os, sys, glob
+    import numpy
+    from PIL import Image
+    from vato_extract_txp import read_null_terminated_string, read_txp_data, texel_layouts
+    from vato_compress_txp import compress_taiko_v, default_level
+    from lib_vato_profile import *
+    from lib_vato_io import *
+    from lib_vato_names import default_names_file, load_name_index, resolve_name, output_name
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Ordered dithering thresholds (4x4 Bayer matrix), in fractions of a quantization step
+bayer_4x4 = (numpy.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) + 0.5) / 16
+
+def quantize (channels, bits, dither = False):
+    # Scales 8-bit channels (height, width, n) down to bits per channel, rounding to nearest, or with
+    # ordered dithering, which trades the banding of smooth gradients for a fine regular pattern
+    levels = (1 << bits) - 1
+    scaled = channels.astype(numpy.float32) * (levels / 255)
+    if dither == True:
+        height, width = channels.shape[0:2]
+        threshold = numpy.tile(bayer_4x4, ((height + 3) // 4, (width + 3) // 4))[:height,:width,None]
+    else:
+        threshold = 0.5
+    return(numpy.clip(numpy.floor(scaled + threshold), 0, levels).astype(numpy.uint16))
+
+def encode_vato_texture (image, tex_format, dither = False, profile = None):
+    # Returns the texel data of a PIL image in one of the texel layouts that decode_vato_texture() reads
+    with profile_stage(profile, 'pixel_encode'):
+        rgba = numpy.asarray(image.convert('RGBA'))
+        if tex_format == 4: # RGBA5551, the alpha is 1 bit
+            rgb = quantize(rgba[:,:,0:3], 5, dither)
+            texels = (rgb[:,:,0] << 11) | (rgb[:,:,1] << 6) | (rgb[:,:,2] << 1) | (rgba[:,:,3] >= 128).astype(numpy.uint16)
+            data = texels.astype('<u2').tobytes()
+        elif tex_format == 5: # RGBA4444
+            q = quantize(rgba, 4, dither)
+            texels = (q[:,:,0] << 12) | (q[:,:,1] << 8) | (q[:,:,2] << 4) | q[:,:,3]
+            data = texels.astype('<u2').tobytes()
+        elif tex_format == 6: # RGB888
+            data = rgba[:,:,0:3].tobytes()
+        elif tex_format == 7: # RGBA8888
+            data = rgba.tobytes()
+        else:
+            raise ValueError("Texture format {} is not supported".format(tex_format))
+    add_count(profile, 'pixels', image.width * image.height)
+    return(data)
+
+def read_txp_layout (txp_file, data = None, profile = None):
+    # Returns the header values and texture descriptors (with the stored texel data and the value of
+    # each texture in the table at hash_offset) of a txp, and whether it was compressed
+    data = read_input(txp_file, data)
+    unc_data = read_txp_data(txp_file, profile = profile, data = data, log = None)
+    txp = {'compressed': not data[0:4] == b'GLTP', 'textures': []}
+    with io.BytesIO(unc_data) as f:
+        if not f.read(4) == b'GLTP':
+            return(None)
+        txp['version'], num_files, hash_offset = struct.unpack("<3I", f.read(12))
+        txp['header_unknown'] = f.read(16)
+        for i in range(num_files):
+            f.seek(0x20 * (i+1), 0)
+            texture = {}
+            desc_offset, tex_size, tex_offset, texture['format'], texture['width'], texture['height'],\
+                texture['maybe_mips'], texture['unk1'], texture['unk2'] = struct.unpack("<4I2H3I", f.read(32))
+            f.seek(desc_offset, 0)
+            texture['name'] = read_null_terminated_string(f)
+            f.seek(tex_offset, 0)
+            texture['data'] = f.read(tex_size)
+            f.seek(hash_offset + 4 * i, 0)
+            texture['hash'], = struct.unpack("<I", f.read(4))
+            txp['textures'].append(texture)
+    return(txp)
+
+def build_txp (txp):
+    # Packs the textures of a layout from read_txp_layout() into an uncompressed GLTP container.  The
+    # names come after the descriptors, then the hash table (aligned to 4), then the texel data of
+    # each texture (aligned to 16).
+    num_files = len(txp['textures'])
+    header_size = 0x20 * (num_files + 1)
+    names = b''.join([x['name'].encode() + b'\x00' for x in txp['textures']])
+    name_offsets = [header_size + sum([len(y['name'].encode()) + 1 for y in txp['textures'][:i]]) for i in range(num_files)]
+    hash_offset = header_size + len(names) + (-(header_size + len(names)) % 4)
+    data_offset = hash_offset + 4 * num_files + (-(hash_offset + 4 * num_files) % 16)
+    descriptors, pixel_data = [], [b'\x00' * (data_offset - hash_offset - 4 * num_files)]
+    for i in range(num_files):
+        texture = txp['textures'][i]
+        descriptors.append(struct.pack("<4I2H3I", name_offsets[i], len(texture['data']), data_offset, texture['format'],\
+            texture['width'], texture['height'], texture['maybe_mips'], texture['unk1'], texture['unk2']))
+        pixel_data.append(texture['data'] + b'\x00' * (-len(texture['data']) % 16))
+        data_offset += len(pixel_data[-1])
+    return(b''.join([b'GLTP', struct.pack("<3I", txp['version'], num_files, hash_offset), txp['header_unknown']]\
+        + descriptors + [names, b'\x00' * (hash_offset - header_size - len(names)),\
+        struct.pack("<{}I".format(num_files), *[x['hash'] for x in txp['textures']])] + pixel_data))
+
+def import_txp (txp_file, png_files = None, png_folder = '.', output_file = None, tex_format = None, dither = False,\
+        compress = None, level = default_level, profile = None, names = None):
+    # Replaces the textures of txp_file with the .png files named after them in png_folder (or only with
+    # png_files), and adds any of png_files that are not in it yet.  If txp_file does not exist, a new
+    # one is made from png_files.  tex_format overrides the format of the textures written (new ones are
+    # RGBA8888 by default).  The result is compressed if compress is True, or if it is None and the
+    # original was compressed (a new txp is compressed by default).  Textures that vato_extract_txp.py
+    # named from the name index names are looked for under that name, then under their own name.
+    print("Processing {}...".format(txp_file))
+    if os.path.exists(txp_file):
+        txp = read_txp_layout(txp_file, profile = profile)
+        if txp is None:
+            print("{} is not a txp file!".format(txp_file))
+            return
+    else:
+        # The unknown header values and hashes of new textures are left zero
+        txp = {'compressed': True, 'version': 1, 'header_unknown': b'\x00' * 16, 'textures': []}
+    file_names = [resolve_name(names, x['hash']) for x in txp['textures']]
+    file_names = [txp['textures'][i]['name'] if file_names[i] is None else output_name(file_names[i]) for i in range(len(file_names))]
+    if png_files is None:
+        # The name index may have settled on a hash function since the textures were extracted (it
+        # only resolves names after several matches), so the name stored in the txp is tried as well
+        png_files = []
+        for i in range(len(file_names)):
+            for name in dict.fromkeys([file_names[i], txp['textures'][i]['name']]):
+                if os.path.exists(os.path.join(png_folder, name + '.png')):
+                    png_files.append(os.path.join(png_folder, name + '.png'))
+                    break
+    if len(png_files) == 0:
+        print("No textures to import into {}, skipping.".format(txp_file))
+        return
+    texture_index = {txp['textures'][i]['name']: i for i in range(len(txp['textures']))}
+    texture_index.update({file_names[i]: i for i in range(len(file_names))})
+    for png_file in png_files:
+        name = os.path.basename(png_file)[:-4] if png_file[-4:].lower() == '.png' else os.path.basename(png_file)
+        if name in texture_index:
+            texture = txp['textures'][texture_index[name]]
+        else:
+            texture = {'name': name, 'format': 7, 'maybe_mips': 1, 'unk1': 0, 'unk2': 0, 'hash': 0}
+            texture_index[name] = len(txp['textures'])
+            txp['textures'].append(texture)
+        if tex_format is not None:
+            texture['format'] = tex_format
+        elif not texture['format'] in texel_layouts:
+            print("{0} is in an unsupported format, type {1}, writing it as RGBA8888.".format(name, texture['format']))
+            texture['format'] = 7
+        with Image.open(png_file) as image:
+            if image.width > 0xFFFF or image.height > 0xFFFF:
+                print("{} is too large for a txp, skipping!".format(png_file))
+                continue
+            texture['width'], texture['height'] = image.width, image.height
+            texture['data'] = encode_vato_texture(image, texture['format'], dither, profile)
+        add_count(profile, 'textures')
+        print("  {0} ({1}, {2}x{3})".format(name, texel_layouts[texture['format']]['name'], texture['width'], texture['height']))
+    output = build_txp(txp)
+    if compress == True or (compress is None and txp['compressed'] == True):
+        output = compress_taiko_v(output, level, profile)
+    with profile_stage(profile, 'file_write'):
+        with open(txp_file if output_file is None else output_file, 'wb') as f:
+            f.write(output)
+    add_bytes(profile, 'written', len(output))
+    return
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    # If argument given, attempt to import into file in argument
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-i', '--input', help="Folder with the edited .png files (default: the current folder)", default = '.')
+        parser.add_argument('-o', '--output', help="Write to this .txp instead of modifying the original")
+        parser.add_argument('-f', '--format', help="Texture format to write: 4 (RGBA5551), 5 (RGBA4444), 6 (RGB888) or 7 (RGBA8888) (default: keep the format, 7 for new textures)",\
+            type = int, choices = sorted(texel_layouts))
+        parser.add_argument('-d', '--dither', help="Use ordered dithering when reducing to RGBA5551 / RGBA4444", action="store_true")
+        parser.add_argument('-c', '--compress', help="Compress the .txp (default: if the original was compressed)", action="store_true", default = None)
+        parser.add_argument('-u', '--uncompressed', help="Do not compress the .txp", dest = 'compress', action="store_false")
+        parser.add_argument('-l', '--level', help="Compression level, see vato_compress_txp.py (default: {})".format(default_level),\
+            type = int, default = default_level, choices = range(10))
+        parser.add_argument('-p', '--profile', help="Write per-stage timings to a JSON report (added to the report if it exists)")
+        parser.add_argument('--names', help="Name index that the textures were named from (default: {})".format(default_names_file),\
+            default = default_names_file)
+        parser.add_argument('txp_filename', help="Name of txp file to import into (it is made if it does not exist).")
+        parser.add_argument('png_filenames', nargs='*', help="Only import (or add) these .png files, named after the textures")
+        args = parser.parse_args()
+        if args.txp_filename[-4:].lower() == '.txp' and (os.path.exists(args.txp_filename) or len(args.png_filenames) > 0):
+            profile = new_profile(args.txp_filename, 'vato_import_txp') if args.profile else None
+            import_txp(args.txp_filename, png_files = args.png_filenames if len(args.png_filenames) > 0 else None,\
+                png_folder = args.input, output_file = args.output, tex_format = args.format, dither = args.dither,\
+                compress = args.compress, level = args.level, profile = profile, names = load_name_index(args.names))
+            if profile is not None:
+                write_profile_report([profile], args.profile)
+    else:
+        txp_files = glob.glob('*.txp')
+        names = load_name_index()
+        for i in range(len(txp_files)):
+            import_txp(txp_files[i], names = names)
@@ -0,0 +1,267 @@
+# Tool to repack files into the pck format used by Valkyrie Anatomia: The Origin.
+#
+# Usage:  Unpack with vato_unpack_pck.py --manifest, which saves the layout of the archive to
+# a .pck.json file.  Edit the unpacked files, then run this script by itself without
+# commandline arguments and it will repack every .pck.json manifest it finds in the folder.
+#
+# If the .pck still matches its manifest, only the entries that were edited are written:
+# an entry that still fits in its old slot is overwritten in place, otherwise it is moved
+# to a free slot or to the end of the file, and the offset table is patched.
+#
+# For command line options, run:
+# /path/to/python3 vato_pack_pck.py --help
+#
+# Requires vato_unpack_pck.py, put in the same directory
+#
+# GitHub eArmada8/vato_mdl_tool
+
+try:
+    import io, json, struct, glob, os, sys
+    from vato_unpack_pck import default_chunk_size, hash_pck_entry
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+def table_entry_size (flags):
+    return(8 + (0x80 if flags == 0x80 else 0))
+
+def make_name_record (name):
+    name_record = name.encode() + b'\x00'
+    if len(name_record) > 0x80:
+        print("Entry name {} is too long, truncating!".format(name))
+        name_record = name_record[:0x7F] + b'\x00'
+    return(name_record + b'\x00' * (0x80 - len(name_record)))
+
+def copy_file_into (f, filename, chunk_size = default_chunk_size):
+    # Returns the number of bytes copied
+    size = 0
+    with open(filename, 'rb') as ff:
+        while True:
+            chunk = ff.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            f.write(chunk)
+            size += len(chunk)
+    return(size)
+
+def file_hash (filename, chunk_size = default_chunk_size):
+    with open(filename, 'rb') as f:
+        return(hash_pck_entry(f, os.path.getsize(filename), b'', chunk_size))
+
+def entry_changed (entry, folder, chunk_size = default_chunk_size):
+    # Size and modification time are checked first, so unchanged files are usually not read
+    if 'pck' in entry:
+        return(any([entry_changed(x, folder, chunk_size) for x in entry['pck']['entries']]))
+    filename = os.path.join(folder, entry['file'])
+    stat = os.stat(filename)
+    if not 'hash' in entry:
+        entry['hash'], entry['mtime_ns'] = file_hash(filename, chunk_size), stat.st_mtime_ns
+        return(True)
+    if entry.get('mtime_ns') == stat.st_mtime_ns and entry['hash'].split('_')[-1] == str(stat.st_size):
+        return(False)
+    new_hash = file_hash(filename, chunk_size)
+    entry['mtime_ns'] = stat.st_mtime_ns
+    if new_hash == entry['hash']:
+        return(False)
+    entry['hash'] = new_hash
+    return(True)
+
+def shared_files (pck_manifest, folder, inodes = None):
+    # Returns the groups of entry files that are hard links to the same file (from an unpack by an
+    # older version with dedup), since editing one of them changes all of them
+    top_level = inodes is None
+    if top_level:
+        inodes = {}
+    for entry in pck_manifest['entries']:
+        if 'pck' in entry:
+            shared_files(entry['pck'], folder, inodes)
+        else:
+            stat = os.stat(os.path.join(folder, entry['file']))
+            if stat.st_nlink > 1:
+                inodes.setdefault((stat.st_dev, stat.st_ino), set()).add(entry['file'])
+    if top_level:
+        return([sorted(x) for x in inodes.values() if len(x) > 1])
+    return
+
+def update_hashes (pck_manifest, folder, chunk_size = default_chunk_size):
+    # Used after a full rebuild, when every entry has just been written
+    for entry in pck_manifest['entries']:
+        if 'pck' in entry:
+            update_hashes(entry['pck'], folder, chunk_size)
+        else:
+            entry['hash'] = file_hash(os.path.join(folder, entry['file']), chunk_size)
+            entry['mtime_ns'] = os.stat(os.path.join(folder, entry['file'])).st_mtime_ns
+    return
+
+def write_pck (f, pck_manifest, folder, chunk_size = default_chunk_size):
+    # Writes the whole archive at the current position of f.  Offsets are relative to the start of
+    # the archive, so nested archives are written in place.  Updates the offsets and sizes in the manifest.
+    if not pck_manifest['flags'] in [0, 0x80]:
+        raise ValueError("Cannot write a .pck with flags {:#x}, only 0x00 and 0x80 are supported".format(pck_manifest['flags']))
+    base_offset = f.tell()
+    alignment = pck_manifest.get('alignment', 0x10)
+    entries = pck_manifest['entries']
+    pck_manifest.pop('free_slots', None)
+    f.write(struct.pack("<4I", len(entries), pck_manifest['flags'], pck_manifest['unk'], pck_manifest['unk2']))
+    f.write(b'\x00' * (table_entry_size(pck_manifest['flags']) * len(entries)))
+    for entry in entries:
+        f.write(b'\x00' * (-(f.tell() - base_offset) % alignment))
+        entry['offset'] = f.tell() - base_offset
+        if 'pck' in entry:
+            write_pck(f, entry['pck'], folder, chunk_size)
+            entry['size'] = f.tell() - base_offset - entry['offset']
+        else:
+            entry['size'] = copy_file_into(f, os.path.join(folder, entry['file']), chunk_size)
+    if pck_manifest.get('pad_end', False) == True:
+        f.write(b'\x00' * (-(f.tell() - base_offset) % alignment))
+    end_offset = f.tell()
+    f.seek(base_offset + 16)
+    f.write(make_pck_table(pck_manifest))
+    f.seek(end_offset)
+    return
+
+def make_pck_table (pck_manifest):
+    table = bytes()
+    for entry in pck_manifest['entries']:
+        table += struct.pack("<2I", entry['offset'], entry['size'])
+        if pck_manifest['flags'] == 0x80:
+            table += make_name_record(entry.get('name', ''))
+    return(table)
+
+def read_pck_table (f, flags, num_entries):
+    table = []
+    for i in range(num_entries):
+        table.append(struct.unpack("<2I", f.read(8)))
+        if flags == 0x80:
+            f.seek(0x80, 1)
+    return(table)
+
+def merge_free_slots (free_slots):
+    # Joins free slots that are next to each other
+    merged = []
+    for offset, size in sorted(free_slots):
+        if len(merged) > 0 and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + size)
+        else:
+            merged.append((offset, size))
+    return(merged)
+
+def patch_pck (pck_filename, pck_manifest, folder, chunk_size = default_chunk_size):
+    # Rewrites only the changed entries of an existing archive.  Returns the number of entries
+    # written, or None if the archive no longer matches the manifest and must be rebuilt.  The slots
+    # left free by moved entries are kept in the manifest, so that later runs can reuse them.
+    alignment = pck_manifest.get('alignment', 0x10)
+    entries = pck_manifest['entries']
+    with open(pck_filename, 'r+b') as f:
+        num_entries, flags, unk, unk2 = struct.unpack("<4I", f.read(16))
+        if not (num_entries == len(entries) and flags == pck_manifest['flags']):
+            return(None)
+        table = read_pck_table(f, flags, num_entries)
+        if not all([table[i] == (entries[i]['offset'], entries[i]['size']) for i in range(num_entries)]):
+            return(None)
+        file_size = f.seek(0, 2)
+        free_slots = [tuple(x) for x in pck_manifest.get('free_slots', [])]
+        # The slot of an entry runs up to the start of the next entry or free slot (or the end of the file)
+        starts = sorted(set([x[0] for x in table] + [x[0] for x in free_slots] + [file_size]))
+        slots = {x[0]: starts[starts.index(x[0]) + 1] - x[0] for x in table}
+        changed = [i for i in range(num_entries) if entry_changed(entries[i], folder, chunk_size)]
+        for i in changed:
+            with io.BytesIO() as entry_data:
+                if 'pck' in entries[i]:
+                    write_pck(entry_data, entries[i]['pck'], folder, chunk_size)
+                    new_size = entry_data.tell()
+                else:
+                    new_size = os.path.getsize(os.path.join(folder, entries[i]['file']))
+                file_size = f.seek(0, 2)
+                old_offset = entries[i]['offset']
+                if new_size <= slots[old_offset] or old_offset + slots[old_offset] == file_size:
+                    # The last entry can grow past the end of the file
+                    new_offset = old_offset
+                    slots[new_offset] = max(new_size, slots[old_offset])
+                else:
+                    # Identical entries can share a slot, which is only free once none of them is left in it
+                    if not any([entries[j]['offset'] == old_offset for j in range(num_entries) if j != i]):
+                        free_slots = merge_free_slots(free_slots + [(old_offset, slots[old_offset])])
+                    fitting_slots = [x for x in free_slots if x[1] >= new_size]
+                    if len(fitting_slots) > 0:
+                        new_offset, slot_size = fitting_slots[0]
+                        free_slots.remove(fitting_slots[0])
+                        # What is left of the slot after the entry (aligned) stays free
+                        used_size = new_size + (-(new_offset + new_size) % alignment)
+                        if used_size < slot_size:
+                            free_slots.append((new_offset + used_size, slot_size - used_size))
+                            slot_size = used_size
+                    else:
+                        new_offset = file_size + (-file_size % alignment)
+                        slot_size = new_size
+                    slots[new_offset] = slot_size
+                f.seek(new_offset)
+                if 'pck' in entries[i]:
+                    f.write(entry_data.getbuffer())
+                else:
+                    copy_file_into(f, os.path.join(folder, entries[i]['file']), chunk_size)
+                if f.tell() > file_size and pck_manifest.get('pad_end', False) == True:
+                    f.write(b'\x00' * (-f.tell() % alignment))
+            entries[i]['offset'], entries[i]['size'] = new_offset, new_size
+        if len(changed) > 0:
+            f.seek(16)
+            f.write(make_pck_table(pck_manifest))
+        pck_manifest['free_slots'] = [list(x) for x in merge_free_slots(free_slots)]
+    return(len(changed))
+
+def pack_pck (manifest_filename, pck_filename = None, full_rebuild = False, chunk_size = default_chunk_size):
+    # The manifest is updated with the new layout and hashes afterwards
+    if pck_filename is None:
+        pck_filename = manifest_filename[:-5] if manifest_filename[-5:].lower() == '.json' else manifest_filename + '.pck'
+    with open(manifest_filename, 'rb') as f:
+        pck_manifest = json.loads(f.read())
+    folder = os.path.dirname(os.path.abspath(manifest_filename))
+    print("Processing {}...".format(pck_filename))
+    for group in shared_files(pck_manifest, folder):
+        print("Warning: {} are hard links to the same file, so an edit to one is packed into all of them!".format(', '.join(group)))
+    num_changed = None
+    if full_rebuild == False and os.path.exists(pck_filename):
+        num_changed = patch_pck(pck_filename, pck_manifest, folder, chunk_size)
+    if num_changed is None:
+        with open(pck_filename + '.tmp', 'wb') as f:
+            write_pck(f, pck_manifest, folder, chunk_size)
+        os.replace(pck_filename + '.tmp', pck_filename)
+        update_hashes(pck_manifest, folder, chunk_size)
+        print("Rebuilt {}.".format(pck_filename))
+    else:
+        print("Patched {0} changed entries in {1}.".format(num_changed, pck_filename))
+    with open(manifest_filename, 'wb') as f:
+        f.write(json.dumps(pck_manifest, indent=4).encode('utf-8'))
+    return
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    # If argument given, attempt to pack from manifest in argument
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-f', '--full', help="Rebuild the whole archive instead of patching the changed entries", action="store_true")
+        parser.add_argument('-o', '--output', help="Name of the pck file to write (default: the manifest name without .json)")
+        parser.add_argument('-c', '--chunk-size', help="Files are copied in chunks of this size, in KiB (default: 1024)",\
+            type = int, default = default_chunk_size // 1024)
+        parser.add_argument('manifest_filename', nargs='?', help="Name of the .pck.json manifest to pack (default: all manifests in the folder).")
+        args = parser.parse_args()
+        if args.manifest_filename is None:
+            manifest_files = glob.glob('*.pck.json')
+        elif os.path.exists(args.manifest_filename):
+            manifest_files = [args.manifest_filename]
+        else:
+            manifest_files = []
+        for i in range(len(manifest_files)):
+            pack_pck(manifest_files[i], pck_filename = args.output if len(manifest_files) == 1 else None,\
+                full_rebuild = args.full, chunk_size = args.chunk_size * 1024)
+    else:
+        manifest_files = glob.glob('*.pck.json')
+        for i in range(len(manifest_files)):
+            pack_pck(manifest_files[i])
@@ -3,12 +3,130 @@
 # Usage:  Run by itself without commandline arguments and it will rename
 # every file it finds via a recursive search.
 #
+# Every rename is recorded in a journal (vato_rename_journal.jsonl), so an interrupted run
+# can be resumed without rescanning finished folders, and a run can be undone with --undo.
+#
 # For command line options, run:
 # /path/to/python3 vato_rename_base64_filenames.py --help
 #
 # GitHub eArmada8/vato_mdl_tool
 
-import base64, glob, os, sys
+import base64, binascii, json, os, sys
+from concurrent.futures import ThreadPoolExecutor
+
+journal_filename = 'vato_rename_journal.jsonl'
+
+def decode_base64_name (name):
+    # Returns None unless the name is strict base64 of printable text that is usable as a filename
+    try:
+        decoded = base64.b64decode(name.encode("ascii"), validate = True).decode("utf-8")
+    except (UnicodeError, binascii.Error, ValueError):
+        return(None)
+    if decoded in ['', '.', '..'] or not decoded.isprintable() or '/' in decoded or '\\' in decoded:
+        return(None)
+    return(decoded)
+
+def plan_folder_renames (entries, stats, renamed_names = set()):
+    # Only files with an extension are renamed, and never the python scripts themselves.  Files that
+    # the journal shows were already renamed (renamed_names) are left alone, since a decoded name can
+    # itself be valid base64.
+    existing_names = set([os.path.normcase(x.name) for x in entries])
+    target_names = set()
+    renames = []
+    for entry in entries:
+        if not entry.is_file(follow_symlinks = False) or entry.name[0] == '.' or not '.' in entry.name\
+            or entry.name[-3:] == '.py' or entry.name in renamed_names:
+            continue
+        filename, ext = os.path.splitext(entry.name)
+        real_filename = decode_base64_name(filename)
+        if real_filename is None:
+            stats['skipped'] += 1
+            continue
+        new_name = real_filename + ext
+        if os.path.normcase(new_name) in existing_names or os.path.normcase(new_name) in target_names:
+            print("Cannot rename {0} to {1}, a file with that name already exists!".format(entry.path, new_name))
+            stats['collisions'] += 1
+            continue
+        target_names.add(os.path.normcase(new_name))
+        renames.append((entry.name, new_name))
+    return(renames)
+
+def read_journal (journal_file):
+    renames, finished_folders = [], set()
+    if os.path.exists(journal_file):
+        with open(journal_file, 'r', encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # Last line of an interrupted run may be incomplete
+                    continue
+                if 'finished' in record:
+                    finished_folders.add(record['finished'])
+                else:
+                    renames.append(record)
+    return(renames, finished_folders)
+
+def rename_files (root = '.', journal_file = journal_filename, workers = 8, dry_run = False, rescan = False):
+    # Folders are walked depth-first, and a folder is marked as finished in the journal only once
+    # everything under it has been renamed, so resuming skips whole finished subtrees.
+    # Files renamed in a folder that was interrupted before it finished are in the journal too.
+    stats = {'renamed': 0, 'skipped': 0, 'collisions': 0, 'errors': 0}
+    journal_renames, finished_folders = read_journal(journal_file)
+    renamed = set([(x['folder'], x['to']) for x in journal_renames])
+    if rescan:
+        finished_folders = set()
+    journal = None if dry_run else open(journal_file, 'a', encoding = 'utf-8')
+    def log (record):
+        if journal is not None:
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+    def rename (folder, old_name, new_name):
+        try:
+            if not dry_run:
+                os.rename(os.path.join(folder, old_name), os.path.join(folder, new_name))
+            return(True)
+        except OSError as e:
+            print("Unable to rename {0}: {1}".format(os.path.join(folder, old_name), e))
+            return(False)
+    def walk (folder, pool):
+        relative_folder = os.path.relpath(folder, root)
+        if relative_folder in finished_folders:
+            return
+        with os.scandir(folder) as it:
+            entries = list(it)
+        renames = plan_folder_renames(entries, stats, set([x[1] for x in renamed if x[0] == relative_folder]))
+        for (old_name, new_name), success in zip(renames, pool.map(lambda x: rename(folder, *x), renames)):
+            if success:
+                log({'folder': relative_folder, 'from': old_name, 'to': new_name})
+                stats['renamed'] += 1
+            else:
+                stats['errors'] += 1
+        for entry in entries:
+            if entry.is_dir(follow_symlinks = False):
+                walk(entry.path, pool)
+        log({'finished': relative_folder})
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            walk(root, pool)
+    finally:
+        if journal is not None:
+            journal.close()
+    return(stats)
+
+def undo_renames (root = '.', journal_file = journal_filename):
+    stats = {'restored': 0, 'errors': 0}
+    renames, _ = read_journal(journal_file)
+    for record in reversed(renames):
+        folder = os.path.join(root, record['folder'])
+        try:
+            os.rename(os.path.join(folder, record['to']), os.path.join(folder, record['from']))
+            stats['restored'] += 1
+        except OSError as e:
+            print("Unable to restore {0}: {1}".format(os.path.join(folder, record['to']), e))
+            stats['errors'] += 1
+    if stats['errors'] == 0 and os.path.exists(journal_file):
+        os.remove(journal_file)
+    return(stats)
 
 if __name__ == "__main__":
     # Set current directory
@@ -17,12 +135,18 @@ if __name__ == "__main__":
     else:
         os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
-    files = [x for x in glob.glob('**/*.*', recursive = True) if not x[-3:] == '.py']
-    for file in files:
-        foldername = os.path.dirname(file)
-        filename, ext = os.path.splitext(os.path.basename(file))
-        #print("filename: {}".format(filename))
-        real_filename = base64.b64decode(filename.encode("ascii"))
-        if not foldername == '':
-            foldername += '/'
-        os.rename(foldername + filename+ext, foldername + real_filename.decode()+ext)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--undo', help="Undo the renames recorded in the journal", action="store_true")
+    parser.add_argument('-n', '--dry-run', help="Report what would be renamed without renaming anything", action="store_true")
+    parser.add_argument('-r', '--rescan', help="Rescan folders that the journal lists as finished", action="store_true")
+    parser.add_argument('-w', '--workers', help="Number of parallel renames within a folder (default: 8)", type = int, default = 8)
+    parser.add_argument('-j', '--journal', help="Journal file (default: {})".format(journal_filename), default = journal_filename)
+    args = parser.parse_args()
+    if args.undo:
+        stats = undo_renames(journal_file = args.journal)
+        print("Restored {0} files, {1} errors.".format(stats['restored'], stats['errors']))
+    else:
+        stats = rename_files(journal_file = args.journal, workers = args.workers, dry_run = args.dry_run, rescan = args.rescan)
+        print("{0} {1} files, skipped {2} names that are not base64, {3} collisions, {4} errors.".format(\
+            'Would rename' if args.dry_run else 'Renamed', stats['renamed'], stats['skipped'], stats['collisions'], stats['errors']))
@@ -1,7 +1,9 @@
 # Tool to export files from the pck format used by Valkyrie Anatomia: The Origin.
 #
 # Usage:  Run by itself without commandline arguments and it will read
-# every pck file it finds in the folder and output contained files.
+# every pck file it finds in the folder and output contained files.  The strings of string
+# archives (flag 0x10) are added to vato_names.json, and used to name the entries (and the textures
+# of txp entries) that are only known by hash, see lib_vato_names.py.
 #
 # For command line options, run:
 # /path/to/python3 vato_unpack_pck.py --help
@@ -9,7 +11,10 @@
 # GitHub eArmada8/vato_mdl_tool
 
 try:
-    import io, struct, glob, os, sys
+    import hashlib, json, struct, glob, os, sys
+    from lib_vato_profile import *
+    from lib_vato_io import *
+    from lib_vato_names import *
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
@@ -21,7 +26,44 @@ def read_null_terminated_string (f):
         null_term_string += f.read(1)
     return(null_term_string[:-1].decode())
 
-def write_pck_entry (filedata, entry_name):
+# Entries larger than this are copied to disk in chunks of this size, instead of being read whole
+default_chunk_size = 1024 * 1024
+
+def new_extract_state (overwrite = False):
+    # Used when entries are sent straight to the extractors instead of being written to disk.
+    # Animations are held until the archive is finished, since they need a skeleton from a model.
+    return({'overwrite': overwrite, 'skeleton': None, 'animations': []})
+
+def extract_pck_entry (filedata, entry_name, extension, extract, profile = None, writer = None, names = None):
+    if extension == 'mdl':
+        import vato_extract_imdl, vato_extract_imtn
+        vato_extract_imdl.process_imdl(entry_name, overwrite = extract['overwrite'], profile = profile, data = filedata,\
+            writer = writer, names = names)
+        if extract['skeleton'] is None or entry_name[-11:] == '00_base.mdl':
+            extract['skeleton'] = vato_extract_imtn.obtain_skeleton_from_imdl(entry_name, data = filedata)
+    elif extension == 'mtn':
+        extract['animations'].append((entry_name, filedata))
+    elif extension == 'txp':
+        import vato_extract_txp
+        vato_extract_txp.process_txp_file(entry_name, profile = profile, data = filedata, writer = writer, names = names)
+    return
+
+def finish_extraction (extract, profile = None, writer = None):
+    if len(extract['animations']) > 0:
+        import vato_extract_imtn
+        if extract['skeleton'] is None and os.path.exists('00_base.mdl'):
+            extract['skeleton'] = vato_extract_imtn.obtain_skeleton_from_imdl('00_base.mdl')
+        if extract['skeleton'] is None:
+            print("No .mdl found to use as a skeleton!  Skipping {} animation(s).".format(len(extract['animations'])))
+        else:
+            for entry_name, filedata in extract['animations']:
+                vato_extract_imtn.process_imtn(entry_name, extract['skeleton'], overwrite = extract['overwrite'],\
+                    profile = profile, data = filedata, writer = writer)
+    extract['animations'] = []
+    return
+
+def sniff_pck_entry (filedata):
+    # Only the first 0x20 bytes are needed to identify an entry
     if filedata[0:4] == b'IANM':
         extension = 'anm'
     elif filedata[0:4] == b'IMDL':
@@ -38,38 +80,221 @@ def write_pck_entry (filedata, entry_name):
         extension = 'pck'
     else:
         extension = 'bin'
-    if not entry_name[:-4] == '.' + extension:
+    return(extension)
+
+def resolve_entry_name (f, entry_size, extension, names):
+    # Entries of archives without names only have a hash in their contents: txp files have one for
+    # each texture.  Returns the first of them that is in the name index, or None.  f is at the start
+    # of the entry, and only its header is read.
+    if extension == 'txp':
+        import vato_extract_txp
+        for name_hash in vato_extract_txp.read_txp_hashes(f, entry_size):
+            resolved_name = resolve_name(names, name_hash)
+            if resolved_name is not None:
+                return(output_name(resolved_name))
+    return(None)
+
+def copy_pck_entry (f, entry_size, head, entry_name, chunk_size = default_chunk_size, writer = None):
+    # f is positioned just after head.  Small entries are passed to the writer whole, large ones are
+    # copied a chunk at a time, so memory use does not depend on the size of the entry.
+    if entry_size <= chunk_size:
+        write_output(writer, entry_name, head + f.read(entry_size - len(head)))
+    else:
+        with open(entry_name, 'wb') as ff:
+            ff.write(head)
+            remaining = entry_size - len(head)
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if len(chunk) == 0: # Truncated archive
+                    break
+                ff.write(chunk)
+                remaining -= len(chunk)
+    return
+
+def new_dedup_index ():
+    # Content hashes of the entries written so far in a batch, so that repeats can be cloned from the
+    # first copy instead of written again.  reflink records, for each output folder, whether the first
+    # clone made there worked; if not, entries written there are no longer hashed.
+    return({'hashes': {}, 'linked': {}, 'saved_bytes': 0, 'reflink': {}})
+
+def dedup_enabled (dedup, entry_name):
+    return(dedup is not None and not dedup['reflink'].get(os.path.dirname(os.path.abspath(entry_name))) == False)
+
+def hash_pck_entry (f, entry_size, head, chunk_size = default_chunk_size):
+    # f is positioned just after head, and is returned there afterwards
+    start = f.tell()
+    entry_hash = hashlib.blake2b(head, digest_size = 20)
+    remaining = entry_size - len(head)
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if len(chunk) == 0:
+            break
+        entry_hash.update(chunk)
+        remaining -= len(chunk)
+    f.seek(start)
+    return(entry_hash.hexdigest() + '_{}'.format(entry_size))
+
+def dedup_pck_entry (f, entry_size, head, entry_name, dedup, chunk_size = default_chunk_size, writer = None,\
+        entry_hash = None):
+    # Returns True if the entry was cloned from an identical entry already written in this batch.
+    # Otherwise (or if the filesystem cannot clone files) the caller writes it as usual.
+    if entry_hash is None:
+        entry_hash = hash_pck_entry(f, entry_size, head, chunk_size)
+    if entry_hash in dedup['hashes'] and os.path.exists(dedup['hashes'][entry_hash]):
+        wait_for_output(writer, dedup['hashes'][entry_hash])
+        link_type = link_file(dedup['hashes'][entry_hash], entry_name)
+        folder = os.path.dirname(os.path.abspath(entry_name))
+        if not folder in dedup['reflink']:
+            dedup['reflink'][folder] = link_type is not None
+            if link_type is None:
+                print("Reflinks are not supported in {}, writing its entries without deduplication.".format(folder))
+        if link_type is not None:
+            dedup['linked'][link_type] = dedup['linked'].get(link_type, 0) + 1
+            dedup['saved_bytes'] += entry_size
+            return(True)
+    else:
+        dedup['hashes'][entry_hash] = entry_name
+    return(False)
+
+def write_pck_entry (f, entry_offset, entry_size, entry_name, profile = None, extract = None, writer = None,\
+        chunk_size = default_chunk_size, dedup = None, manifest = False, names = None, named = True):
+    # Returns the manifest record of the entry: the file it was written to (with its hash if manifest
+    # is True, so vato_pack_pck.py can tell whether it was edited), or the manifest of a nested archive.
+    # If the entry is not named in the archive (named is False), it is named from the name index.
+    f.seek(entry_offset)
+    head = f.read(min(entry_size, 0x20))
+    extension = sniff_pck_entry(head)
+    if named == False and has_names(names) and extension == 'txp':
+        with profile_stage(profile, 'string_lookup'):
+            f.seek(entry_offset)
+            resolved_name = resolve_entry_name(f, entry_size, extension, names)
+        f.seek(entry_offset + len(head))
+        if resolved_name is not None:
+            entry_name += '_' + resolved_name
+            add_count(profile, 'resolved_names')
+    if not entry_name[-4:] == '.' + extension:
         entry_name += '.' + extension
-    if extension == 'pck' and int.from_bytes(filedata[0:4], byteorder = 'little') > 0:
-        #Internal pck file, execute recursive function to unpack
-        with io.BytesIO(filedata) as internal_f:
-            unpack_pck(internal_f, entry_name)
+    pck_flags = int.from_bytes(head[4:8], byteorder = 'little')
+    if extension == 'pck' and int.from_bytes(head[0:4], byteorder = 'little') > 0 and pck_flags in [0, 0x80]:
+        #Internal pck file, execute recursive function to unpack, reading directly from the outer archive
+        add_count(profile, 'nested_archives')
+        f.seek(entry_offset)
+        pck_manifest = unpack_pck(f, entry_name, profile, extract, writer, chunk_size, dedup, manifest, names, entry_size)
+        set_pck_layout(pck_manifest, entry_size)
+        return({'pck': pck_manifest})
+    elif extract is not None and extension in ['mdl', 'mtn', 'txp']:
+        # The extractors need the whole entry
+        filedata = head + f.read(entry_size - len(head))
+        extract_pck_entry(filedata, entry_name, extension, extract, profile, writer, names)
+        return({'file': entry_name})
     else:
-        open("{}".format(entry_name), 'wb').write(filedata)
+        # Nested archives that cannot be unpacked (string archives and unknown flags) are kept whole, so
+        # that vato_pack_pck.py can put them back
+        if extension == 'pck' and pck_flags == 0x10 and names is not None:
+            f.seek(entry_offset)
+            unpack_pck(f, entry_name, profile, names = names, archive_size = entry_size)
+            f.seek(entry_offset + len(head))
+        entry_hash = hash_pck_entry(f, entry_size, head, chunk_size) if manifest == True else None
+        with profile_stage(profile, 'file_write'):
+            linked = dedup_enabled(dedup, entry_name) and dedup_pck_entry(f, entry_size, head, entry_name, dedup, chunk_size, writer, entry_hash)
+            if not linked:
+                copy_pck_entry(f, entry_size, head, entry_name, chunk_size, writer)
+        add_bytes(profile, 'deduplicated' if linked else 'written', entry_size)
+        if entry_hash is not None:
+            return({'file': entry_name, 'hash': entry_hash})
+        return({'file': entry_name})
+
+def set_pck_layout (pck_manifest, archive_size):
+    # Records the alignment of the entries, and whether the archive is padded after the last entry:
+    # the largest power of two (up to 0x800) that places every entry directly after the previous one
+    # (or the offset table) and pads the end to archive_size.  If there are gaps, the largest power of
+    # two that the offsets are a multiple of.
+    entries = sorted(pck_manifest['entries'], key = lambda x: x['offset'])
+    if len(entries) == 0:
+        return
+    ends = [16 + (8 + (0x80 if pck_manifest['flags'] == 0x80 else 0)) * len(entries)] + [x['offset'] + x['size'] for x in entries]
+    pck_manifest['pad_end'] = archive_size > ends[-1]
+    offsets = [x['offset'] for x in entries] + ([archive_size] if pck_manifest['pad_end'] else [])
+    for alignment in [2**i for i in reversed(range(12))]:
+        if all([offsets[i] == ends[i] + (-ends[i] % alignment) for i in range(len(offsets))]):
+            pck_manifest['alignment'] = alignment
+            return
+    alignment = 0x800
+    while alignment > 1 and any([x % alignment for x in offsets]):
+        alignment //= 2
+    pck_manifest['alignment'] = alignment
     return
 
-def unpack_pck (f, pck_filename):
+def unpack_pck (f, pck_filename, profile = None, extract = None, writer = None, chunk_size = default_chunk_size, dedup = None,\
+        manifest = False, names = None, archive_size = None):
+    # Offsets in the archive are relative to its start, which is the current position of f
+    # (nested archives are read in place from the outer archive).  Returns the layout of the
+    # archive, which is saved as a manifest for vato_pack_pck.py.  The strings of a string
+    # archive are added to the name index names (if given) instead.
+    base_offset = f.tell()
     header = {}
     header['num_entries'], header['flags'], header['unk'], header['unk2'] = struct.unpack("<4I", f.read(16))
+    pck_manifest = {'flags': header['flags'], 'unk': header['unk'], 'unk2': header['unk2'], 'entries': []}
     if header['flags'] in [0, 0x80]:
         for i in range(header['num_entries']):
-            offset, size = struct.unpack("<2I", f.read(8))
-            entry_name = pck_filename[:-4]+"_{0}".format(i)
-            entry_end_offset = f.tell()
-            if header['flags'] == 0x80:
-                entry_end_offset = f.tell() + 0x80
-                entry_name += read_null_terminated_string(f)
-            f.seek(offset)
-            filedata = f.read(size)
-            write_pck_entry (filedata, entry_name)
+            with profile_stage(profile, 'section_parse'):
+                offset, size = struct.unpack("<2I", f.read(8))
+                entry_name = pck_filename[:-4]+"_{0}".format(i)
+                entry_end_offset = f.tell()
+                entry = {'offset': offset, 'size': size}
+                if header['flags'] == 0x80:
+                    entry_end_offset = f.tell() + 0x80
+                    with profile_stage(profile, 'string_lookup'):
+                        entry['name'] = read_null_terminated_string(f)
+                        entry_name += entry['name']
+            add_count(profile, 'entries')
+            entry.update(write_pck_entry (f, base_offset + offset, size, entry_name, profile, extract, writer, chunk_size,\
+                dedup, manifest, names, header['flags'] == 0x80))
+            pck_manifest['entries'].append(entry)
             f.seek(entry_end_offset)
+    elif header['flags'] == 0x10:
+        if names is not None:
+            f.seek(base_offset)
+            with profile_stage(profile, 'string_lookup'):
+                strings = read_string_archive(f, stream_size(f) - base_offset if archive_size is None else archive_size)
+                add_names(names, strings)
+            add_count(profile, 'strings', len(strings))
+            print("Added {0} names from {1} to the name index.".format(len(strings), pck_filename))
     else: # I think these are compressed or something
         print("{} is in a .pck format that is not supported yet!".format(pck_filename))
+    return(pck_manifest)
+
+def write_pck_manifest (pck_manifest, manifest_filename):
+    # Entry filenames are stored relative to the manifest
+    def relative_paths (pck_manifest):
+        for entry in pck_manifest['entries']:
+            if 'pck' in entry:
+                relative_paths(entry['pck'])
+            else:
+                entry['file'] = os.path.relpath(entry['file'], os.path.dirname(os.path.abspath(manifest_filename)))
+    relative_paths(pck_manifest)
+    with open(manifest_filename, 'wb') as f:
+        f.write(json.dumps(pck_manifest, indent=4).encode('utf-8'))
     return
 
-def unpack_pck_file (pck_filename):
+def unpack_pck_file (pck_filename, profile = None, extract = None, writer = None, chunk_size = default_chunk_size,\
+        dedup = None, manifest = False, names = None):
+    # With manifest, the layout of the archive is saved to pck_filename + '.json' for vato_pack_pck.py
+    add_bytes(profile, 'read', os.path.getsize(pck_filename))
     with open(pck_filename, 'rb') as f:
-        unpack_pck (f, pck_filename)
+        pck_manifest = unpack_pck (f, pck_filename, profile, extract, writer, chunk_size, dedup, manifest, names)
+    if extract is not None:
+        finish_extraction(extract, profile, writer)
+    if manifest == True and pck_manifest['flags'] in [0, 0x80]:
+        set_pck_layout(pck_manifest, os.path.getsize(pck_filename))
+        write_pck_manifest(pck_manifest, pck_filename + '.json')
+
+def string_archives_first (pck_files):
+    # String archives are unpacked before the others, so that their names can be used for all of them
+    def is_string_archive (pck_filename):
+        with open(pck_filename, 'rb') as f:
+            return(f.read(8)[4:8] == b'\x10\x00\x00\x00')
+    return(sorted(pck_files, key = lambda x: not is_string_archive(x)))
 
 if __name__ == "__main__":
     # Set current directory
@@ -82,11 +307,54 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         import argparse
         parser = argparse.ArgumentParser()
-        parser.add_argument('pck_filename', help="Name of pck file to unpack (required).")
+        parser.add_argument('-x', '--extract', help="Convert mdl/mtn/txp entries straight to glb/png instead of writing them", action="store_true")
+        parser.add_argument('-o', '--overwrite', help="Overwrite existing files when extracting", action="store_true")
+        parser.add_argument('-p', '--profile', help="Write per-stage timings to a JSON report (added to the report if it exists)")
+        parser.add_argument('-c', '--chunk-size', help="Entries larger than this (in KiB) are copied in chunks of this size (default: 1024)",\
+            type = int, default = default_chunk_size // 1024)
+        parser.add_argument('-d', '--dedup', help="Clone repeated entries from the first copy written in this run (reflink) instead of writing them again",\
+            action="store_true")
+        parser.add_argument('-m', '--manifest', help="Save the layout of each archive to a .pck.json manifest for vato_pack_pck.py", action="store_true")
+        parser.add_argument('-n', '--names', help="Name index to read and add the strings of string archives to (default: {})".format(default_names_file),\
+            default = default_names_file)
+        parser.add_argument('--writer-threads', help="Number of background writer threads, 0 to write in order (default: 2)",\
+            type = int, default = 2)
+        parser.add_argument('pck_filename', nargs='?', help="Name of pck file to unpack (default: all .pck files in the folder).")
         args = parser.parse_args()
-        if os.path.exists(args.pck_filename) and args.pck_filename[-4:].lower() == '.pck':
-            unpack_pck_file(args.pck_filename)
+        if args.manifest and args.extract:
+            parser.error("--manifest cannot be used with --extract, since the entries must be written to be repacked")
+        if args.pck_filename is None:
+            pck_files = glob.glob('*.pck')
+        elif os.path.exists(args.pck_filename) and args.pck_filename[-4:].lower() == '.pck':
+            pck_files = [args.pck_filename]
+        else:
+            pck_files = []
+        pck_files = string_archives_first(pck_files)
+        names = load_name_index(args.names)
+        profiles = []
+        writer = start_writer(args.writer_threads) if args.writer_threads > 0 else None
+        dedup = new_dedup_index() if args.dedup else None
+        for i in range(len(pck_files)):
+            profile = new_profile(pck_files[i], 'vato_unpack_pck') if args.profile else None
+            extract = new_extract_state(overwrite = args.overwrite) if args.extract else None
+            unpack_pck_file(pck_files[i], profile, extract, writer, chunk_size = args.chunk_size * 1024, dedup = dedup,\
+                manifest = args.manifest, names = names)
+            if profile is not None:
+                profiles.append(profile)
+        finish_writer(writer)
+        if names['modified'] == True:
+            save_name_index(names, args.names)
+        if dedup is not None and (len(dedup['linked']) > 0 or not False in dedup['reflink'].values()):
+            print("Deduplicated {0} entries ({1}), saved {2} bytes.".format(sum(dedup['linked'].values()),\
+                ', '.join(['{0} {1}'.format(v, k) for k, v in dedup['linked'].items()]) or 'none', dedup['saved_bytes']))
+        if args.profile:
+            write_profile_report(profiles, args.profile)
     else:
-        pck_files = glob.glob('*.pck')
+        pck_files = string_archives_first(glob.glob('*.pck'))
+        names = load_name_index()
+        writer = start_writer()
         for i in range(len(pck_files)):
-            unpack_pck_file(pck_files[i])
+            unpack_pck_file(pck_files[i], writer = writer, names = names)
+        finish_writer(writer)
+        if names['modified'] == True:
+            save_name_index(names)